@@ -0,0 +1,90 @@
+"""
+Quadratic overdose and underdose objectives can be formulated in two ways in PortPy:
+
+1. 'slack' (default): a positive slack variable and a linear constraint for each voxel of the structure
+    i.e. minimize sum_squares(dO) s.t. A_s @ x <= d + dO
+2. 'hinge': hinge function of the dose without additional variables and constraints
+    i.e. minimize sum_squares(pos(A_s @ x - d))
+
+Both formulations have the same optimal solution. This example compares the problem size, build time, solve time and
+objective value of both formulations for the shipped protocols using the first patient of each disease site
+(see opt_params['dose_penalty_formulation']). It also checks if the problem is DPP (disciplined parametrized
+programming) and reports the time to solve it again after updating the weights using Optimization.update_params().
+cvxpy compiles a DPP problem once and reuses it when only the parameters are changed.
+"""
+
+import time
+import portpy.photon as pp
+
+
+def benchmark(data: pp.DataExplorer, patient_id: str, protocol_name: str, solver: str = 'MOSEK') -> list:
+    """
+    Create and solve the problem for the patient using slack and hinge formulations
+
+    :return: list of results for each formulation
+    """
+    data.patient_id = patient_id
+    ct = pp.CT(data)
+    structs = pp.Structures(data)
+    beams = pp.Beams(data)
+    clinical_criteria = pp.ClinicalCriteria(data, protocol_name=protocol_name)
+    opt_params = data.load_config_opt_params(protocol_name=protocol_name)
+    structs.create_opt_structures(opt_params=opt_params, clinical_criteria=clinical_criteria)
+    inf_matrix = pp.InfluenceMatrix(ct=ct, structs=structs, beams=beams)
+    my_plan = pp.Plan(ct=ct, structs=structs, beams=beams, inf_matrix=inf_matrix, clinical_criteria=clinical_criteria)
+
+    results = []
+    for formulation in ['slack', 'hinge']:
+        opt_params['dose_penalty_formulation'] = formulation
+        t = time.time()
+        opt = pp.Optimization(my_plan, opt_params=opt_params, clinical_criteria=clinical_criteria)
+        opt.create_cvxpy_problem()
+        build_time = time.time() - t
+        t = time.time()
+        sol, prob = opt.solve(return_cvxpy_prob=True, solver=solver, verbose=False)
+        solve_time = time.time() - t
+        obj_value = opt.obj_value
+
+        # solve again after doubling the weights of the objective functions
+        opt.update_params(**{name: 2 * param.value for name, param in opt.params.items() if name.endswith('_weight')})
+        t = time.time()
+        opt.solve(solver=solver, verbose=False, warm_start=True)
+        resolve_time = time.time() - t
+        results.append({'patient_id': patient_id, 'protocol_name': protocol_name, 'formulation': formulation,
+                        'num_variables': prob.size_metrics.num_scalar_variables,
+                        'num_constraints': prob.size_metrics.num_scalar_eq_constr +
+                                           prob.size_metrics.num_scalar_leq_constr,
+                        'is_dpp': prob.is_dpp(), 'build_time': build_time, 'solve_time': solve_time,
+                        'resolve_time': resolve_time, 'objective': obj_value})
+    return results
+
+
+def dose_penalty_formulation_benchmark():
+    # specify the patient data location.
+    data_dir = r'../../data'
+    # Use PortPy DataExplorer class to explore PortPy data
+    data = pp.DataExplorer(data_dir=data_dir)
+    patients_df = data.display_list_of_patients(return_df=True)
+
+    results = []
+    for protocol_name in ['Lung_2Gy_30Fx', 'Paraspinal_1Fx', 'Prostate_26Fx']:
+        # pick first patient of the disease site of the protocol
+        disease_site = protocol_name.split('_')[0]
+        patient_ids = patients_df.loc[patients_df['disease_site'] == disease_site, 'patient_id'].tolist()
+        if len(patient_ids) == 0:
+            print('Warning: no patient found for protocol {}'.format(protocol_name))
+            continue
+        results += benchmark(data, patient_id=sorted(patient_ids)[0], protocol_name=protocol_name)
+
+    print('{:<22}{:<16}{:<12}{:>12}{:>14}{:>8}{:>12}{:>12}{:>14}{:>14}'.format(
+        'patient_id', 'protocol_name', 'formulation', 'variables', 'constraints', 'dpp', 'build (s)', 'solve (s)',
+        're-solve (s)', 'objective'))
+    for res in results:
+        print('{:<22}{:<16}{:<12}{:>12}{:>14}{:>8}{:>12.2f}{:>12.2f}{:>14.2f}{:>14.4f}'.format(
+            res['patient_id'], res['protocol_name'], res['formulation'], res['num_variables'],
+            res['num_constraints'], str(res['is_dpp']), res['build_time'], res['solve_time'], res['resolve_time'],
+            res['objective']))
+
+
+if __name__ == "__main__":
+    dose_penalty_formulation_benchmark()
@@ -0,0 +1,102 @@
+"""
+PortPy provides a first-order solver (solver='portpy-fista') for the problems defined by the optimization parameters
+(quadratic, quadratic-overdose, quadratic-underdose and smoothness objectives with max/mean dose constraints). It uses
+only the products of the influence matrix with vectors, so the cvxpy problem is not created and the solver does not
+need the memory of the interior point solvers. Its solution is approximate (see tol and feas_tol of FistaSolver.solve()).
+
+This example compares the solve time, peak memory, objective value and constraint violation of a cvxpy solver and
+portpy-fista for the shipped protocols using the first patient of each disease site. Each problem is solved in a
+separate process to measure the peak memory (resident set size) of the process.
+Note: the resource module used to measure the memory is available on Linux and macOS
+"""
+
+import sys
+import time
+import resource
+import multiprocessing
+import numpy as np
+import portpy.photon as pp
+
+
+def get_peak_memory_mb() -> float:
+    """
+    Get the peak resident set size of the process in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS and KB on Linux
+
+
+def benchmark(data_dir: str, patient_id: str, protocol_name: str, solver: str) -> dict:
+    """
+    Create and solve the problem for the patient using the solver
+
+    :return: dictionary of results
+    """
+    data = pp.DataExplorer(data_dir=data_dir)
+    data.patient_id = patient_id
+    ct = pp.CT(data)
+    structs = pp.Structures(data)
+    beams = pp.Beams(data)
+    clinical_criteria = pp.ClinicalCriteria(data, protocol_name=protocol_name)
+    opt_params = data.load_config_opt_params(protocol_name=protocol_name)
+    structs.create_opt_structures(opt_params=opt_params, clinical_criteria=clinical_criteria)
+    inf_matrix = pp.InfluenceMatrix(ct=ct, structs=structs, beams=beams)
+    my_plan = pp.Plan(ct=ct, structs=structs, beams=beams, inf_matrix=inf_matrix, clinical_criteria=clinical_criteria)
+
+    memory_before = get_peak_memory_mb()
+    t = time.time()
+    opt = pp.Optimization(my_plan, opt_params=opt_params, clinical_criteria=clinical_criteria)
+    if solver == 'portpy-fista':
+        sol = opt.solve(solver=solver)
+        num_iter = len(opt.solver_history['iteration'])
+    else:
+        # cvxpy problem is created before solving it. So, its time and memory are included
+        opt.create_cvxpy_problem()
+        sol, prob = opt.solve(return_cvxpy_prob=True, solver=solver, verbose=False)
+        num_iter = prob.solver_stats.num_iters
+    solve_time = time.time() - t
+    peak_memory = get_peak_memory_mb()
+
+    # evaluate objective and constraints of both the solutions in the same way
+    fista_solver = opt.create_fista_solver()
+    x = sol['optimal_intensity']
+    dose_1d = inf_matrix.A @ x
+    max_violation = np.max(fista_solver.constraint_values(dose_1d), initial=0)
+    return {'patient_id': patient_id, 'protocol_name': protocol_name, 'solver': solver, 'solve_time': solve_time,
+            'num_iter': num_iter, 'memory_before': memory_before, 'peak_memory': peak_memory,
+            'objective': fista_solver.objective(x, dose_1d),
+            'max_violation_gy': max(max_violation, 0) * clinical_criteria.get_num_of_fractions()}
+
+
+def fista_solver_benchmark():
+    # specify the patient data location.
+    data_dir = r'../../data'
+    # Use PortPy DataExplorer class to explore PortPy data
+    data = pp.DataExplorer(data_dir=data_dir)
+    patients_df = data.display_list_of_patients(return_df=True)
+
+    results = []
+    # each problem is solved in a new process so that peak memory of the solvers is measured separately
+    ctx = multiprocessing.get_context('spawn')
+    for protocol_name in ['Lung_2Gy_30Fx', 'Paraspinal_1Fx', 'Prostate_26Fx']:
+        # pick first patient of the disease site of the protocol
+        disease_site = protocol_name.split('_')[0]
+        patient_ids = patients_df.loc[patients_df['disease_site'] == disease_site, 'patient_id'].tolist()
+        if len(patient_ids) == 0:
+            print('Warning: no patient found for protocol {}'.format(protocol_name))
+            continue
+        for solver in ['MOSEK', 'portpy-fista']:
+            with ctx.Pool(processes=1) as pool:
+                results.append(pool.apply(benchmark, (data_dir, sorted(patient_ids)[0], protocol_name, solver)))
+
+    print('{:<22}{:<16}{:<14}{:>12}{:>12}{:>18}{:>18}{:>14}{:>20}'.format(
+        'patient_id', 'protocol_name', 'solver', 'solve (s)', 'iterations', 'memory before (MB)', 'peak memory (MB)',
+        'objective', 'max violation (Gy)'))
+    for res in results:
+        print('{:<22}{:<16}{:<14}{:>12.2f}{:>12}{:>18.0f}{:>18.0f}{:>14.4f}{:>20.4f}'.format(
+            res['patient_id'], res['protocol_name'], res['solver'], res['solve_time'], res['num_iter'],
+            res['memory_before'], res['peak_memory'], res['objective'], res['max_violation_gy']))
+
+
+if __name__ == "__main__":
+    fista_solver_benchmark()
@@ -94,7 +94,7 @@ ecl_dose_1d = inf_matrix.dose_3d_to_1d(dose_3d=ecl_dose_3d)
 
 # *** Large Dose Discrepancy: Observed when using the truncated sparse influence matrix **
 # Visualize the DVH discrepancy between sparse and full
-dose_sparse_1d = inf_matrix.A @ (sol['optimal_intensity'] * my_plan.get_num_of_fractions())
+dose_sparse_1d = inf_matrix.compute_dose(sol['optimal_intensity'], fractions=my_plan.get_num_of_fractions())
 struct_names = ['PTV', 'ESOPHAGUS', 'HEART', 'CORD']
 fig, ax = plt.subplots(figsize=(12, 8))
 ax = pp.Visualization.plot_dvh(my_plan, dose_1d=ecl_dose_1d, struct_names=struct_names, style='solid', ax=ax, norm_flag=True)
@@ -108,7 +108,7 @@ plt.show()
 beams_full = pp.Beams(data, load_inf_matrix_full=True)
 # load influence matrix based upon beams and structure set
 inf_matrix_full = pp.InfluenceMatrix(ct=ct, structs=structs, beams=beams_full, is_full=True)
-dose_full_1d = inf_matrix_full.A @ (sol['optimal_intensity'] * my_plan.get_num_of_fractions()) # calculate dose using full matrix
+dose_full_1d = inf_matrix_full.compute_dose(sol['optimal_intensity'], fractions=my_plan.get_num_of_fractions()) # calculate dose using full matrix
 
 # Visualize the DVH discrepancy between eclipse dose and dose using full matrix in portpy
 struct_names = ['PTV', 'ESOPHAGUS', 'HEART', 'CORD']
@@ -149,7 +149,7 @@ for i in range(num_corr):
     sol_corr = opt.solve(solver='MOSEK', verbose=False)
     
     dose_sparse_corr_1d = (inf_matrix.A @ sol_corr['optimal_intensity'] + delta) * my_plan.get_num_of_fractions()
-    dose_full_corr_1d = inf_matrix_full.A @ (sol_corr['optimal_intensity'] * my_plan.get_num_of_fractions())
+    dose_full_corr_1d = inf_matrix_full.compute_dose(sol_corr['optimal_intensity'], fractions=my_plan.get_num_of_fractions())
     
     # recalculate delta
     norm_volume = 90
@@ -8,6 +8,7 @@ This example will guide you through the following processes:
 1. Generating a plan utilizing the default sparse matrix
 2. Loading the full and dense influence matrix for improved dose calculation accuracy
 3. Manually sparsifying the full influence matrix
+4. Sparsifying the full influence matrix with per-beamlet thresholds using InfluenceMatrix.sparsify
 """
 
 import portpy.photon as pp
@@ -53,7 +54,7 @@ def inf_matrix_sparsification():
     sol_sparse = opt.solve(solver='MOSEK', verbose=False)
 
     # Calculate the dose using the sparse matrix
-    dose_sparse_1d = plan_sparse.inf_matrix.A @ (sol_sparse['optimal_intensity'] * plan_sparse.get_num_of_fractions())
+    dose_sparse_1d = plan_sparse.inf_matrix.compute_dose(sol_sparse['optimal_intensity'], fractions=plan_sparse.get_num_of_fractions())
     """
     2) Loading the full and dense influence matrix for improved dose calculation accuracy
     
@@ -70,7 +71,7 @@ def inf_matrix_sparsification():
     inf_matrix_full = pp.InfluenceMatrix(ct=ct, structs=structs, beams=beams_full, is_full=True)
     plan_full = pp.Plan(ct=ct, structs=structs, beams=beams, inf_matrix=inf_matrix_full, clinical_criteria=clinical_criteria)
     # use the full influence matrix to calculate the dose for the plan obtained by sparse matrix
-    dose_full_1d = plan_full.inf_matrix.A @ (sol_sparse['optimal_intensity'] * plan_full.get_num_of_fractions())
+    dose_full_1d = plan_full.inf_matrix.compute_dose(sol_sparse['optimal_intensity'], fractions=plan_full.get_num_of_fractions())
 
     # Visualize the DVH discrepancy
     struct_names = ['PTV', 'ESOPHAGUS', 'HEART', 'CORD']
@@ -111,6 +112,17 @@ For demonstration purposes, we will manually generate the sparse matrix from the
     # Check if both influence matrices agree
     assert test.all()
 
+    """
+    4) Sparsifying the full influence matrix using InfluenceMatrix.sparsify
+
+sparsify() processes the full matrix beamlet by beamlet (streaming it from the .h5 files when the influence matrix is 
+sparse) and supports absolute, per-beamlet relative thresholds or a budget on the number of non-zeros. 
+It reports the dose error for a reference fluence and a bound on the dose error for any fluence.
+
+    """
+    inf_matrix_rel = plan_sparse.inf_matrix.sparsify(data=data, rel_tol=0.02, ref_fluence=sol_sparse['optimal_intensity'])
+    print(inf_matrix_rel.sparsify_report)
+
 
 if __name__ == "__main__":
     inf_matrix_sparsification()
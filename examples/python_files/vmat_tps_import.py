@@ -128,7 +128,7 @@ ecl_dose_1d = inf_matrix.dose_3d_to_1d(dose_3d=ecl_dose_3d)
 beams_full = pp.Beams(data, beam_ids=beam_ids, load_inf_matrix_full=True)
 # load influence matrix based upon beams and structure set
 inf_matrix_full = pp.InfluenceMatrix(ct=ct, structs=structs, beams=beams_full, is_full=True)
-dose_full_1d = inf_matrix_full.A @ (sol['optimal_intensity'] * my_plan.get_num_of_fractions())  # calculate dose using full matrix
+dose_full_1d = inf_matrix_full.compute_dose(sol['optimal_intensity'], fractions=my_plan.get_num_of_fractions())  # calculate dose using full matrix
 
 # Visualize the DVH discrepancy between eclipse dose and dose using full matrix in portpy
 struct_names = ['PTV', 'ESOPHAGUS', 'HEART', 'CORD', 'LUNGS_NOT_GTV']
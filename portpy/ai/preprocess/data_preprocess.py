@@ -273,7 +273,7 @@ def data_preprocess(in_dir, out_dir):
                 structs = pp.Structures(data)
                 beams = pp.Beams(data)
                 inf_matrix = pp.InfluenceMatrix(ct=ct, structs=structs, beams=beams)
-                beams_1d = inf_matrix.A * np.ones((inf_matrix.A.shape[1]))
+                beams_1d = inf_matrix.compute_dose(np.ones((inf_matrix.A.shape[1])))
                 beams_3d = inf_matrix.dose_1d_to_3d(dose_1d=beams_1d)
                 beams_3d = beams_3d.astype('float16')
 
@@ -3,6 +3,7 @@ from .structures import Structures
 from .beam import Beams
 from .ct import CT
 from .influence_matrix import InfluenceMatrix
+from .influence_matrix_pyramid import InfluenceMatrixPyramid
 from .data_explorer import DataExplorer
 from .optimization import Optimization
 from .visualization import Visualization
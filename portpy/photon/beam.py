@@ -1,6 +1,7 @@
 import numpy as np
 from typing import List, Union
 from .data_explorer import DataExplorer
+from .utils.beam_map import create_beamlet_idx_2d_finest_grid, renumber_beamlets, remove_repeated_rows_cols
 
 
 class Beams:
@@ -27,16 +28,29 @@ class Beams:
 
     """
 
-    def __init__(self, data: DataExplorer, beam_ids:  List[Union[int, str]] = None, load_inf_matrix_full: bool = False):
+    def __init__(self, data: DataExplorer, beam_ids:  List[Union[int, str]] = None, load_inf_matrix_full: bool = False,
+                 structures: List[str] = None, fields: List[str] = None):
         """
 
         :param beams_dict: Beams dictionary containing information about beams
+        :param structures: if not None, the BEV data (e.g. BEV_structure_contour_points) are loaded only for these
+            structures. e.g. ['PTV']. Default to None (all structures)
+        :param fields: if not None, only these numeric fields are loaded for the beams.
+            e.g. ['influenceMatrixSparse', 'BEV_structure_contour_points']. beamlets are always loaded.
+            Default to None (all fields)
         """
 
-        metadata = data.load_metadata()
+        metadata = data.load_metadata(beam_ids=beam_ids)
         metadata = self.get_plan_beams(beam_ids=beam_ids, meta_data=metadata)
-        beams_dict = data.load_data(meta_data=metadata['beams'], load_inf_matrix_full=load_inf_matrix_full)
+        if fields is not None and 'beamlets' not in fields:
+            fields = list(fields) + ['beamlets']
+        # size and modification time of the data files and data type of sparse matrix identify the data of the beams
+        self.source_info = {'files': data.get_files_info(meta_data=metadata['beams']),
+                            'sparse_dtype': None if data.sparse_dtype is None else np.dtype(data.sparse_dtype).str}
+        beams_dict = data.load_data(meta_data=metadata['beams'], load_inf_matrix_full=load_inf_matrix_full,
+                                    fields=fields, structures=structures)
         self.beams_dict = beams_dict
+        self.patient_id = data.patient_id
         self.preprocess_beams()
 
     def get_beamlet_idx_2d_finest_grid(self, beam_id: Union[int, str]) -> np.ndarray:
@@ -115,15 +129,7 @@ class Beams:
 
     @staticmethod
     def sort_beamlets(b_map):
-        c = b_map[b_map >= 0]
-        c = np.unique(c)
-        ind = np.arange(0, len(c))
-        c_sort = np.sort(c)
-        matrix_ind = [np.where(b_map == c_i) for c_i in c_sort]
-        map_copy = b_map.copy()
-        for i in range(len(ind)):
-            map_copy[matrix_ind[i]] = ind[i]
-        return map_copy
+        return renumber_beamlets(b_map)
 
     def make_beamlets_continous(self):
 
@@ -153,16 +159,7 @@ class Beams:
 
     @staticmethod
     def _create_2d_orig_grid(beam_map):
-        rowsNoRepeat = [0]
-        for i in range(1, np.size(beam_map, 0)):
-            if (beam_map[i, :] != beam_map[rowsNoRepeat[-1], :]).any():
-                rowsNoRepeat.append(i)
-        colsNoRepeat = [0]
-        for j in range(1, np.size(beam_map, 1)):
-            if (beam_map[:, j] != beam_map[:, colsNoRepeat[-1]]).any():
-                colsNoRepeat.append(j)
-        beam_map = beam_map[np.ix_(np.asarray(rowsNoRepeat), np.asarray(colsNoRepeat))]
-        return beam_map
+        return remove_repeated_rows_cols(beam_map)
 
     def get_beamlet_idx_2d_grid(self, beam_id: Union[Union[int, str], List[Union[int, str]]] = None, ind: int = None,
                                 finest_grid: bool = False) -> Union[np.ndarray, List[np.ndarray]]:
@@ -254,27 +251,7 @@ class Beams:
         """
         ind = self.beams_dict['ID'].index(beam_id)
         beamlets = self.beams_dict['beamlets'][ind]
-        x_positions = beamlets['position_x_mm'][0] - beamlets['width_mm'][0]/2  # x position is center of beamlet. Get left corner
-        y_positions = beamlets['position_y_mm'][0] + beamlets['height_mm'][0]/2  # y position is center of beamlet. Get top corner
-        right_ind = np.argmax(x_positions)
-        bottom_ind = np.argmin(y_positions)
-        w_all = np.column_stack((x_positions, y_positions))  # top left corners of all beamlets
-        x_coord = np.arange(np.min(x_positions), np.max(x_positions) + beamlets['width_mm'][0][right_ind].item(), 2.5)
-        y_coord = np.arange(np.max(y_positions), np.min(y_positions) - beamlets['height_mm'][0][bottom_ind].item(), -2.5)
-
-        # create mesh grid in 2.5 mm resolution
-        XX, YY = np.meshgrid(x_coord, y_coord)
-        beamlet_idx_2d_finest_grid = np.ones_like(XX, dtype=int)
-        beamlet_idx_2d_finest_grid = beamlet_idx_2d_finest_grid * int(-1)  # make all elements to -1
-
-        for row in range(XX.shape[0]):
-            for col in range(XX.shape[1]):
-                ind = np.where((w_all[:, 0] == XX[row, col]) & (w_all[:, 1] == YY[row, col]))  # find the position in matrix where we find the beamlet
-                if np.size(ind) > 0:
-                    ind = ind[0][0]
-                    num_width = int(beamlets['width_mm'][0][ind].item() /2.5)
-                    num_height = int(beamlets['height_mm'][0][ind].item() / 2.5)
-                    beamlet_idx_2d_finest_grid[row:row+num_height, col:col+num_width] = ind
+        beamlet_idx_2d_finest_grid = create_beamlet_idx_2d_finest_grid(beamlets, finest_res_mm=2.5)
         return beamlet_idx_2d_finest_grid
 
     @staticmethod
@@ -8,6 +8,10 @@ from pathlib import Path
 import pandas as pd
 from tabulate import tabulate
 import webbrowser
+import re
+from concurrent.futures import ThreadPoolExecutor
+from .utils.lazy_h5_list import H5Ref, H5ResidentCache, LazyH5List
+from .utils.h5_csr import read_csr_from_triplets, read_csr_from_h5, write_csr_to_h5
 
 
 class DataExplorer:
@@ -18,6 +22,16 @@ class DataExplorer:
 
         :param data_dir: local directory containing data
         :param patient_id: patient id of the patient
+        :param lazy_load: if True, the numeric data in .h5 files are read on first access instead of at load time.
+            Contiguous and uncompressed datasets are memory-mapped. Default to False
+        :param max_resident_mb: maximum size in MB of the lazily loaded data kept in memory. Least recently used data
+            are evicted and read again from disk on the next access. If None, loaded data are never evicted
+        :param io_workers: number of threads used to read and decode the per-beam .h5 files concurrently.
+            Default to 1 (sequential)
+        :param sparse_dtype: data type of the sparse influence matrix values (e.g. 'float32'). If None, data type
+            saved in the .h5 file is used
+        :param persist_csr: if True, the sparse influence matrix is saved in csr layout next to the beam data
+            (e.g. Beam_0_Data_csr.h5) after it is created. Subsequent loads read the csr arrays directly
 
     - **Methods** ::
         :display_patient_metadata()
@@ -27,12 +41,19 @@ class DataExplorer:
 
 
     """
-    def __init__(self, data_dir: str = None, patient_id: str = None):
+    def __init__(self, data_dir: str = None, patient_id: str = None, lazy_load: bool = False,
+                 max_resident_mb: float = None, io_workers: int = 1, sparse_dtype=None, persist_csr: bool = False):
         if data_dir is None:
             data_dir = os.path.join('..', 'data')
         self.data_dir = data_dir
         if patient_id is not None:
             self.patient_id = patient_id
+        self.lazy_load = lazy_load
+        max_bytes = None if max_resident_mb is None else max_resident_mb * 1024 ** 2
+        self._h5_cache = H5ResidentCache(max_bytes=max_bytes)
+        self.io_workers = io_workers
+        self.sparse_dtype = sparse_dtype
+        self.persist_csr = persist_csr
 
     def display_patient_metadata(self, in_browser: bool = False, return_beams_df: bool = False,
                                  return_structs_df: bool = False):
@@ -206,7 +227,7 @@ class DataExplorer:
             else:
                 print(tabulate(df, headers='keys', tablefmt='psql'))  # print in console using tabulate
 
-    def load_metadata(self, pat_dir: str = None) -> dict:
+    def load_metadata(self, pat_dir: str = None, beam_ids: list = None) -> dict:
         """Loads metadata of a patient located in path and returns the metadata as a dictionary
 
         The data are loaded from the following .Json files:
@@ -224,6 +245,7 @@ class DataExplorer:
             including beam information (e.g., gantry angle, collimator angle)
 
         :param pat_dir: full path of patient folder
+        :param beam_ids: if not None, only the metadata of these beams are loaded. Default to None (all beams)
         :return: a dictionary including all metadata
         """
         if pat_dir is None:
@@ -266,6 +288,15 @@ class DataExplorer:
         beamsJson = [pos_json for pos_json in os.listdir(beamFolder) if pos_json.endswith('.json')]
 
         beamsJson = natsorted(beamsJson)
+        if beam_ids is not None:
+            # skip the beams which are not requested based upon beam id in file name e.g. Beam_0_MetaData.json
+            req_ids = [str(beam_id) for beam_id in beam_ids]
+            req_json = []
+            for file in beamsJson:
+                match = re.fullmatch(r'Beam_(.+)_MetaData\.json', file)
+                if match is None or match.group(1) in req_ids:
+                    req_json.append(file)
+            beamsJson = req_json
         meta_data['beams'] = dict()
         # the information for each beam is stored in an individual .json file, so we loop through them
         for i in range(len(beamsJson)):
@@ -352,7 +383,8 @@ class DataExplorer:
         f.close()
         return json_data
 
-    def load_data(self, meta_data: dict, load_inf_matrix_full: bool = False) -> dict:
+    def load_data(self, meta_data: dict, load_inf_matrix_full: bool = False, fields: list = None,
+                  structures: list = None) -> dict:
         """
         Takes meta_data and the location of the data as inputs and returns the full data.
         The meta_data only includes light-weight data from the .json files (e.g., beam IDs, angles, struct_name names,..).
@@ -363,8 +395,18 @@ class DataExplorer:
         :param meta_data: meta_data containing light weight data from json file
         :param pat_dir: patient folder directory containing all the data
         e.g. if options['loadInfluenceMatrixFull']=True, it will load full influence matrix
+        :param fields: if not None, only these numeric fields are loaded from .h5 files
+            e.g. ['beamlets', 'influenceMatrixSparse']. Default to None (all fields)
+        :param structures: if not None, only the data of these structures are loaded for the fields grouped by
+            structure e.g. BEV_structure_contour_points. Default to None (all structures)
         :return: a dict of data
         """
+        if fields is not None:
+            for key in list(meta_data.keys()):
+                if key.endswith('_File') and key[0:-5] not in fields:
+                    del meta_data[key]
+                elif key in ['beamlets', 'spots'] and key not in fields:
+                    del meta_data[key]
         if not load_inf_matrix_full:
             if 'influenceMatrixFull_File' in meta_data:
                 meta_data['influenceMatrixFull_File'] = [None] * len(
@@ -373,28 +415,61 @@ class DataExplorer:
             if 'influenceMatrixSparse_File' in meta_data:
                 meta_data['influenceMatrixSparse_File'] = [None] * len(
                     meta_data['influenceMatrixSparse_File'])
-        meta_data = self.load_file(meta_data=meta_data)  # recursive function to load data from .h5 files
+        meta_data = self.load_file(meta_data=meta_data, structures=structures)  # recursive function to load data from .h5 files
         return meta_data
 
-    def load_file(self, meta_data: dict):
+    def get_files_info(self, meta_data: dict) -> list:
+        """
+        Get the size and modification time of the .h5 files in meta_data. They are used to find if the data is modified
+        e.g. in the key of influence matrix cache
+
+        :param meta_data: meta_data containing light weight data from json file
+        :return: sorted list of [file name relative to data_dir, size, modification time]
+        """
+        filenames = set()
+        items = [(None, meta_data)]
+        while items:
+            key, item = items.pop()
+            if isinstance(item, dict):
+                items.extend(item.items())
+            elif isinstance(item, list):
+                items.extend((key, val) for val in item)
+            elif isinstance(item, str) and key is not None and key.endswith('_File'):
+                data_folder = os.path.join(self.data_dir, self.patient_id)
+                if item.startswith('Beam_'):
+                    data_folder = os.path.join(data_folder, 'Beams')
+                filenames.add(os.path.join(data_folder, item.split('.h5')[0] + '.h5'))
+        files_info = []
+        for filename in sorted(filenames):
+            if os.path.exists(filename):
+                stat = os.stat(filename)
+                files_info.append([os.path.relpath(filename, self.data_dir), stat.st_size, stat.st_mtime])
+        return files_info
+
+    def load_file(self, meta_data: dict, structures: list = None):
         """
         This recursive function loads the data from .h5 files and merge them with the meta_data and returns a dictionary
         including all the data (meta_data+actual numeric data)
         :param meta_data: meta_data containing leight weight data from json file
         :param pat_dir: patient folder directory
+        :param structures: if not None, only the data of these structures are loaded for the fields grouped by structure
         :return:
         """
+        if structures is not None:
+            structures = tuple(structures)
         for key in meta_data.copy():
             item = meta_data[key]
             if type(item) is dict:
-                meta_data[key] = self.load_file(item)
+                meta_data[key] = self.load_file(item, structures=structures)
             elif key == 'beamlets' or key == 'spots':  # added this part to check if there are beamlets since beamlets are list of dictionary
                 if type(item[0]) is dict:
                     for ls in range(len(item)):
-                        self.load_file(item[ls])
+                        self.load_file(item[ls], structures=structures)
                         # meta_data[key] = ls_data
             elif key.endswith('_File'):
                 success = 1
+                field = key[0:-5]
+                refs = []
                 for i in range(np.size(meta_data[key])):
                     dataFolder = os.path.join(self.data_dir, self.patient_id)
                     if meta_data[key][i] is not None:
@@ -409,42 +484,114 @@ class DataExplorer:
                         filename = os.path.join(dataFolder, file_tag[0] + '.h5')
                         with h5py.File(filename, "r") as f:
                             if file_tag[1] in f:
-                                if key[0:-5] == 'optimizationVoxIndices':
-                                    vox = f[file_tag[1]][:].ravel()
-                                    meta_data.setdefault(key[0:-5], []).append(vox.astype(int))
-                                elif key[0:-5] == 'BEV_2d_structure_mask':
-                                    orgs = f[file_tag[1]].keys()
-                                    organ_mask_dict = dict()
-                                    for j in orgs:
-                                        organ_mask_dict[j] = f[file_tag[1]][j][:]
-                                    #                                     organ_mask_dict['Mask'].append(f[file_tag[1]][j][:].T)
-                                    meta_data.setdefault(key[0:-5], []).append(organ_mask_dict)
-                                elif key[0:-5] == 'BEV_structure_contour_points':
-                                    orgs = f[file_tag[1]].keys()
-                                    organ_mask_dict = dict()
-                                    for j in orgs:
-                                        segments = f[file_tag[1]][j].keys()
-                                        for seg in segments:
-                                            organ_mask_dict.setdefault(j, []).append(f[file_tag[1]][j][seg][:])
-                                            # organ_mask_dict[j] = f[file_tag[1]][j][seg][:].T
-                                    #                                     organ_mask_dict['Mask'].append(f[file_tag[1]][j][:].T)
-                                    meta_data.setdefault(key[0:-5], []).append(organ_mask_dict)
-                                #                                 meta_data.setdefault(key[0:-5], []).append(f[file_tag[1]][j][:].T)
-                                else:
-                                    meta_data.setdefault(key[0:-5], []).append(f[file_tag[1]][:])
-                                if key[0:-5] == 'influenceMatrixSparse':
-                                    infMatrixSparseForBeam = meta_data[key[0:-5]][i]
-                                    meta_data[key[0:-5]][i] = csr_matrix(
-                                        (infMatrixSparseForBeam[:, 2], (infMatrixSparseForBeam[:, 0].astype(int),
-                                                                        infMatrixSparseForBeam[:, 1].astype(int))))
+                                refs.append(H5Ref(filename=filename, dataset_key=file_tag[1], field=field,
+                                                  structures=structures))
                             else:
                                 print('Problem reading data: {}'.format(meta_data[key][i]))
                                 success = 0
+                if refs:
+                    if self.lazy_load:
+                        meta_data[field] = LazyH5List(refs, loader=self._read_h5_ref, cache=self._h5_cache)
+                    else:
+                        meta_data.setdefault(field, []).extend(self._read_h5_refs(refs))
                 if success:
                     del meta_data[key]
 
         return meta_data
 
+    def get_beams_h5_refs(self, field: str, beam_ids: list = None) -> list:
+        """
+        Get references to the datasets of the beams in .h5 files without loading them.
+        It can be used to stream large datasets e.g. full influence matrix
+
+        :param field: name of the field e.g. 'influenceMatrixFull'
+        :param beam_ids: beam ids. Default to None (all beams)
+        :return: list of H5Ref for the beams in the order of beam_ids
+        """
+        beams = self.load_metadata(beam_ids=beam_ids)['beams']
+        if field + '_File' not in beams:
+            raise ValueError('{} is not available for the beams'.format(field))
+        if beam_ids is None:
+            beam_ids = beams['ID']
+        refs = []
+        for beam_id in beam_ids:
+            file_tag = beams[field + '_File'][beams['ID'].index(beam_id)].split('.h5')
+            filename = os.path.join(self.data_dir, self.patient_id, 'Beams', file_tag[0] + '.h5')
+            refs.append(H5Ref(filename=filename, dataset_key=file_tag[1], field=field))
+        return refs
+
+    def _read_h5_refs(self, refs: list) -> list:
+        """
+        Read the data for the list of references. If io_workers > 1, the references (e.g. influence matrix of each beam)
+        are read and decoded concurrently using a thread pool. The order of the references is preserved
+
+        :param refs: list of references to datasets in .h5 files
+        :return: list of data
+        """
+        num_workers = min(self.io_workers, len(refs))
+        if num_workers <= 1:
+            return [self._read_h5_ref(ref) for ref in refs]
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            return list(executor.map(self._read_h5_ref, refs))
+
+    def _read_h5_ref(self, ref: H5Ref):
+        """
+        Read the data for the reference from .h5 file. In lazy loading mode, contiguous and uncompressed datasets
+        are memory-mapped instead of being read into memory
+
+        :param ref: reference to the dataset in .h5 file
+        :return: data for the reference
+        """
+        if ref.field == 'influenceMatrixSparse':
+            return self._read_inf_matrix_sparse(ref)
+        with h5py.File(ref.filename, "r") as f:
+            item = f[ref.dataset_key]
+            if ref.field == 'optimizationVoxIndices':
+                vox = item[:].ravel()
+                return vox.astype(int)
+            elif ref.field == 'BEV_2d_structure_mask':
+                organ_mask_dict = dict()
+                for j in item.keys():
+                    if ref.structures is not None and j not in ref.structures:
+                        continue
+                    organ_mask_dict[j] = item[j][:]
+                return organ_mask_dict
+            elif ref.field == 'BEV_structure_contour_points':
+                organ_mask_dict = dict()
+                for j in item.keys():
+                    if ref.structures is not None and j not in ref.structures:
+                        continue
+                    for seg in item[j].keys():
+                        organ_mask_dict.setdefault(j, []).append(item[j][seg][:])
+                return organ_mask_dict
+            if self.lazy_load:
+                offset = item.id.get_offset()
+                if item.chunks is None and item.compression is None and offset is not None and item.size > 0:
+                    # copy-on-write memory map so that in-place changes are not written back to the patient data
+                    return np.memmap(ref.filename, dtype=item.dtype, mode='c', offset=offset, shape=item.shape)
+            return item[:]
+
+    def _read_inf_matrix_sparse(self, ref: H5Ref) -> csr_matrix:
+        """
+        Read sparse influence matrix in csr format. The csr layout saved next to the beam data is used if it exists and
+        is up-to-date. Otherwise, the matrix is created from the (row, col, value) triplets in .h5 file
+
+        :param ref: reference to the triplets dataset in .h5 file
+        :return: csr matrix
+        """
+        csr_filename = ref.filename[:-len('.h5')] + '_csr.h5'
+        A = read_csr_from_h5(csr_filename, ref.dataset_key, source_file=ref.filename, dtype=self.sparse_dtype)
+        if A is not None:
+            return A
+        with h5py.File(ref.filename, "r") as f:
+            A = read_csr_from_triplets(f[ref.dataset_key], dtype=self.sparse_dtype)
+        if self.persist_csr:
+            try:
+                write_csr_to_h5(csr_filename, ref.dataset_key, A, source_file=ref.filename)
+            except OSError as e:
+                print('Warning: unable to save csr matrix to {}: {}'.format(csr_filename, e))
+        return A
+
     @staticmethod
     def is_notebook() -> bool:
         try:
@@ -11,6 +11,7 @@ except ImportError:
     from typing_extensions import Literal
 
 from .plan import Plan
+from .influence_matrix import InfluenceMatrix
 from .clinical_criteria import ClinicalCriteria
 from tabulate import tabulate
 
@@ -132,8 +133,7 @@ class Evaluation:
         if isinstance(sol, dict):
             sol = [sol]
         if dose_1d is None:
-            for p, s in enumerate(sol):
-                dose_1d_list.append(s['inf_matrix'].A @ (s['optimal_intensity'] * my_plan.get_num_of_fractions()))
+            dose_1d_list = InfluenceMatrix.compute_dose_for_sols(sol, fractions=my_plan.get_num_of_fractions())
         else:
             if isinstance(dose_1d, np.ndarray):
                 dose_1d_list = [dose_1d]
@@ -443,7 +443,7 @@ class Evaluation:
         percentile = 0.95  # reference isodose
         pres = my_plan.get_prescription()
         if dose_3d is None:
-            dose_1d = sol['inf_matrix'].A @ (sol['optimal_intensity'] * my_plan.get_num_of_fractions())
+            dose_1d = sol['inf_matrix'].compute_dose(sol['optimal_intensity'], fractions=my_plan.get_num_of_fractions())
             dose_3d = sol['inf_matrix'].dose_1d_to_3d(dose_1d=dose_1d)
         pres_iso_dose_mask = (dose_3d >= pres * percentile).astype(int)
         V_iso_pres = np.count_nonzero(pres_iso_dose_mask)
@@ -468,7 +468,7 @@ class Evaluation:
 
                 """
         if dose_3d is None:
-            dose_1d = sol['inf_matrix'].A @ (sol['optimal_intensity'] * my_plan.get_num_of_fractions())
+            dose_1d = sol['inf_matrix'].compute_dose(sol['optimal_intensity'], fractions=my_plan.get_num_of_fractions())
             dose_3d = sol['inf_matrix'].dose_1d_to_3d(dose_1d=dose_1d)
         ptv = my_plan.structures.get_structure_mask_3d(target_structure)
         ptv_dose = dose_3d[np.where(ptv == 1)]
@@ -490,7 +490,7 @@ class Evaluation:
         """
 
         if dose_per_fraction_1d is None:
-            dose_per_fraction_1d = sol['inf_matrix'].A @ (sol['optimal_intensity'])
+            dose_per_fraction_1d = sol['inf_matrix'].compute_dose(sol['optimal_intensity'])
         bed_d = np.zeros_like(dose_per_fraction_1d)
         for i in range(int(my_plan.get_num_of_fractions())):
             bed_d = bed_d + (dose_per_fraction_1d + (dose_per_fraction_1d**2/(alpha/beta)))
@@ -1,14 +1,27 @@
 import numpy as np
-from shapely.geometry import LinearRing, Polygon, Point
+import h5py
+import hashlib
+from collections import OrderedDict
+from shapely.geometry import LinearRing, Polygon
+try:
+    from shapely import contains_xy
+except ImportError:  # shapely < 2.0
+    from shapely.vectorized import contains as contains_xy
 from scipy import sparse
-from copy import deepcopy
+from copy import copy
 from scipy.sparse import csr_matrix
-import itertools
 from patchify import patchify
 from typing import List, Union
 from .ct import CT
 from .beam import Beams
 from .structures import Structures
+from .data_explorer import DataExplorer
+from .utils.inf_matrix_cache import InfluenceMatrixCache
+from .utils.shared_copy import shared_copy
+from .utils.parallel_spmv import ParallelSpMV
+from .utils.low_rank import LowRankMatrix, randomized_svd, frobenius_norm
+from .utils.beam_map import create_beamlet_idx_2d_finest_grid, create_beamlet_idx_2d_orig_grid, renumber_beamlets, \
+    remove_repeated_rows_cols, group_beamlets, create_smoothness_matrix
 
 
 class InfluenceMatrix:
@@ -24,23 +37,42 @@ class InfluenceMatrix:
         :param beamlets_dict: A dictionary containing the information about beamlets used in the plan.
         :param opt_beamlets_PTV_margin_mm: A float value representing the margin_mm around the PTV that was used in creating beamlets
         :param A: influence matrix that is generated by the get_influence_matrix() method.
+        :param A_op: linear operator of A for multithreaded matrix-vector products
         :param opt_voxels_dict: A dictionary containing the information about optimization voxels
 
     - **Methods** ::
+        :compute_dose(X, fractions)
+            Compute dose for one or more intensity vectors
+        :sparsify(data, abs_tol, rel_tol, nnz_budget)
+            Create sparse influence matrix from full influence matrix
+        :compress(rank, tol, per_beam)
+            Create low-rank representation of influence matrix
+        :get_smoothness_matrix()
+            Get cached sparse smoothness matrices of the beamlets
         :dose_1d_to_3d(sol)
             Convert dose_1d from 1d to 3d and return dose_1d in 3d
         :dose_3d_to_1d(dose_3d)
             Convert dose_1d from 3d to 1d voxels and return dose_1d in 1d
+        :dose_1d_to_3d_batch(doses_1d)
+            Convert stack of doses from 1d to 3d voxels
+        :dose_3d_to_1d_batch(doses_3d)
+            Convert stack of doses from 3d to 1d voxels
         :fluence_2d_to_1d(fluence_2d)
             Create vector of intensities from 2d fluence maps
         :fluence_1d_to_2d(fluence_1d)
             From vector of intensities create 2d fluence maps
+        :fluence_1d_to_2d_batch(fluences_1d)
+            Create 2d fluence maps from stack of intensity vectors
+        :fluence_2d_to_1d_batch(fluences_2d)
+            Create stack of intensity vectors from 2d fluence maps
 
     """
 
     def __init__(self, structs: Structures, beams: Beams,
                  ct: CT = None, beamlet_width_mm: float = None, beamlet_height_mm: float = None, opt_vox_xyz_res_mm: List[float] = None,
-                 is_full: bool = False, target_structure: str = 'PTV', opt_beamlets_PTV_margin_mm: float = 3, is_bev: bool = False) -> None:
+                 is_full: bool = False, target_structure: str = 'PTV', opt_beamlets_PTV_margin_mm: float = 3, is_bev: bool = False,
+                 cache_dir: str = None, cache_max_size_gb: float = None, sparse_format: str = 'csr', dtype=None,
+                 dose_cache_size: int = 32, num_threads: int = None) -> None:
         """
         Create a influence matrix object for Influence Matrix class based upon beamlet resolution and opt_vox_xyz_res_mm
 
@@ -55,6 +87,16 @@ class InfluenceMatrix:
                 defaults to None. When None it will use the original optimization voxel resolution.
         :param is_full: Load full or sparse matrix. defaults to False. If True, will load full matrix
         :param is_bev: True, if the given beams are already in beam eye view and influence matrix should not beamlets according to ptv margin
+        :param cache_dir: directory of the on-disk cache of influence matrix. If the influence matrix with the same
+                parameters was created before, it is loaded from cache instead of being created again. defaults to None (no cache)
+        :param cache_max_size_gb: maximum size of the cache in GB. Least recently used matrices are removed from cache
+                when it exceeds this size. defaults to None (no limit)
+        :param sparse_format: layout of the sparse influence matrix. 'csr' (fast row slicing) or 'csc' (fast column slicing).
+                defaults to 'csr'
+        :param dtype: data type of the influence matrix e.g. np.float32. defaults to None (data type in the data)
+        :param dose_cache_size: maximum number of doses cached by compute_dose(). defaults to 32
+        :param num_threads: number of threads used by A_op for sparse matrix-vector products. defaults to None
+                (number of cpus). If 1, SciPy product is used
 
         """
         if beamlet_width_mm is None and beamlet_height_mm is None:
@@ -68,131 +110,480 @@ class InfluenceMatrix:
                 raise ValueError('beamlet_width_mm and beamlet_height_mm should be multiple of 2.5')
         self._beams = beams
         self._structs = structs
+        self._beamlet_agg_matrix = None
+        self._voxel_agg_matrix = None
+        self._sparse_format = sparse_format
+        self._dtype = dtype
+        self.dose_cache_size = dose_cache_size
+        self.num_threads = num_threads
         if ct is not None:
             self._ct = ct
 
         down_sample_xyz = None  # Temporary variable to check if we want to down sample or not
         if opt_vox_xyz_res_mm is not None:
-            down_sample_xyz = [round(i / j) for i, j in zip(opt_vox_xyz_res_mm, structs.get_ct_res_xyz_mm())]
+            down_sample_xyz = [round(i / j) for i, j in zip(opt_vox_xyz_res_mm, structs.opt_voxels_dict['ct_voxel_resolution_xyz_mm'])]
             if np.all(np.array(down_sample_xyz) == 1):  # if all are 1 then no down sample
                 down_sample_xyz = None
 
         self._down_sample_xyz = down_sample_xyz
         self.is_full = is_full
 
-        # create deepcopy of the object or else it will modify the structs object
+        # create copy of the dictionary sharing the arrays as read-only or else it will modify the structs object
         if hasattr(structs, 'opt_voxels_dict'):
-            self.opt_voxels_dict = deepcopy(structs.opt_voxels_dict)
+            self.opt_voxels_dict = shared_copy(structs.opt_voxels_dict)
             # del structs.opt_voxels_dict  # remove opt_voxels_dict from structures
         else:
-            self.opt_voxels_dict = deepcopy(self.opt_voxels_dict)
+            self.opt_voxels_dict = shared_copy(self.opt_voxels_dict)
 
-        # creating deepcopy so that it doesnt modify beams object
+        # creating copy sharing the arrays so that it doesnt modify beams object
         if 'beamlets' in beams.beams_dict:
-            self.beamlets_dict = deepcopy(beams.beams_dict['beamlets'])
+            self.beamlets_dict = shared_copy(beams.beams_dict['beamlets'])
         else:
-            self.beamlets_dict = deepcopy(self.beamlets_dict['beamlets'])
+            self.beamlets_dict = shared_copy(self.beamlets_dict['beamlets'])
 
         for i in range(len(beams.beams_dict['ID'])):
             self.beamlets_dict[i]['beam_id'] = beams.beams_dict['ID'][i]  # save beam_id in beamlet_dict
 
         self.opt_beamlets_PTV_margin_mm = opt_beamlets_PTV_margin_mm
+        self.target_structure = target_structure
+        self.is_bev = is_bev
         # self.opt_voxels_dict['ct_origin_xyz_mm'] = ct.ct_dict['origin_xyz_mm']  # store ct origin from plan
-        print('Creating BEV..')
-        self.preprocess_beams(structure=target_structure, is_bev=is_bev)
-        if self._down_sample_xyz is not None:
-            self.pre_process_voxels()  # create new optimization voxel indices based on down-sample resolution
-
-        if not self.is_full:
-            print('Loading sparse influence matrix...')
-            self.A = self.get_influence_matrix()  # create sparse influence matrix
-            self.sparse_tol = float(beams.beams_dict['influenceMatrixSparse_tol'][0])
+        cache, cache_key = None, None
+        if cache_dir is not None and getattr(beams, 'source_info', None) is not None:
+            cache = InfluenceMatrixCache(cache_dir=cache_dir, max_size_gb=cache_max_size_gb)
+            cache_key = self.get_cache_key(structs=structs, beams=beams, opt_vox_xyz_res_mm=opt_vox_xyz_res_mm,
+                                           target_structure=target_structure, is_bev=is_bev)
+            entry = cache.load(cache_key)
+            if entry is not None and 'beamlet_agg_matrix' not in entry:
+                entry = None  # entry saved without the aggregation matrices is created again
         else:
-            print('Loading full influence matrix..')
-            self.A = self.get_influence_matrix(self.is_full)  # create full matrix
+            entry = None
+        if entry is not None:
+            print('Loading influence matrix from cache..')
+            self.A = entry['A'].asformat(sparse_format) if sparse.issparse(entry['A']) else entry['A']
+            self.beamlets_dict = entry['beamlets_dict']
+            self.opt_voxels_dict = entry['opt_voxels_dict']
+            self._beamlet_agg_matrix = entry['beamlet_agg_matrix']
+            self._voxel_agg_matrix = entry['voxel_agg_matrix']
+            if not self.is_full:
+                self.sparse_tol = entry['sparse_tol']
+            # influence matrix of the beams is not needed since it is loaded from cache
+            beams.beams_dict.pop('influenceMatrixSparse', None)
+            beams.beams_dict.pop('influenceMatrixFull', None)
+        else:
+            # beamlets and voxels are down sampled from the influence matrix in original resolution
+            beamlet_width_mm, beamlet_height_mm = self.beamlet_width_mm, self.beamlet_height_mm
+            is_down_sample = beamlet_width_mm > beams.get_beamlet_width() or \
+                beamlet_height_mm > beams.get_beamlet_height() or self._down_sample_xyz is not None
+            if is_down_sample:
+                self.beamlet_width_mm = beams.get_beamlet_width()
+                self.beamlet_height_mm = beams.get_beamlet_height()
+                self._down_sample_xyz = None
+            print('Creating BEV..')
+            self.preprocess_beams(structure=target_structure, is_bev=is_bev)
+
+            if not self.is_full:
+                print('Loading sparse influence matrix...')
+                self.A = self.get_influence_matrix()  # create sparse influence matrix
+                self.sparse_tol = float(beams.beams_dict['influenceMatrixSparse_tol'][0])
+            else:
+                print('Loading full influence matrix..')
+                self.A = self.get_influence_matrix(self.is_full)  # create full matrix
+            if is_down_sample:
+                self.create_down_sample(beamlet_width_mm=beamlet_width_mm, beamlet_height_mm=beamlet_height_mm,
+                                        opt_vox_xyz_res_mm=opt_vox_xyz_res_mm, overwrite=True)
+            if cache is not None:
+                entry = {'A': self.A, 'beamlets_dict': self.beamlets_dict, 'opt_voxels_dict': self.opt_voxels_dict,
+                         'beamlet_agg_matrix': self._beamlet_agg_matrix, 'voxel_agg_matrix': self._voxel_agg_matrix}
+                if not self.is_full:
+                    entry['sparse_tol'] = self.sparse_tol
+                try:
+                    cache.save(cache_key, entry)
+                except (OSError, TypeError) as e:
+                    print('Warning: unable to save influence matrix to cache: {}'.format(e))
         self._vox_map = None
         self._vox_weights = None
+        self._reset_caches()
         print('Done')
 
-    def get_voxel_info(self, row_number):
-        row_dict = {}
-        if row_number <= self.A.shape[0]:
-            for i in range(len(self.opt_voxels_dict['name'])):
-                if row_number in list(self.opt_voxels_dict['voxel_idx'][i]):
-                    row_dict.setdefault('structures', []).append(self.opt_voxels_dict['name'][i])
-
-            patch = np.where(
-                self.opt_voxels_dict['ct_to_dose_voxel_map'][0] == row_number)  # get dose voxel index patch
-
-            # get center of patch. It should be equivalent dose voxel center
-            z_ind = (min(patch[0]) + max(patch[0])) / 2
-            y_ind = (min(patch[1]) + max(patch[1])) / 2
-            x_ind = (min(patch[2]) + max(patch[2])) / 2
-            ct_res = self.opt_voxels_dict['ct_voxel_resolution_xyz_mm']
-            ct_orig = self.opt_voxels_dict['ct_origin_xyz_mm']
-            xyz_mm = [ct_orig[0] + x_ind * ct_res[0], ct_orig[1] + y_ind * ct_res[1], ct_orig[2] + z_ind * ct_res[2]]
-            row_dict['position_xyz_mm'] = xyz_mm
-        else:
-            raise ValueError('invalid row number {}'.format(row_number))
-        return row_dict
+    def __getstate__(self) -> dict:
+        """
+        Get the state of influence matrix for pickling. The cached indexes, doses and operators are not pickled. They
+        are created again when they are needed
+        """
+        state = self.__dict__.copy()
+        for key in ['_voxel_index', '_beamlet_index', '_dose_index_map', '_fluence_index_map', '_dose_cache',
+                    '_dose_cache_A', '_A_op', '_smoothness_matrix']:
+            state[key] = None
+        return state
 
-    def get_beamlet_info(self, col_number: int) -> dict:
+    def __setstate__(self, state: dict) -> None:
+        """
+        Restore the pickled influence matrix. Attributes missing in the objects pickled by the older versions are set
+        to their defaults and the cached indexes are created again when they are needed
+        """
+        self.__dict__.update(state)
+        defaults = {'_beamlet_agg_matrix': None, '_voxel_agg_matrix': None, 'target_structure': 'PTV', 'is_bev': False,
+                    '_sparse_format': 'csr', '_dtype': None, 'dose_cache_size': 32, 'num_threads': None}
+        for key, val in defaults.items():
+            if key not in self.__dict__:
+                setattr(self, key, val)
+        self._reset_caches()
+
+    def get_cache_key(self, structs: Structures, beams: Beams, opt_vox_xyz_res_mm: List[float] = None,
+                      target_structure: str = 'PTV', is_bev: bool = False) -> str:
+        """
+        Get the key of influence matrix in on-disk cache. The key is the hash of patient id, size and modification time
+        of the data files and data type of the beams, beam ids, beamlet and voxel resolution, target structure,
+        PTV margin, type of matrix and the structure set
+
+        :return: hash key
+        """
+        params = {'patient_id': beams.patient_id,
+                  'source_info': beams.source_info,
+                  'beam_ids': beams.get_all_beam_ids(),
+                  'beamlet_width_mm': self.beamlet_width_mm,
+                  'beamlet_height_mm': self.beamlet_height_mm,
+                  'opt_vox_xyz_res_mm': opt_vox_xyz_res_mm,
+                  'target_structure': target_structure,
+                  'opt_beamlets_PTV_margin_mm': self.opt_beamlets_PTV_margin_mm,
+                  'is_full': self.is_full,
+                  'is_bev': is_bev,
+                  'dtype': None if self._dtype is None else np.dtype(self._dtype).str,
+                  'structure_names': structs.opt_voxels_dict['name']}
+        return InfluenceMatrixCache.get_key(params, arrays=structs.opt_voxels_dict['voxel_idx'])
+
+    def get_voxel_info(self, row_number: int = None, rows: np.ndarray = None) -> dict:
+        """
+        Get the structures and position of the optimization voxels (rows of influence matrix)
+
+        :param row_number: row number/voxel number in influence matrix
+        :param rows: array of row numbers. If given, information of all the rows is returned together
+        :return: dictionary containing information about the voxel. If rows is given, dictionary contains
+            structures (list of structure names for each row), structure_mask (rows x structures boolean array) and
+            position_xyz_mm (rows x 3 array) for the rows
+        """
+        if rows is None:
+            if row_number is None:
+                raise ValueError('row_number or rows should be given')
+            info = self.get_voxel_info(rows=[row_number])
+            row_dict = {}
+            if info['structures'][0]:
+                row_dict['structures'] = info['structures'][0]
+            row_dict['position_xyz_mm'] = list(info['position_xyz_mm'][0])
+            return row_dict
+        rows = np.atleast_1d(np.asarray(rows)).astype(int)
+        invalid = (rows < 0) | (rows >= self.A.shape[0])
+        if np.any(invalid):
+            raise ValueError('invalid row number {}'.format(rows[invalid][0]))
+        voxel_index = self._get_voxel_index()
+        names = voxel_index['structure_names']
+        structure_mask = np.unpackbits(voxel_index['structure_bitmask'][rows], axis=1, count=len(names)).astype(bool)
+        structures = [[names[j] for j in np.flatnonzero(mask)] for mask in structure_mask]
+        return {'structures': structures, 'structure_mask': structure_mask,
+                'position_xyz_mm': voxel_index['position_xyz_mm'][rows]}
+
+    def get_beamlet_info(self, col_number: int = None, cols: np.ndarray = None) -> dict:
         """
+        Get the beam and position of the beamlets (columns of influence matrix)
 
         :param col_number: col number/beamlet number in influence matrix
-        :return: dictionary containing information about the beamlet
+        :param cols: array of col numbers. If given, information of all the cols is returned together
+        :return: dictionary containing information about the beamlet. If cols is given, dictionary contains
+            beam_id, position_x_mm, position_y_mm, width_mm and height_mm arrays for the cols
         """
-        col_dict = {}
-        for ind in range(len(self.beamlets_dict)):
-            if col_number in range(self.beamlets_dict[ind]['start_beamlet_idx'],
-                                   self.beamlets_dict[ind]['end_beamlet_idx'] + 1):
-                if ind > 0:
-                    prev_beam_beamlet = self.beamlets_dict[ind - 1]['end_beamlet_idx'] + 1
-                else:
-                    prev_beam_beamlet = 0
-                col_dict['beam_id'] = self.beamlets_dict[ind]['beam_id']
-                col_dict['position_x_mm'] = self.beamlets_dict[ind]['position_x_mm'][0][col_number - prev_beam_beamlet]
-                col_dict['position_y_mm'] = self.beamlets_dict[ind]['position_y_mm'][0][col_number - prev_beam_beamlet]
-                col_dict['width_mm'] = self.beamlets_dict[ind]['width_mm'][0][col_number - prev_beam_beamlet]
-                col_dict['height_mm'] = self.beamlets_dict[ind]['height_mm'][0][col_number - prev_beam_beamlet]
+        beamlet_index = self._get_beamlet_index()
+        if cols is None:
+            if col_number is None:
+                raise ValueError('col_number or cols should be given')
+            if not 0 <= col_number < len(beamlet_index['beam_ind']):
+                return {}
+            info = self.get_beamlet_info(cols=[col_number])
+            return {key: val[0] for key, val in info.items()}
+        cols = np.atleast_1d(np.asarray(cols)).astype(int)
+        invalid = (cols < 0) | (cols >= len(beamlet_index['beam_ind']))
+        if np.any(invalid):
+            raise ValueError('invalid col number {}'.format(cols[invalid][0]))
+        beam_ids = [self.beamlets_dict[ind]['beam_id'] for ind in range(len(self.beamlets_dict))]
+        col_dict = {'beam_id': np.array(beam_ids)[beamlet_index['beam_ind'][cols]]}
+        for key in ['position_x_mm', 'position_y_mm', 'width_mm', 'height_mm']:
+            col_dict[key] = beamlet_index[key][cols]
         return col_dict
 
-    def dose_1d_to_3d(self, sol: dict = None, dose_1d: np.array = None) -> np.ndarray:
+    def _get_voxel_index(self) -> dict:
+        """
+        Create reverse index of the rows of influence matrix. It contains bitmask of the structures
+        (packed using np.packbits) and center of the dose voxel in mm for each row. It is created at the first call and
+        reused until _reset_caches() is called
+        """
+        if self._voxel_index is not None:
+            return self._voxel_index
+        num_rows = self.A.shape[0]
+        names = list(self.opt_voxels_dict['name'])
+        structure_mask = np.zeros((num_rows, len(names)), dtype=bool)
+        for i in range(len(names)):
+            vox = np.asarray(self.opt_voxels_dict['voxel_idx'][i]).astype(int)
+            structure_mask[vox[(vox >= 0) & (vox < num_rows)], i] = True
+
+        # center of the ct voxels patch of each dose voxel
+        dose_vox_map = self.opt_voxels_dict['ct_to_dose_voxel_map'][0]
+        flat_ind = np.flatnonzero(dose_vox_map >= 0)
+        row_ind = dose_vox_map.ravel()[flat_ind].astype(int)
+        in_range = row_ind < num_rows
+        flat_ind, row_ind = flat_ind[in_range], row_ind[in_range]
+        center_zyx = np.full((num_rows, 3), np.nan)
+        for axis, ind in enumerate(np.unravel_index(flat_ind, dose_vox_map.shape)):
+            min_ind = np.full(num_rows, np.iinfo(np.int64).max)
+            max_ind = np.full(num_rows, -1)
+            np.minimum.at(min_ind, row_ind, ind)
+            np.maximum.at(max_ind, row_ind, ind)
+            found = max_ind >= 0
+            center_zyx[found, axis] = (min_ind[found] + max_ind[found]) / 2
+        ct_res = np.asarray(self.opt_voxels_dict['ct_voxel_resolution_xyz_mm'], dtype=float)
+        ct_orig = np.asarray(self.opt_voxels_dict['ct_origin_xyz_mm'], dtype=float)
+        position_xyz_mm = ct_orig + center_zyx[:, ::-1] * ct_res
+
+        self._voxel_index = {'structure_names': names, 'structure_bitmask': np.packbits(structure_mask, axis=1),
+                             'position_xyz_mm': position_xyz_mm}
+        return self._voxel_index
+
+    def _get_beamlet_index(self) -> dict:
+        """
+        Create reverse index of the columns of influence matrix. It contains index of the beam in beamlets_dict and
+        position and size of the beamlet for each column. It is created at the first call and reused until
+        _reset_caches() is called
+        """
+        if self._beamlet_index is not None:
+            return self._beamlet_index
+        beamlet_index = {'beam_ind': [], 'position_x_mm': [], 'position_y_mm': [], 'width_mm': [], 'height_mm': []}
+        for ind in range(len(self.beamlets_dict)):
+            beam = self.beamlets_dict[ind]
+            num_beamlets = beam['end_beamlet_idx'] - beam['start_beamlet_idx'] + 1
+            beamlet_index['beam_ind'].append(np.full(num_beamlets, ind))
+            for key in ['position_x_mm', 'position_y_mm', 'width_mm', 'height_mm']:
+                beamlet_index[key].append(np.ravel(beam[key][0])[:num_beamlets])
+        self._beamlet_index = {key: np.concatenate(val) if val else np.zeros(0) for key, val in beamlet_index.items()}
+        return self._beamlet_index
+
+    def _reset_caches(self) -> None:
+        """
+        Remove the cached indexes. It should be called when influence matrix, beamlets or voxels are modified
+        """
+        self._voxel_index = None
+        self._beamlet_index = None
+        self._dose_index_map = None
+        self._fluence_index_map = None
+        self._dose_cache = None
+        self._dose_cache_A = None
+        self._A_op = None
+        self._smoothness_matrix = None
+
+    def compute_dose(self, X: Union[np.ndarray, List[np.ndarray]], fractions: float = 1,
+                     use_cache: bool = True) -> np.ndarray:
+        """
+        Compute dose for one or more intensity vectors. All the intensity vectors are multiplied with the influence
+        matrix in a single sparse-dense product. Dose of each intensity vector is cached (least recently used doses
+        are removed when the cache has more than dose_cache_size doses) so that repeated calls for the same solution
+        do not multiply with the influence matrix again. Cache is cleared when influence matrix is replaced.
+
+        :param X: intensity vector of size number of beamlets, matrix of shape (number of beamlets, number of
+            solutions) or list of intensity vectors
+        :param fractions: dose is computed as A @ (X * fractions). defaults to 1 (dose per fraction)
+        :param use_cache: if False, doses are computed without using and saving in the cache
+        :return: dose vector or matrix of shape (number of voxels, number of solutions) containing dose for each column
+            of X
+
+        :Example:
+        >>> dose_1d = inf_matrix.compute_dose(sol['optimal_intensity'], fractions=my_plan.get_num_of_fractions())
+        """
+        if isinstance(X, (list, tuple)):
+            X = np.column_stack(X)
+        X = np.asarray(X)
+        is_vector = X.ndim == 1
+        X = X.reshape(X.shape[0], -1)
+        if X.shape[0] != self.A.shape[1]:
+            raise ValueError('size of intensity vector {} does not match number of beamlets {}'.format(
+                X.shape[0], self.A.shape[1]))
+        num_sols = X.shape[1]
+        cache = self._get_dose_cache() if use_cache else None
+        keys = [self._get_dose_key(X[:, j], fractions) for j in range(num_sols)] if use_cache else None
+        missing = [j for j in range(num_sols) if cache is None or keys[j] not in cache]
+
+        dose = np.empty((self.A.shape[0], num_sols), dtype=np.result_type(self.A.dtype, X.dtype))
+        if len(missing) == 1:
+            dose[:, missing[0]] = self.A_op @ (X[:, missing[0]] * fractions)
+        elif len(missing) > 1:
+            dose[:, missing] = self.A_op @ (X[:, missing] * fractions)
+        for j in range(num_sols):
+            if cache is None:
+                continue
+            if keys[j] in cache:
+                dose[:, j] = cache[keys[j]]
+                cache.move_to_end(keys[j])
+            else:
+                cache[keys[j]] = dose[:, j].copy()
+        if cache is not None:
+            while len(cache) > max(self.dose_cache_size, 0):
+                cache.popitem(last=False)
+        return dose[:, 0] if is_vector else dose
+
+    @property
+    def A_op(self) -> ParallelSpMV:
+        """
+        Linear operator of influence matrix for multithreaded products A_op @ x and A_op.T @ y. It is created again
+        when A or num_threads is changed
+
+        :Example:
+        >>> inf_matrix.num_threads = 8
+        >>> dose_1d = inf_matrix.A_op @ x
+        """
+        A_op = self._A_op
+        num_threads = self.num_threads
+        if A_op is None or A_op.A is not self.A or A_op.num_threads != (num_threads or A_op.num_threads):
+            A_op = ParallelSpMV(self.A, num_threads=num_threads)
+            self._A_op = A_op
+        return A_op
+
+    @staticmethod
+    def compute_dose_for_sols(sols: List[dict], fractions: float = 1) -> List[np.ndarray]:
+        """
+        Compute dose for the list of solutions. Solutions with the same influence matrix are computed together
+        using compute_dose()
+
+        :param sols: list of solution dictionaries containing inf_matrix and optimal_intensity
+        :param fractions: dose is computed as A @ (optimal_intensity * fractions). defaults to 1
+        :return: list of doses in 1d for the solutions
+        """
+        groups = {}
+        for i, sol in enumerate(sols):
+            groups.setdefault(id(sol['inf_matrix']), []).append(i)
+        doses = [None] * len(sols)
+        for inds in groups.values():
+            inf_matrix = sols[inds[0]]['inf_matrix']
+            dose = inf_matrix.compute_dose([sols[i]['optimal_intensity'] for i in inds], fractions=fractions)
+            for j, i in enumerate(inds):
+                doses[i] = dose[:, j]
+        return doses
+
+    def _get_dose_cache(self) -> OrderedDict:
+        """
+        Get the cache of compute_dose(). It is cleared if the influence matrix is replaced
+        """
+        if self._dose_cache is None or self._dose_cache_A is not self.A:
+            self._dose_cache = OrderedDict()
+            self._dose_cache_A = self.A
+        return self._dose_cache
+
+    @staticmethod
+    def _get_dose_key(x: np.ndarray, fractions: float) -> str:
+        x = np.ascontiguousarray(x)
+        h = hashlib.sha256(str((x.dtype.str, x.shape, float(fractions))).encode())
+        h.update(x.tobytes())
+        return h.hexdigest()
+
+    def dose_1d_to_3d(self, sol: dict = None, dose_1d: np.array = None, crop: bool = False) -> np.ndarray:
         """
         Create 3d dose_1d from dose_1d in 1d voxels. 3d array have same resolution as CT
 
         :param sol: solution dictionary from optimization
         :param dose_1d: dose_1d in 1d. Optional
+        :param crop: if True, return dose only in the dose calculation box. See get_dose_calc_box()
         :return: dose_1d in 3d
 
 
         """
-        dose_vox_map = self.opt_voxels_dict['ct_to_dose_voxel_map'][0]
         # dose_1d = my_plan.opt_voxels_dict['dose_1d']
         if dose_1d is None:
             if 'dose_1d' not in sol:
-                dose_1d = sol['inf_matrix'].A * sol['optimal_intensity']  # multiply it with num fractions
+                dose_1d = sol['inf_matrix'].compute_dose(sol['optimal_intensity'])  # multiply it with num fractions
             else:
                 dose_1d = sol['dose_1d']
-        dose_3d = np.zeros_like(dose_vox_map, dtype='float32')
-        inds = np.unique(dose_vox_map[dose_vox_map >= 0])
-        a = np.where(np.isin(dose_vox_map, inds))
-        dose_3d[a] = dose_1d[dose_vox_map[a]]
-        return dose_3d
+        return self.dose_1d_to_3d_batch(doses_1d=np.asarray(dose_1d).reshape(1, -1), crop=crop)[0]
 
-    def dose_3d_to_1d(self, dose_3d: np.ndarray) -> np.array:
+    def dose_3d_to_1d(self, dose_3d: np.ndarray, crop: bool = False) -> np.array:
         """
         Get dose_1d in 1d voxels for the given influence matrix from 3d dose_1d
 
         :param dose_3d: 3d dose_1d
+        :param crop: if True, dose_3d is only in the dose calculation box. See get_dose_calc_box()
         :return: dose_1d in 1d voxel indices
         """
+        return self.dose_3d_to_1d_batch(doses_3d=np.asarray(dose_3d)[np.newaxis], crop=crop)[0]
+
+    def dose_1d_to_3d_batch(self, doses_1d: np.ndarray, crop: bool = False) -> np.ndarray:
+        """
+        Create 3d doses from the stack of doses in 1d voxels e.g. doses for robust scenarios or iterations
+
+        :param doses_1d: array of shape (number of doses, number of voxels)
+        :param crop: if True, return doses only in the dose calculation box. See get_dose_calc_box()
+        :return: array of shape (number of doses, z, y, x) containing 3d doses
+        """
+        index_map = self._get_dose_index_map()
+        doses_1d = np.asarray(doses_1d)
+        if crop:
+            shape, flat_ind = index_map['crop_shape'], index_map['crop_flat_ind']
+        else:
+            shape, flat_ind = index_map['shape'], index_map['flat_ind']
+        doses_3d = np.zeros((doses_1d.shape[0], int(np.prod(shape))), dtype='float32')
+        doses_3d[:, flat_ind] = doses_1d[:, index_map['vox_ind']]
+        return doses_3d.reshape((doses_1d.shape[0],) + tuple(shape))
+
+    def dose_3d_to_1d_batch(self, doses_3d: np.ndarray, crop: bool = False) -> np.ndarray:
+        """
+        Get doses in 1d voxels from the stack of 3d doses
+
+        :param doses_3d: array of shape (number of doses, z, y, x) containing 3d doses
+        :param crop: if True, doses_3d are only in the dose calculation box. See get_dose_calc_box()
+        :return: array of shape (number of doses, number of voxels)
+        """
+        index_map = self._get_dose_index_map()
+        doses_3d = np.asarray(doses_3d)
+        doses_flat = doses_3d.reshape(doses_3d.shape[0], -1)
+        gather_ind = index_map['crop_gather_flat_ind'] if crop else index_map['gather_flat_ind']
+        doses_1d = np.zeros((doses_3d.shape[0], self.A.shape[0]), dtype=np.float32)
+        doses_1d[:, index_map['gather_vox_ind']] = doses_flat[:, gather_ind]
+        return doses_1d
+
+    def get_dose_calc_box(self) -> tuple:
+        """
+        Get the dose calculation box i.e. bounding box of the ct voxels which are mapped to dose voxels
+
+        :return: tuple of slices in z, y and x direction which can be used to crop 3d arrays in CT resolution
+        """
+        return self._get_dose_index_map()['crop_slices']
+
+    def _get_dose_index_map(self) -> dict:
+        """
+        Create flat indices of the ct voxels mapped to dose voxels in full and cropped 3d arrays. It is created at the
+        first call and reused until _reset_caches() is called
+        """
+        if self._dose_index_map is not None:
+            return self._dose_index_map
         dose_vox_map = self.opt_voxels_dict['ct_to_dose_voxel_map'][0]
-        inds = np.unique(dose_vox_map[dose_vox_map >= 0])
-        dose_1d = np.zeros_like(np.arange(0, self.A.shape[0]), dtype=np.float32)
-        a = np.where(np.isin(dose_vox_map, inds))
-        dose_1d[dose_vox_map[a]] = dose_3d[a]
-        return dose_1d
+        flat_map = dose_vox_map.ravel()
+        flat_ind = np.flatnonzero(flat_map >= 0)
+        vox_ind = flat_map[flat_ind].astype(int)
+        # when several ct voxels are mapped to the same dose voxel, the last one in row-major order is used in 3d to 1d
+        gather_vox_ind, last = np.unique(vox_ind[::-1], return_index=True)
+        gather = flat_ind.size - 1 - last
+
+        # bounding box of the mapped voxels
+        zyx_ind = np.unravel_index(flat_ind, dose_vox_map.shape)
+        if flat_ind.size > 0:
+            start = [int(np.min(ind)) for ind in zyx_ind]
+            end = [int(np.max(ind)) + 1 for ind in zyx_ind]
+        else:
+            start, end = [0, 0, 0], [0, 0, 0]
+        crop_shape = tuple(e - s for s, e in zip(start, end))
+        crop_flat_ind = np.ravel_multi_index(tuple(ind - s for ind, s in zip(zyx_ind, start)), crop_shape) \
+            if flat_ind.size > 0 else flat_ind
+
+        self._dose_index_map = {'shape': dose_vox_map.shape, 'flat_ind': flat_ind, 'vox_ind': vox_ind,
+                                'gather_flat_ind': flat_ind[gather], 'gather_vox_ind': gather_vox_ind,
+                                'crop_slices': tuple(slice(s, e) for s, e in zip(start, end)),
+                                'crop_shape': crop_shape, 'crop_flat_ind': crop_flat_ind,
+                                'crop_gather_flat_ind': crop_flat_ind[gather]}
+        return self._dose_index_map
 
     def fluence_2d_to_1d(self, fluence_2d: List[np.ndarray]) -> np.array:
         """
@@ -201,18 +592,7 @@ class InfluenceMatrix:
         :param fluence_2d: 2d fluence as list of nd array with same length as number of beams_dict
         :return: fluence in 1d for beamlet indices
         """
-        fluence_1d = np.zeros((self.A.shape[1]))
-        for ind in range(len(self.beamlets_dict)):
-            maps = self.beamlets_dict[ind]['beamlet_idx_2d_finest_grid']
-            numRows = np.size(maps, 0)
-            numCols = np.size(maps, 1)
-            # wMaps = np.zeros((numRows, numCols))
-            for r in range(numRows):
-                for c in range(numCols):
-                    if maps[r, c] >= 0:
-                        curr = maps[r, c]
-                        fluence_1d[curr] = fluence_2d[ind][r, c]
-        return fluence_1d
+        return self.fluence_2d_to_1d_batch(fluences_2d=[np.asarray(f)[np.newaxis] for f in fluence_2d])[0]
 
     def fluence_1d_to_2d(self, fluence_1d: np.array = None, sol: dict = None) -> List[np.ndarray]:
         """
@@ -225,22 +605,57 @@ class InfluenceMatrix:
         """
         if fluence_1d is None:
             fluence_1d = sol['optimal_intensity']
+        fluences_2d = self.fluence_1d_to_2d_batch(fluences_1d=np.asarray(fluence_1d).reshape(1, -1))
+        return [f[0] for f in fluences_2d]
 
-        wMaps = []
-        for ind in range(len(self.beamlets_dict)):
-            maps = self.beamlets_dict[ind]['beamlet_idx_2d_finest_grid']
-            numRows = np.size(maps, 0)
-            numCols = np.size(maps, 1)
-            wMaps.append(np.zeros((numRows, numCols)))
-            # wMaps = np.zeros((numRows, numCols))
-            for r in range(numRows):
-                for c in range(numCols):
-                    if maps[r, c] >= 0:
-                        curr = maps[r, c]
-                        wMaps[ind][r, c] = fluence_1d[curr]
-                        # wMaps[r, c] = optimal_intensity[curr]
-
-        return wMaps
+    def fluence_1d_to_2d_batch(self, fluences_1d: np.ndarray) -> List[np.ndarray]:
+        """
+        Create 2d fluence maps of all the beams from the stack of intensity vectors
+
+        :param fluences_1d: array of shape (number of fluences, number of beamlets)
+        :return: list containing array of shape (number of fluences, rows, cols) for each beam
+        """
+        index_map = self._get_fluence_index_map()
+        fluences_1d = np.asarray(fluences_1d)
+        fluences_2d = np.zeros((fluences_1d.shape[0], index_map['offsets'][-1]),
+                               dtype=np.result_type(fluences_1d, float))
+        fluences_2d[:, index_map['flat_ind']] = fluences_1d[:, index_map['beamlet_ind']]
+        return [fluences_2d[:, start:end].reshape((fluences_1d.shape[0],) + shape) for start, end, shape in
+                zip(index_map['offsets'][:-1], index_map['offsets'][1:], index_map['shapes'])]
+
+    def fluence_2d_to_1d_batch(self, fluences_2d: List[np.ndarray]) -> np.ndarray:
+        """
+        Create stack of intensity vectors from 2d fluence maps of all the beams
+
+        :param fluences_2d: list containing array of shape (number of fluences, rows, cols) for each beam
+        :return: array of shape (number of fluences, number of beamlets)
+        """
+        index_map = self._get_fluence_index_map()
+        num_fluences = np.asarray(fluences_2d[0]).shape[0]
+        fluences_flat = np.concatenate([np.asarray(f).reshape(num_fluences, -1) for f in fluences_2d], axis=1)
+        fluences_1d = np.zeros((num_fluences, self.A.shape[1]))
+        fluences_1d[:, index_map['gather_beamlet_ind']] = fluences_flat[:, index_map['gather_flat_ind']]
+        return fluences_1d
+
+    def _get_fluence_index_map(self) -> dict:
+        """
+        Create flat indices of the beamlets in 2d grids of all the beams concatenated in row-major order. It is created
+        at the first call and reused until _reset_caches() is called
+        """
+        if self._fluence_index_map is not None:
+            return self._fluence_index_map
+        maps = [self.beamlets_dict[ind]['beamlet_idx_2d_finest_grid'] for ind in range(len(self.beamlets_dict))]
+        offsets = np.cumsum([0] + [m.size for m in maps])
+        flat_map = np.concatenate([m.ravel() for m in maps]) if maps else np.zeros(0, dtype=int)
+        flat_ind = np.flatnonzero(flat_map >= 0)
+        beamlet_ind = flat_map[flat_ind].astype(int)
+        # when a beamlet covers several elements, its last element in row-major order is used in 2d to 1d
+        gather_beamlet_ind, last = np.unique(beamlet_ind[::-1], return_index=True)
+        gather_flat_ind = flat_ind[flat_ind.size - 1 - last]
+        self._fluence_index_map = {'shapes': [m.shape for m in maps], 'offsets': offsets, 'flat_ind': flat_ind,
+                                   'beamlet_ind': beamlet_ind, 'gather_flat_ind': gather_flat_ind,
+                                   'gather_beamlet_ind': gather_beamlet_ind}
+        return self._fluence_index_map
 
     @staticmethod
     def sol_change_inf_matrix(sol: dict, inf_matrix) -> dict:
@@ -276,18 +691,21 @@ class InfluenceMatrix:
         if overwrite:
             new_inf_matrix = self
         else:
-            new_inf_matrix = deepcopy(self)
+            # shallow copy. dictionaries are copied and arrays are shared read-only with self
+            new_inf_matrix = copy(self)
+            new_inf_matrix.opt_voxels_dict = shared_copy(self.opt_voxels_dict)
         if beamlet_width_mm is None:
             beamlet_width_mm = self.beamlet_width_mm
             beamlet_height_mm = self.beamlet_height_mm
         new_inf_matrix.beamlet_width_mm = beamlet_width_mm
         new_inf_matrix.beamlet_height_mm = beamlet_height_mm
-        new_inf_matrix.beamlets_dict = deepcopy(self._beams.beams_dict['beamlets'])
+        finest_grids = [self.beamlets_dict[i]['beamlet_idx_2d_finest_grid'] for i in range(len(self.beamlets_dict))]
+        new_inf_matrix.beamlets_dict = shared_copy(self._beams.beams_dict['beamlets'])
         for i in range(len(self._beams.beams_dict['ID'])):
-            new_inf_matrix.beamlets_dict[i]['beam_id'] = deepcopy(self._beams.beams_dict['ID'][i])  # save beam_id in beamlet_dict
+            new_inf_matrix.beamlets_dict[i]['beam_id'] = self._beams.beams_dict['ID'][i]  # save beam_id in beamlet_dict
 
         for i in range(len(new_inf_matrix.beamlets_dict)):
-            new_inf_matrix.beamlets_dict[i]['beamlet_idx_2d_finest_grid'] = deepcopy(self.beamlets_dict[i]['beamlet_idx_2d_finest_grid'])
+            new_inf_matrix.beamlets_dict[i]['beamlet_idx_2d_finest_grid'] = finest_grids[i]
             # new_inf_matrix.beamlets_dict[i]['position_x_mm'][0] = deepcopy(self.beamlets_dict[i]['position_x_mm'][0])
             # new_inf_matrix.beamlets_dict[i]['position_y_mm'][0] = deepcopy(self.beamlets_dict[i]['position_y_mm'][0])
             # new_inf_matrix.beamlets_dict[i]['width_mm'][0] = deepcopy(self.beamlets_dict[i]['width_mm'][0])
@@ -300,109 +718,303 @@ class InfluenceMatrix:
             if np.all(np.array(down_sample_xyz) == 1):  # if all are 1 then no down sample
                 down_sample_xyz = None
         new_inf_matrix._down_sample_xyz = down_sample_xyz
-        new_inf_matrix.preprocess_beams(remove_corner_beamlets=remove_corner_beamlets)
+        new_inf_matrix.preprocess_beams(structure=self.target_structure, remove_corner_beamlets=remove_corner_beamlets,
+                                        is_bev=self.is_bev)
         new_inf_matrix.pre_process_voxels()
         A = new_inf_matrix.get_influence_matrix(is_full=new_inf_matrix.is_full)
         new_inf_matrix.A = A
+        new_inf_matrix._reset_caches()
+        return new_inf_matrix
+
+    def sparsify(self, data: DataExplorer = None, abs_tol: float = None, rel_tol: float = None,
+                 nnz_budget: int = None, ref_fluence: np.ndarray = None, chunk_cols: int = 64,
+                 overwrite: bool = False):
+        """
+        Create sparse influence matrix from the full influence matrix by removing the small elements of each beamlet
+        (column). The full matrix is processed in chunks of columns. If the influence matrix is full, the chunks are
+        taken from A. Otherwise, they are read from influenceMatrixFull in .h5 files of the beams, so the full matrix is
+        never loaded in memory. Elements are removed if
+
+        - abs(element) <= abs_tol
+        - abs(element) <= rel_tol * (max abs element of the beamlet)
+        - element is not in the nnz_budget largest elements of the matrix
+
+        The report of the removed elements is saved in sparsify_report of the sparse influence matrix. It contains the
+        dose error for ref_fluence and error_bound (max row sum of the removed elements) i.e. max abs dose error is
+        less than error_bound * max(abs(fluence)) for any fluence.
+
+        :param data: object of class DataExplorer. Required to read full influence matrix if A is sparse
+        :param abs_tol: absolute threshold. e.g. beams.beams_dict['influenceMatrixSparse_tol'][0]. It is saved in
+            sparse_tol of the sparse influence matrix. If None, sparse_tol of the sparse influence matrix is not changed
+        :param rel_tol: threshold relative to the max element of each beamlet e.g. 0.01
+        :param nnz_budget: maximum number of non-zeros in the sparse matrix
+        :param ref_fluence: reference fluence used to calculate dose error. defaults to None (fluence of ones)
+        :param chunk_cols: number of columns processed at a time. defaults to 64
+        :param overwrite: if True, A is replaced with the sparse matrix. Otherwise, new object is created
+        :return: object of InfluenceMatrix class with sparse influence matrix
+
+        :Example:
+        >>> inf_matrix_sparse = inf_matrix.sparsify(data=data, rel_tol=0.01, ref_fluence=sol['optimal_intensity'])
+        >>> print(inf_matrix_sparse.sparsify_report)
+        """
+        num_rows, num_cols = self.A.shape
+        x = np.ones(num_cols) if ref_fluence is None else np.asarray(ref_fluence, dtype=float)
+        if x.shape != (num_cols,):
+            raise ValueError('size of ref_fluence {} does not match number of beamlets {}'.format(x.shape, num_cols))
+        print('Sparsifying influence matrix..')
+        blocks = []
+        dose_error = np.zeros(num_rows)
+        removed_row_sum = np.zeros(num_rows)
+        nnz_full = 0
+        for start, block in self._get_full_matrix_chunks(data=data, chunk_cols=chunk_cols):
+            block_abs = np.abs(block)
+            keep = block_abs > 0
+            nnz_full += int(np.count_nonzero(keep))
+            if abs_tol is not None:
+                keep &= block_abs > abs_tol
+            if rel_tol is not None:
+                keep &= block_abs > rel_tol * np.max(block_abs, axis=0, initial=0)
+            removed = np.where(keep, 0, block)
+            dose_error += removed @ x[start:start + block.shape[1]]
+            removed_row_sum += np.sum(np.abs(removed), axis=1)
+            blocks.append(sparse.csc_matrix(np.where(keep, block, 0)))
+        A = sparse.hstack(blocks, format='csc') if blocks else sparse.csc_matrix((num_rows, num_cols))
+
+        if nnz_budget is not None and A.nnz > nnz_budget:
+            # keep the largest elements of the matrix
+            keep = np.zeros(A.nnz, dtype=bool)
+            keep[np.argpartition(-np.abs(A.data), max(nnz_budget, 1) - 1)[:max(nnz_budget, 0)]] = True
+            removed = sparse.csc_matrix((np.where(keep, 0, A.data), A.indices, A.indptr), shape=A.shape)
+            dose_error += removed @ x
+            removed_row_sum += abs(removed).sum(axis=1).A1
+            A.data[~keep] = 0
+            A.eliminate_zeros()
+
+        ref_dose = A @ x + dose_error  # dose of full matrix
+        report = {'nnz': int(A.nnz), 'nnz_full': nnz_full, 'density': A.nnz / max(num_rows * num_cols, 1),
+                  'max_dose_error': float(np.max(np.abs(dose_error), initial=0)),
+                  'rel_dose_error': float(np.linalg.norm(dose_error) / max(np.linalg.norm(ref_dose), np.finfo(float).tiny)),
+                  'error_bound': float(np.max(removed_row_sum, initial=0))}
+        print('Sparse matrix has {} of {} non-zeros. Relative dose error for reference fluence: {:.2e}'.format(
+            report['nnz'], report['nnz_full'], report['rel_dose_error']))
+
+        if overwrite:
+            new_inf_matrix = self
+        else:
+            new_inf_matrix = copy(self)
+            new_inf_matrix.opt_voxels_dict = shared_copy(self.opt_voxels_dict)
+            new_inf_matrix.beamlets_dict = shared_copy(self.beamlets_dict)
+        new_inf_matrix.A = A.asformat(self._sparse_format)
+        new_inf_matrix.is_full = False
+        if abs_tol is not None or self.is_full:
+            new_inf_matrix.sparse_tol = abs_tol
+        new_inf_matrix.sparsify_report = report
+        new_inf_matrix._reset_caches()
+        return new_inf_matrix
+
+    def compress(self, rank: int = None, tol: float = None, per_beam: bool = False, oversample: int = 10,
+                 power_iter: int = 2, seed: int = 0, overwrite: bool = False):
+        """
+        Create low-rank representation of the influence matrix using randomized truncated SVD. The compressed matrix
+        (LowRankMatrix) supports A @ x, A.T @ y and row indexing, so it can be used in Optimization and Evaluation
+        in place of the exact matrix. Relative approximation error ||A - A_low_rank||_F / ||A||_F is saved in
+        A.approx_error.
+
+        :param rank: rank of the matrix. If per_beam is True, rank of each beam
+        :param tol: relative approximation error used to select the rank if rank is None. If per_beam is True, it is
+            used for each beam
+        :param per_beam: if True, low-rank blocks are created for each beam
+        :param oversample: number of additional random vectors used in randomized SVD. defaults to 10
+        :param power_iter: number of power iterations used in randomized SVD. defaults to 2
+        :param seed: seed of the random number generator. defaults to 0
+        :param overwrite: if True, A is replaced with the low-rank matrix. Otherwise, new object is created
+        :return: object of InfluenceMatrix class with low-rank influence matrix
+
+        :Example:
+        >>> inf_matrix_lr = inf_matrix.compress(tol=0.05)
+        >>> print(inf_matrix_lr.A.rank, inf_matrix_lr.A.approx_error)
+        """
+        print('Compressing influence matrix..')
+        if not per_beam:
+            U, s, Vt, error = randomized_svd(self.A, rank=rank, tol=tol, oversample=oversample,
+                                             power_iter=power_iter, seed=seed)
+            A = LowRankMatrix(U, s[:, np.newaxis] * Vt, approx_error=error)
+        else:
+            Us, Ws = [], []
+            sq_error = 0
+            for ind in range(len(self.beamlets_dict)):
+                A_beam = self.A[:, self.beamlets_dict[ind]['start_beamlet_idx']:
+                                self.beamlets_dict[ind]['end_beamlet_idx'] + 1]
+                U, s, Vt, error = randomized_svd(A_beam, rank=rank, tol=tol, oversample=oversample,
+                                                 power_iter=power_iter, seed=seed)
+                sq_error += (error * frobenius_norm(A_beam)) ** 2
+                Us.append(U)
+                Ws.append(s[:, np.newaxis] * Vt)
+            A = LowRankMatrix(np.hstack(Us), sparse.block_diag(Ws, format='csr'),
+                              approx_error=float(np.sqrt(sq_error) / max(frobenius_norm(self.A), np.finfo(float).tiny)))
+        print('Rank of compressed matrix is {} with relative error {:.2e}'.format(A.rank, A.approx_error))
+
+        if overwrite:
+            new_inf_matrix = self
+        else:
+            new_inf_matrix = copy(self)
+            new_inf_matrix.opt_voxels_dict = shared_copy(self.opt_voxels_dict)
+            new_inf_matrix.beamlets_dict = shared_copy(self.beamlets_dict)
+        new_inf_matrix.A = A
+        new_inf_matrix._reset_caches()
         return new_inf_matrix
 
-    def get_influence_matrix(self, is_full=False):
+    def _get_full_matrix_chunks(self, data: DataExplorer = None, chunk_cols: int = 64):
+        """
+        Generate the chunks of columns of the full influence matrix as (index of first column, dense block)
+        """
+        if self.is_full and not sparse.issparse(self.A):
+            for start in range(0, self.A.shape[1], chunk_cols):
+                yield start, np.asarray(self.A[:, start:start + chunk_cols])
+            return
+        if data is None:
+            raise ValueError('data is required to read the full influence matrix')
+        if self.get_beamlet_agg_matrix() is not None or self.get_voxel_agg_matrix() is not None:
+            raise ValueError('full influence matrix can be streamed only in original resolution. '
+                             'Sparsify influence matrix in original resolution and use create_down_sample()')
+        refs = data.get_beams_h5_refs(field='influenceMatrixFull', beam_ids=self.get_all_beam_ids())
+        start = 0
+        for ind, ref in enumerate(refs):
+            ids = np.asarray(self.beamlets_dict[ind]['opt_beamlets_ids']).astype(int)
+            with h5py.File(ref.filename, 'r') as f:
+                dset = f[ref.dataset_key]
+                if dset.shape[0] != self.A.shape[0]:
+                    raise ValueError('full influence matrix of beam {} has {} voxels instead of {}'.format(
+                        self.beamlets_dict[ind]['beam_id'], dset.shape[0], self.A.shape[0]))
+                for chunk_start in range(0, len(ids), chunk_cols):
+                    chunk_ids = ids[chunk_start:chunk_start + chunk_cols]
+                    # read contiguous columns and select the beamlets
+                    first, last = int(np.min(chunk_ids)), int(np.max(chunk_ids))
+                    block = dset[:, first:last + 1]
+                    yield start + chunk_start, block[:, chunk_ids - first]
+            start += len(ids)
+
+    def get_influence_matrix(self, is_full=False, sparse_format: str = None, dtype=None):
         """
 
         Load influence matrix based on the beamlets and voxels.
 
         :param beams: object of class Beams
         :param is_full: get full or sparse matrix. Default to True.
+        :param sparse_format: layout of the sparse matrix e.g. 'csr' or 'csc'. Default to the layout set in constructor
+        :param dtype: data type of the matrix e.g. np.float32. Default to the data type set in constructor
         :return: full or sparse matrix
         """
+        if sparse_format is None:
+            sparse_format = self._sparse_format
+        if dtype is None:
+            dtype = self._dtype
         data_beamlet_width = self._beams.get_beamlet_width()
         data_beamlet_height = self._beams.get_beamlet_height()
+        is_beamlet_down_sample = self.beamlet_width_mm > data_beamlet_width or \
+            self.beamlet_height_mm > data_beamlet_height
+        self._beamlet_agg_matrix = None
+        self._voxel_agg_matrix = None
 
         if not is_full:
-            if self.beamlet_width_mm > data_beamlet_width or \
-                    self.beamlet_height_mm > data_beamlet_height or self._down_sample_xyz is not None:
-                inf_matrix_sparse = self.A
+            if is_beamlet_down_sample or self._down_sample_xyz is not None:
+                inf_matrix = self.A
             else:
-                # deepcopy so that it doesnt modify
-                inf_matrix_sparse = deepcopy(self._beams.beams_dict['influenceMatrixSparse'])
-                # if 'influenceMatrixSparse' in self._beams.beams_dict:
+                inf_matrix_sparse = self._beams.beams_dict['influenceMatrixSparse']
                 del self._beams.beams_dict['influenceMatrixSparse']
-
-            for ind in range(len(self.beamlets_dict)):
-                opt_beamlets = self.beamlets_dict[ind]['opt_beamlets_ids']
-
-                if ind == 0:
-                    if self.beamlet_width_mm > data_beamlet_width or self.beamlet_height_mm > data_beamlet_height:
-                        print('parsing influence matrix for beam {}'.format(ind))
-                        inf_matrix = sparse.hstack(
-                            [csr_matrix(inf_matrix_sparse[:, np.unique(opt_beamlets[i])].sum(axis=1)) for i in
-                             range(len(opt_beamlets))], format='csr')
-                    else:
-                        if self._down_sample_xyz is None:
-                            inf_matrix = inf_matrix_sparse[ind][:, opt_beamlets]
-                else:
-                    if self.beamlet_width_mm > data_beamlet_width or self.beamlet_height_mm > data_beamlet_height:
-                        print('parsing influence matrix for beam {}'.format(ind))
-                        inf_matrix_2 = sparse.hstack(
-                            [csr_matrix(inf_matrix_sparse[:, np.unique(opt_beamlets[i])].sum(axis=1)) for i in
-                             range(len(opt_beamlets))], format='csr')
-                        inf_matrix = sparse.hstack(
-                            [inf_matrix, inf_matrix_2], format='csr')
-                    else:
-                        if self._down_sample_xyz is None:
-                            inf_matrix = sparse.hstack(
-                                [inf_matrix, inf_matrix_sparse[ind][:, opt_beamlets]], format='csr')
-            # if del_org_matrix:
-            if self._down_sample_xyz is not None:
-                if self.beamlet_width_mm <= data_beamlet_width or self.beamlet_height_mm <= data_beamlet_height:
-                    inf_matrix = inf_matrix_sparse
-                print('creating influence matrix for down sample voxels..')
-                inf_matrix = sparse.vstack(
-                    [csr_matrix((sparse.diags(self._vox_weights[i]).dot(inf_matrix[self._vox_map[i], :])).sum(axis=0))
-                     for i
-                     in
-                     range(len(self._vox_map))], format='csr')
+                # collect column slices of all the beams and concatenate them once
+                blocks = [inf_matrix_sparse[ind][:, self.beamlets_dict[ind]['opt_beamlets_ids']]
+                          for ind in range(len(self.beamlets_dict))]
+                inf_matrix = sparse.hstack(blocks, format=sparse_format, dtype=dtype)
         else:
-            if self.beamlet_width_mm > data_beamlet_width or self.beamlet_height_mm > data_beamlet_height or self._down_sample_xyz is not None:
-                inf_matrix_full = self.A
+            if is_beamlet_down_sample or self._down_sample_xyz is not None:
+                inf_matrix = self.A
             else:
                 inf_matrix_full = self._beams.beams_dict['influenceMatrixFull']
                 del self._beams.beams_dict['influenceMatrixFull']
+                num_cols = [len(self.beamlets_dict[ind]['opt_beamlets_ids']) for ind in range(len(self.beamlets_dict))]
+                inf_matrix = np.empty((inf_matrix_full[0].shape[0], sum(num_cols)),
+                                      dtype=inf_matrix_full[0].dtype if dtype is None else dtype)
+                start = 0
+                for ind in range(len(self.beamlets_dict)):
+                    inf_matrix[:, start:start + num_cols[ind]] = \
+                        inf_matrix_full[ind][:, self.beamlets_dict[ind]['opt_beamlets_ids']]
+                    start = start + num_cols[ind]
+
+        # down sampling beamlets. A_down_sample = A @ S
+        if is_beamlet_down_sample:
+            print('creating influence matrix for down sample beamlets..')
+            self._beamlet_agg_matrix = self._create_beamlet_agg_matrix(num_beamlets=inf_matrix.shape[1])
+            if is_full:
+                inf_matrix = np.ascontiguousarray((self._beamlet_agg_matrix.T @ inf_matrix.T).T)
+            else:
+                inf_matrix = inf_matrix @ self._beamlet_agg_matrix
 
-            for ind in range(len(self.beamlets_dict)):
-                opt_beamlets = self.beamlets_dict[ind]['opt_beamlets_ids']
-
-                if ind == 0:
-                    if self.beamlet_width_mm > data_beamlet_width or self.beamlet_height_mm > data_beamlet_height:
-                        print('parsing full influence matrix for beam {}'.format(ind))
-                        inf_matrix = np.column_stack(
-                            [inf_matrix_full[:, np.unique(opt_beamlets[i])].sum(axis=1) for i in
-                             range(len(opt_beamlets))])
-                    else:
-                        if self._down_sample_xyz is None:
-                            inf_matrix = inf_matrix_full[ind][:, opt_beamlets]
-                else:
-                    if self.beamlet_width_mm > data_beamlet_width or self.beamlet_height_mm > data_beamlet_height:
-                        print('parsing full influence matrix for beam {}'.format(ind))
-                        inf_matrix_2 = np.column_stack(
-                            [inf_matrix_full[:, np.unique(opt_beamlets[i])].sum(axis=1) for i in
-                             range(len(opt_beamlets))])
-                        inf_matrix = np.hstack([inf_matrix, inf_matrix_2])
-                    else:
-                        if self._down_sample_xyz is None:
-                            inf_matrix = np.hstack([inf_matrix, inf_matrix_full[ind][:, opt_beamlets]])
-
-                # down sampling voxels
-            if self._down_sample_xyz is not None:
-                if self.beamlet_width_mm <= data_beamlet_width or self.beamlet_height_mm <= data_beamlet_height:
-                    inf_matrix = inf_matrix_full
-                print('creating influence matrix for down sample voxels..')
-                inf_matrix = np.vstack(
-                    [(np.diag(self._vox_weights[i]).dot(inf_matrix[self._vox_map[i], :])).sum(axis=0)
-                     for i in range(len(self._vox_map))])
+        # down sampling voxels. A_down_sample = W @ A
+        if self._down_sample_xyz is not None:
+            print('creating influence matrix for down sample voxels..')
+            self._voxel_agg_matrix = self._create_voxel_agg_matrix(num_voxels=inf_matrix.shape[0])
+            inf_matrix = self._voxel_agg_matrix @ inf_matrix
 
+        if not is_full:
+            inf_matrix = inf_matrix.asformat(sparse_format)
+        if dtype is not None and inf_matrix.dtype != dtype:
+            inf_matrix = inf_matrix.astype(dtype)
         return inf_matrix
 
+    def get_smoothness_matrix(self) -> (csr_matrix, csr_matrix, int, int):
+        """
+        Get sparse smoothness matrices of the beamlets. They are created once and cached
+
+        :return: Qx, Qy, number of rows and number of columns of the beam maps
+
+        :Example:
+        >>> [Qx, Qy, num_rows, num_cols] = inf_matrix.get_smoothness_matrix()
+        """
+        if self._smoothness_matrix is None:
+            self._smoothness_matrix = create_smoothness_matrix(self.beamlets_dict)
+        return self._smoothness_matrix
+
+    def get_beamlet_agg_matrix(self) -> Union[csr_matrix, None]:
+        """
+        Get sparse beamlet aggregation matrix S used to create the down sampled influence matrix (A_down_sample = A @ S).
+        Column j of S has ones at the beamlets of the previous influence matrix covered by down sampled beamlet j.
+        It can be used to map fluence between resolutions e.g. fluence_1d_fine = S @ fluence_1d_down_sample
+
+        :return: beamlet aggregation matrix. None if beamlets are not down sampled
+        """
+        return self._beamlet_agg_matrix
+
+    def get_voxel_agg_matrix(self) -> Union[csr_matrix, None]:
+        """
+        Get sparse voxel aggregation matrix W used to create the down sampled influence matrix (A_down_sample = W @ A).
+        Row i of W has the weights of the voxels of the previous influence matrix in down sampled voxel i.
+        It can be used to map dose between resolutions e.g. dose_1d_down_sample = W @ dose_1d_fine
+
+        :return: voxel aggregation matrix. None if voxels are not down sampled
+        """
+        return self._voxel_agg_matrix
+
+    def _create_beamlet_agg_matrix(self, num_beamlets: int) -> csr_matrix:
+        rows = []
+        cols = []
+        col = 0
+        for ind in range(len(self.beamlets_dict)):
+            for beamlets in self.beamlets_dict[ind]['opt_beamlets_ids']:
+                beamlets = np.unique(beamlets)
+                rows.append(beamlets)
+                cols.append(np.full(len(beamlets), col))
+                col = col + 1
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=int)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype=int)
+        return csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(num_beamlets, col))
+
+    def _create_voxel_agg_matrix(self, num_voxels: int) -> csr_matrix:
+        rows = np.repeat(np.arange(len(self._vox_map)), [len(vox) for vox in self._vox_map])
+        cols = np.concatenate(self._vox_map) if self._vox_map else np.zeros(0, dtype=int)
+        weights = np.concatenate(self._vox_weights) if self._vox_weights else np.zeros(0)
+        return csr_matrix((weights, (rows, cols)), shape=(len(self._vox_map), num_voxels))
+
     def create_BEV_mask_from_contours(self, ind: int, structure: str = 'PTV',
                                       margin_mm: float = None) -> np.ndarray:
         """
@@ -425,7 +1037,17 @@ class InfluenceMatrix:
         # ind = my_plan.beamlets_dict['ID'].index(beam_id)
         # contours = my_plan._beams_contours[ind][struct_name]
 
-        # for each contour create polygon and get beamlets inside the polygon and create mask for it
+        # create beam map from beamlet coordinates. row and col of each beamlet in the map
+        beamlets = self.beamlets_dict[ind]
+        x_positions = np.ravel(beamlets['position_x_mm'][0])
+        y_positions = np.ravel(beamlets['position_y_mm'][0])
+        x_min_max_sort = np.unique(x_positions)
+        y_min_max_sort = np.unique(y_positions)
+        cols = np.searchsorted(x_min_max_sort, x_positions)
+        rows = len(y_min_max_sort) - 1 - np.searchsorted(y_min_max_sort, y_positions)
+        mask = np.zeros((len(y_min_max_sort), len(x_min_max_sort)), dtype=bool)
+
+        # for each contour create polygon and mask the beamlets inside the polygon
         for count_num in range(len(contours)):
             polygon = []
             for j in contours[count_num]:
@@ -437,34 +1059,8 @@ class InfluenceMatrix:
                 shapely_poly = s
             else:
                 shapely_poly = Polygon(s.buffer(margin_mm), [r])
-            #             poly_coordinates = np.array(list(t.exterior.coords))
-
-            # create beam map from beamlet coordinates and mask the beamlets inside shapely polygon
-            beamlets = self.beamlets_dict[ind]
-            x_positions = beamlets['position_x_mm'][0]
-            y_positions = beamlets['position_y_mm'][0]
-            x_min_max_sort = np.sort(np.unique(x_positions))
-            y_max_min_sort = np.sort(np.unique(y_positions))[::-1]
-            points = []
-            for i in range(len(beamlets['id'][0])):
-                x_coord = beamlets['position_x_mm'][0][i]
-                y_coord = beamlets['position_y_mm'][0][i]
-                points.append(Point(x_coord, y_coord))
-            valid_points = []
-            valid_points.extend(filter(shapely_poly.contains, points))
-            x_and_y = [(a.x, a.y) for a in valid_points]
-            XX, YY = np.meshgrid(x_min_max_sort, y_max_min_sort)
-            w_all = np.column_stack((x_positions, y_positions))
-            if count_num == 0:
-                mask = np.zeros_like(XX, dtype=bool)
-            for row in range(XX.shape[0]):
-                for col in range(XX.shape[1]):
-                    ind1 = np.where((w_all[:, 0] == XX[row, col]) & (w_all[:, 1] == YY[row, col]))[0][0]
-
-                    # if (beamlets[ind]['position_x_mm'], beamlets[ind]['position_y_mm']) in x_and_y:
-                    if (beamlets['position_x_mm'][0][ind1], beamlets['position_y_mm'][0][ind1]) in x_and_y:
-                        # beam_map[row, col] = beamlets[ind]['id']
-                        mask[row, col] = True
+            inside = contains_xy(shapely_poly, x_positions, y_positions)
+            mask[rows[inside], cols[inside]] = True
         mask = self._process_matrix(mask)
         return mask
 
@@ -515,16 +1111,15 @@ class InfluenceMatrix:
                         count_ind = np.where(counts >= (self.beamlet_width_mm / 2.5) * (self.beamlet_height_mm / 2.5))
                         down_sample_beamlets = down_sample_beamlets[count_ind]
                         # updating down sample grid after removing corner beamlets
-                        inds_down_sample = down_sample_2d_grid == down_sample_beamlets[:, None,
-                                                                  None]  # keep only down sample beamlets and remove others
-                        down_sample_2d_grid[~np.any(inds_down_sample, axis=0)] = -1
+                        # keep only down sample beamlets and remove others
+                        down_sample_2d_grid[~np.isin(down_sample_2d_grid, down_sample_beamlets)] = -1
 
                     a = np.where(np.isin(down_sample_2d_grid, down_sample_beamlets))
                     mask_2d_grid = np.zeros_like(beam_2d_grid, dtype=bool)
                     mask_2d_grid[a] = True
                     actual_beamlets = self.beamlets_dict[ind]['beamlet_idx_2d_finest_grid'][a]
                     sampled_beamlets = down_sample_2d_grid[a]
-                    b = [np.where(sampled_beamlets == down_sample_beamlets[i]) for i in range(len(down_sample_beamlets))]
+                    b = group_beamlets(sampled_beamlets, down_sample_beamlets)
                     opt_beamlets = [actual_beamlets[i] for i in b]
                     if remove_corner_beamlets:
                         orig_beamlets = beam_2d_grid[a]
@@ -589,25 +1184,7 @@ class InfluenceMatrix:
         """
         # ind = my_plan.beamlets_dict['ID'].index(beam_id)
         beamlets = self.beamlets_dict[ind]
-        x_positions = beamlets['position_x_mm'][0] - beamlets['width_mm'][0] / 2
-        y_positions = beamlets['position_y_mm'][0] + beamlets['height_mm'][0] / 2
-        right_ind = np.argmax(x_positions)
-        bottom_ind = np.argmin(y_positions)
-        w_all = np.column_stack((x_positions, y_positions))  # top left corners of all beamlets
-        x_coord = np.arange(np.min(x_positions), np.max(x_positions) + beamlets['width_mm'][0][right_ind].item(), 2.5)
-        y_coord = np.arange(np.max(y_positions), np.min(y_positions) - beamlets['height_mm'][0][bottom_ind].item(), -2.5)
-        XX, YY = np.meshgrid(x_coord, y_coord)
-        beamlet_idx_2d_grid = np.ones_like(XX, dtype=int)
-        beamlet_idx_2d_grid = beamlet_idx_2d_grid * int(-1)
-        for row in range(XX.shape[0]):
-            for col in range(XX.shape[1]):
-                ind = np.where((w_all[:, 0] == XX[row, col]) & (w_all[:, 1] == YY[row, col]))
-                if np.size(ind) > 0:
-                    ind = ind[0][0]
-                    num_width = int(beamlets['width_mm'][0][ind].item() / 2.5)
-                    num_height = int(beamlets['height_mm'][0][ind].item() / 2.5)
-                    beamlet_idx_2d_grid[row:row + num_height, col:col + num_width] = ind
-
+        beamlet_idx_2d_grid = create_beamlet_idx_2d_finest_grid(beamlets, finest_res_mm=2.5)
         return beamlet_idx_2d_grid
 
     def down_sample_2d_grid(self, ind: int, beamlet_width_mm: float = 5.0,
@@ -623,32 +1200,23 @@ class InfluenceMatrix:
         """
         # ind = my_plan.beamlets_dict['ID'].index(beam_id)
         beamlets = self.beamlets_dict[ind]
-        x_positions = beamlets['position_x_mm'][0] - beamlets['width_mm'][0] / 2
-        y_positions = beamlets['position_y_mm'][0] + beamlets['height_mm'][0] / 2
+        widths = np.ravel(beamlets['width_mm'][0])
+        heights = np.ravel(beamlets['height_mm'][0])
+        x_positions = np.ravel(beamlets['position_x_mm'][0]) - widths / 2
+        y_positions = np.ravel(beamlets['position_y_mm'][0]) + heights / 2
         right_ind = np.argmax(x_positions)
         bottom_ind = np.argmin(y_positions)
-        # w_all = np.column_stack((x_positions, y_positions))  # top left corners of all beamlets
-        x_coord = np.arange(np.min(x_positions), np.max(x_positions) + beamlets['width_mm'][0][right_ind], 2.5)
-        y_coord = np.arange(np.max(y_positions), np.min(y_positions) - beamlets['height_mm'][0][bottom_ind], -2.5)
-        XX, YY = np.meshgrid(x_coord, y_coord)
-        beamlet_resample_2d_grid = np.ones_like(XX, dtype=int)
-        beamlet_resample_2d_grid = beamlet_resample_2d_grid * int(-1)
-        row_col_covered = []
-        ind = 0
-        for row in range(XX.shape[0]):
-            for col in range(XX.shape[1]):
-                # ind = np.where((w_all[:, 0] == XX[row, col]) & (w_all[:, 1] == YY[row, col]))
-                # if np.size(ind) > 0:
-                #     ind = ind[0][0]
-                if [row, col] not in row_col_covered:
-                    num_width = int(beamlet_width_mm / 2.5)
-                    num_height = int(beamlet_height_mm / 2.5)
-                    beamlet_resample_2d_grid[row:row + num_height, col:col + num_width] = ind
-                    ind = ind + 1
-                    rows = np.arange(row, row + num_height)
-                    cols = np.arange(col, col + num_width)
-                    for r in itertools.product(rows, cols):
-                        row_col_covered.append([r[0], r[1]])
+        num_cols = len(np.arange(np.min(x_positions), np.max(x_positions) + widths[right_ind], 2.5))
+        num_rows = len(np.arange(np.max(y_positions), np.min(y_positions) - heights[bottom_ind], -2.5))
+        num_width = int(beamlet_width_mm / 2.5)
+        num_height = int(beamlet_height_mm / 2.5)
+        if num_width <= 0 or num_height <= 0:
+            return np.full((num_rows, num_cols), -1, dtype=int)
+
+        # tile the grid with blocks of num_height*num_width starting from top left. blocks are numbered in row-major order
+        rows, cols = np.indices((num_rows, num_cols))
+        num_blocks_per_row = -(-num_cols // num_width)
+        beamlet_resample_2d_grid = (rows // num_height) * num_blocks_per_row + cols // num_width
         return beamlet_resample_2d_grid
 
     def get_orig_res_2d_grid(self, ind: int) -> np.ndarray:
@@ -660,20 +1228,7 @@ class InfluenceMatrix:
 
         """
         beamlets = self.beamlets_dict[ind]
-        x_positions = beamlets['position_x_mm'][0]
-        y_positions = beamlets['position_y_mm'][0]
-        x_min_max_sort = np.sort(np.unique(x_positions))
-        y_max_min_sort = np.sort(np.unique(y_positions))[::-1]
-        XX, YY = np.meshgrid(x_min_max_sort, y_max_min_sort)
-        w_all = np.column_stack((x_positions, y_positions))
-        beam_map = np.zeros_like(XX, dtype=int)
-        for row in range(XX.shape[0]):
-            for col in range(XX.shape[1]):
-                b_ind = np.where((w_all[:, 0] == XX[row, col]) & (w_all[:, 1] == YY[row, col]))[0][0]
-                # beam_map[row, col] = beamlets[ind]['id']+int(1)# adding one so that 0th beamlet is retained
-                beam_map[row, col] = b_ind  # + int(1)  # adding one so that 0th beamlet is retained
-        # beam_map = np.multiply(beam_map, mask)
-        # beam_map = beam_map - int(1)  # subtract one again to get original beamlets
+        beam_map = create_beamlet_idx_2d_orig_grid(beamlets)
         return beam_map
 
     def get_bev_2d_grid(self, beam_id: Union[Union[int, str], List[Union[int, str]]] = None, ind: int = None,
@@ -712,15 +1267,7 @@ class InfluenceMatrix:
         for b in ind:
             beam_map = self.beamlets_dict[b]['beamlet_idx_2d_finest_grid']
             if not finest_grid:
-                rowsNoRepeat = [0]
-                for i in range(1, np.size(beam_map, 0)):
-                    if (beam_map[i, :] != beam_map[rowsNoRepeat[-1], :]).any():
-                        rowsNoRepeat.append(i)
-                colsNoRepeat = [0]
-                for j in range(1, np.size(beam_map, 1)):
-                    if (beam_map[:, j] != beam_map[:, colsNoRepeat[-1]]).any():
-                        colsNoRepeat.append(j)
-                beam_map = beam_map[np.ix_(np.asarray(rowsNoRepeat), np.asarray(colsNoRepeat))]
+                beam_map = remove_repeated_rows_cols(beam_map)
 
                 # add this part in case remove corner beamlets create issue for getting original resolution
                 remove_row = []
@@ -794,7 +1341,7 @@ class InfluenceMatrix:
          and ct to dose_1d voxel map
         """
 
-        vox_3d = self.opt_voxels_dict['ct_to_dose_voxel_map'][0]
+        vox_3d = self.opt_voxels_dict['ct_to_dose_voxel_map'][0].copy()  # patches are modified in place below
         # dose_to_ct_int = np.round(np.array(self.opt_voxels_dict['dose_voxel_resolution_xyz_mm']) /
         #                           np.array(self.opt_voxels_dict['ct_voxel_resolution_xyz_mm']))
         # dose_to_ct_int = dose_to_ct_int.astype(int)
@@ -889,7 +1436,7 @@ class InfluenceMatrix:
             for structure_name in self._structs.structures_dict['name']:
                 ind = self._structs.structures_dict['name'].index(structure_name)
                 # deep copying mask so that it doesnt modify in structures
-                vox_3d = deepcopy(self._structs.structures_dict['structure_mask_3d'][ind]) * self.opt_voxels_dict['ct_to_dose_voxel_map'][0]
+                vox_3d = self._structs.structures_dict['structure_mask_3d'][ind] * self.opt_voxels_dict['ct_to_dose_voxel_map'][0]
                 # my_plan.structures_dict['voxel_idx'][i] = np.unique(vox_3d[vox_3d > 0])
                 vox, counts = np.unique(vox_3d[vox_3d > 0], return_counts=True)
                 self.opt_voxels_dict['voxel_idx'][ind] = vox
@@ -899,15 +1446,7 @@ class InfluenceMatrix:
 
     @staticmethod
     def sort_beamlets(b_map):
-        c = b_map[b_map >= 0]
-        c = np.unique(c)
-        ind = np.arange(0, len(c))
-        c_sort = np.sort(c)
-        matrix_ind = [np.where(b_map == c_i) for c_i in c_sort]
-        map_copy = b_map.copy()
-        for i in range(len(ind)):
-            map_copy[matrix_ind[i]] = ind[i]
-        return map_copy
+        return renumber_beamlets(b_map)
 
     # for voxels idx methods
     def set_opt_voxel_idx(self, plan_obj, structure_name: str) -> None:
@@ -928,6 +1467,7 @@ class InfluenceMatrix:
         self.opt_voxels_dict['voxel_volume_cc'].append(
             counts * np.prod(plan_obj.get_ct_res_xyz_mm())/1000)  # calculate weight for each voxel
         self.opt_voxels_dict['name'].append(structure_name)
+        self._reset_caches()
 
     def get_fraction_of_vol_in_calc_box(self, structure_name: str):
         return self._structs.get_fraction_of_vol_in_calc_box(structure_name=structure_name)
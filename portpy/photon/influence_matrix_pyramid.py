@@ -0,0 +1,108 @@
+import numpy as np
+from scipy import sparse
+from typing import List
+from .influence_matrix import InfluenceMatrix
+
+
+class InfluenceMatrixPyramid:
+    """
+    Multi-resolution pyramid of influence matrices for coarse-to-fine optimization.
+
+    The coarser levels are created once from the influence matrix of the finest level using create_down_sample().
+    Beamlet aggregation matrix of each level (finest beamlets x level beamlets) is used to create the prolongation
+    (coarse to fine fluence) and restriction (fine to coarse fluence) maps between consecutive levels.
+    Prolongation assigns the intensity of a coarse beamlet to the fine beamlets covered by it, so that
+    A_fine @ prolong(x) = A_coarse @ x when the beamlets are nested.
+
+    :param inf_matrix: influence matrix of the finest level
+    :param beamlet_res_mm: beamlet width and height in mm of the coarser levels from coarsest to finest e.g. [10, 5]
+    :param opt_vox_xyz_res_mm: optimization voxel resolution of the coarser levels e.g. [[10, 10, 5], [5, 5, 2.5]].
+        Defaults to None (voxels are not down sampled)
+
+    - **Attributes** ::
+
+        :param levels: list of InfluenceMatrix objects from coarsest to finest
+        :param prolongation: list of sparse matrices. prolongation[l] maps fluence of level l to level l + 1
+        :param restriction: list of sparse matrices. restriction[l] maps fluence of level l + 1 to level l
+
+    :Example:
+    >>> pyramid = InfluenceMatrixPyramid(inf_matrix, beamlet_res_mm=[10, 5])
+    >>> sol = opt.solve(pyramid=pyramid, solver='MOSEK')
+    """
+
+    def __init__(self, inf_matrix: InfluenceMatrix, beamlet_res_mm: List[float] = None,
+                 opt_vox_xyz_res_mm: List[List[float]] = None):
+        if beamlet_res_mm is None:
+            beamlet_res_mm = [10, 5]
+        if opt_vox_xyz_res_mm is not None and len(opt_vox_xyz_res_mm) != len(beamlet_res_mm):
+            raise ValueError('opt_vox_xyz_res_mm should be given for each level in beamlet_res_mm')
+        num_beamlets = inf_matrix.A.shape[1]
+        self.levels = []
+        beamlet_agg_matrices = []
+        for i, res in enumerate(beamlet_res_mm):
+            print('Creating level {} of pyramid..'.format(i))
+            level = inf_matrix.create_down_sample(beamlet_width_mm=res, beamlet_height_mm=res,
+                                                  opt_vox_xyz_res_mm=None if opt_vox_xyz_res_mm is None else
+                                                  opt_vox_xyz_res_mm[i])
+            S = level.get_beamlet_agg_matrix()
+            beamlet_agg_matrices.append(sparse.identity(num_beamlets, format='csr') if S is None else S.tocsr())
+            self.levels.append(level)
+        self.levels.append(inf_matrix)
+        beamlet_agg_matrices.append(sparse.identity(num_beamlets, format='csr'))
+        self._beamlet_agg_matrices = beamlet_agg_matrices
+
+        self.prolongation = []
+        self.restriction = []
+        for S_coarse, S_fine in zip(beamlet_agg_matrices[:-1], beamlet_agg_matrices[1:]):
+            # overlap[j, i] is number of finest beamlets shared by fine beamlet j and coarse beamlet i
+            overlap = (S_fine.T @ S_coarse).tocsr()
+            self.prolongation.append(self._normalize_rows(overlap))
+            self.restriction.append(self._normalize_rows(overlap.T.tocsr()))
+
+    @staticmethod
+    def _normalize_rows(M):
+        row_sum = np.asarray(M.sum(axis=1)).ravel()
+        row_sum[row_sum == 0] = 1
+        return (sparse.diags(1 / row_sum) @ M).tocsr()
+
+    @property
+    def num_levels(self) -> int:
+        return len(self.levels)
+
+    def get_level(self, level: int) -> InfluenceMatrix:
+        """
+        :param level: index of the level. 0 is the coarsest and -1 is the finest level
+        :return: influence matrix of the level
+        """
+        return self.levels[level]
+
+    def prolong(self, x: np.ndarray, level: int, to_level: int = None) -> np.ndarray:
+        """
+        Map fluence from level to finer level
+
+        :param x: fluence of the level
+        :param level: index of the level of x
+        :param to_level: index of the finer level. defaults to level + 1
+        :return: fluence of to_level
+        """
+        level = level % self.num_levels
+        to_level = level + 1 if to_level is None else to_level % self.num_levels
+        for i in range(level, to_level):
+            x = self.prolongation[i] @ x
+        return x
+
+    def restrict(self, x: np.ndarray, level: int, to_level: int = None) -> np.ndarray:
+        """
+        Map fluence from level to coarser level. Intensity of coarse beamlet is the average intensity of the fine
+        beamlets covered by it
+
+        :param x: fluence of the level
+        :param level: index of the level of x
+        :param to_level: index of the coarser level. defaults to level - 1
+        :return: fluence of to_level
+        """
+        level = level % self.num_levels
+        to_level = level - 1 if to_level is None else to_level % self.num_levels
+        for i in range(level - 1, to_level - 1, -1):
+            x = self.restriction[i] @ x
+        return x
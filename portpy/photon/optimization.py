@@ -6,7 +6,11 @@ import time
 if TYPE_CHECKING:
     from portpy.photon.plan import Plan
     from portpy.photon.influence_matrix import InfluenceMatrix
+    from portpy.photon.influence_matrix_pyramid import InfluenceMatrixPyramid
 from .clinical_criteria import ClinicalCriteria
+from .utils.fista_solver import FistaSolver
+from .utils.beam_map import create_smoothness_matrix
+from scipy.sparse import csr_matrix
 from copy import deepcopy
 
 class Optimization(object):
@@ -17,6 +21,9 @@ class Optimization(object):
     :param inf_matrix: object of class InfluenceMatrix
     :param clinical_criteria: clinical criteria for which plan to be optimized
     :param opt_params: optimization parameters for modifying parameters of problem statement
+        opt_params['dose_formulation'] = 'shared' creates single dose variable for the voxels used in the problem
+        opt_params['dose_penalty_formulation'] = 'hinge' uses sum_squares(pos(A_s @ x - d)) for quadratic overdose and
+        underdose instead of slack variables
 
     - **Attributes** ::
 
@@ -25,10 +32,19 @@ class Optimization(object):
         :param vars: Dictionary containing variable
         :Example
                 dict = {"x": [...]}
+        :param params: Dictionary containing cvxpy parameters for weights and dose limits (total dose in Gy)
+        :Example
+                dict = {"PTV_quadratic-overdose_weight": cp.Parameter, "CORD_max_dose_limit": cp.Parameter}
 
     - **Methods** ::
         :create_cvxpy_problem(my_plan)
             Create cvxpy objective function and constraints and save them as a list
+        :get_dose_expr(voxels)
+            Get cvxpy expression for dose of the voxels
+        :update_params(opt_params, clinical_criteria, **params)
+            Update weights and dose limits without rebuilding the problem
+        :create_fista_solver()
+            Create FistaSolver for the problem defined by opt_params and clinical criteria
 
     """
 
@@ -53,6 +69,13 @@ class Optimization(object):
             self.vars = {'x': x}
         else:
             self.vars = vars
+        self.params = {}
+        self._problem = None
+        self._problem_key = None
+        self._dose_voxel_map = None
+        self._dose_voxels = None
+        self._hinge_terms = {}
+        self._num_problem_terms = None
 
     def create_cvxpy_problem(self):
         """
@@ -75,97 +98,275 @@ class Optimization(object):
 
         # get opt params for optimization
         obj_funcs = opt_params['objective_functions'] if 'objective_functions' in opt_params else []
-        opt_params_constraints = opt_params['constraints'] if 'constraints' in opt_params else []
 
-        A = inf_matrix.A
         num_fractions = clinical_criteria.get_num_of_fractions()
         st = inf_matrix
 
+        constraint_def = self._get_constraint_def(opt_params, clinical_criteria)
+
+        # create cvxpy parameters for weights and dose limits so that problem can be updated without rebuilding it
+        obj_names, constraint_names, param_values = self._get_param_specs(obj_funcs, constraint_def)
+        params = self.params
+        for name, value in param_values.items():
+            params[name] = cp.Parameter(nonneg=True, value=value, name=name)
+
+        # create single dose variable for the voxels used in objectives and constraints if shared formulation is used
+        self._create_dose_variable(obj_funcs, constraint_def)
+        # slack variables or hinge functions for quadratic overdose/underdose
+        penalty_formulation = opt_params.get('dose_penalty_formulation', 'slack')
+        if penalty_formulation not in ['slack', 'hinge']:
+            raise ValueError("dose_penalty_formulation should be 'slack' or 'hinge'. Got {}".format(penalty_formulation))
+
         # Construct optimization problem
 
         # Generating objective functions
         print('Objective Start')
         for i in range(len(obj_funcs)):
+            if obj_names[i] is None:
+                continue
+            weight = params[obj_names[i]['weight']]
             if obj_funcs[i]['type'] == 'quadratic-overdose':
-                if obj_funcs[i]['structure_name'] in my_plan.structures.get_structures():
-                    struct = obj_funcs[i]['structure_name']
-                    if len(st.get_opt_voxels_idx(struct)) == 0:  # check if there are any opt voxels for the structure
-                        continue
-                    key = self.matching_keys(obj_funcs[i], 'dose')
-                    dose_gy = self.dose_to_gy(key, obj_funcs[i][key]) / num_fractions
+                struct = obj_funcs[i]['structure_name']
+                if len(st.get_opt_voxels_idx(struct)) == 0:  # check if there are any opt voxels for the structure
+                    continue
+                if penalty_formulation == 'hinge':
+                    obj += [self._create_hinge_term(obj_names[i]['dose_gy'], index=len(obj),
+                                                    voxels=st.get_opt_voxels_idx(struct), weight=weight,
+                                                    num_fractions=num_fractions, is_overdose=True)]
+                else:
+                    dose_gy = params[obj_names[i]['dose_gy']] / num_fractions
                     dO = cp.Variable(len(st.get_opt_voxels_idx(struct)), pos=True)
-                    obj += [(1 / len(st.get_opt_voxels_idx(struct))) * (obj_funcs[i]['weight'] * cp.sum_squares(dO))]
-                    constraints += [A[st.get_opt_voxels_idx(struct), :] @ x <= dose_gy + dO]
+                    constraints += [self.get_dose_expr(st.get_opt_voxels_idx(struct)) <= dose_gy + dO]
+                    obj += [(1 / len(st.get_opt_voxels_idx(struct))) * (weight * cp.sum_squares(dO))]
             elif obj_funcs[i]['type'] == 'quadratic-underdose':
-                if obj_funcs[i]['structure_name'] in my_plan.structures.get_structures():
-                    struct = obj_funcs[i]['structure_name']
-                    if len(st.get_opt_voxels_idx(struct)) == 0:
-                        continue
-                    key = self.matching_keys(obj_funcs[i], 'dose')
-                    dose_gy = self.dose_to_gy(key, obj_funcs[i][key]) / num_fractions
+                struct = obj_funcs[i]['structure_name']
+                if len(st.get_opt_voxels_idx(struct)) == 0:
+                    continue
+                if penalty_formulation == 'hinge':
+                    obj += [self._create_hinge_term(obj_names[i]['dose_gy'], index=len(obj),
+                                                    voxels=st.get_opt_voxels_idx(struct), weight=weight,
+                                                    num_fractions=num_fractions, is_overdose=False)]
+                else:
+                    dose_gy = params[obj_names[i]['dose_gy']] / num_fractions
                     dU = cp.Variable(len(st.get_opt_voxels_idx(struct)), pos=True)
-                    obj += [(1 / len(st.get_opt_voxels_idx(struct))) * (obj_funcs[i]['weight'] * cp.sum_squares(dU))]
-                    constraints += [A[st.get_opt_voxels_idx(struct), :] @ x >= dose_gy - dU]
+                    constraints += [self.get_dose_expr(st.get_opt_voxels_idx(struct)) >= dose_gy - dU]
+                    obj += [(1 / len(st.get_opt_voxels_idx(struct))) * (weight * cp.sum_squares(dU))]
             elif obj_funcs[i]['type'] == 'quadratic':
-                if obj_funcs[i]['structure_name'] in my_plan.structures.get_structures():
-                    struct = obj_funcs[i]['structure_name']
-                    if len(st.get_opt_voxels_idx(struct)) == 0:
-                        continue
-                    obj += [(1 / len(st.get_opt_voxels_idx(struct))) * (obj_funcs[i]['weight'] * cp.sum_squares(A[st.get_opt_voxels_idx(struct), :] @ x))]
+                struct = obj_funcs[i]['structure_name']
+                if len(st.get_opt_voxels_idx(struct)) == 0:
+                    continue
+                obj += [(1 / len(st.get_opt_voxels_idx(struct))) * (weight * cp.sum_squares(self.get_dose_expr(st.get_opt_voxels_idx(struct))))]
             elif obj_funcs[i]['type'] == 'smoothness-quadratic':
-                [Qx, Qy, num_rows, num_cols] = self.get_smoothness_matrix(inf_matrix.beamlets_dict)
+                [Qx, Qy, num_rows, num_cols] = inf_matrix.get_smoothness_matrix()
                 smoothness_X_weight = 0.6
                 smoothness_Y_weight = 0.4
-                obj += [obj_funcs[i]['weight'] * (smoothness_X_weight * (1 / num_cols) * cp.sum_squares(Qx @ x) +
-                                                  smoothness_Y_weight * (1 / num_rows) * cp.sum_squares(Qy @ x))]
+                obj += [weight * (smoothness_X_weight * (1 / num_cols) * cp.sum_squares(Qx @ x) +
+                                  smoothness_Y_weight * (1 / num_rows) * cp.sum_squares(Qy @ x))]
 
         print('Objective done')
 
         print('Constraints Start')
 
+        # Adding max/mean constraints
+        for i in range(len(constraint_def)):
+            if constraint_names[i] is None:
+                continue
+            org = constraint_def[i]['parameters']['structure_name']
+            if len(st.get_opt_voxels_idx(org)) == 0:
+                continue
+            limit = params[constraint_names[i]['limit']]
+            if constraint_def[i]['type'] == 'max_dose':
+                constraints += [self.get_dose_expr(st.get_opt_voxels_idx(org)) <= limit / num_fractions]
+            elif constraint_def[i]['type'] == 'mean_dose':
+                # mean constraints using voxel weights
+                fraction_of_vol_in_calc_box = my_plan.structures.get_fraction_of_vol_in_calc_box(org)
+                # modify limit due to fraction of volume receiving no dose
+                constraints += [(1 / sum(st.get_opt_voxels_volume_cc(org))) *
+                                (cp.sum((cp.multiply(st.get_opt_voxels_volume_cc(org),
+                                                     self.get_dose_expr(st.get_opt_voxels_idx(org))))))
+                                <= limit / (fraction_of_vol_in_calc_box * num_fractions)]
+
+        print('Constraints done')
+        self._num_problem_terms = (len(obj), len(constraints))
+
+    def _get_constraint_def(self, opt_params: dict, clinical_criteria: ClinicalCriteria) -> List[dict]:
+        """
+        Get constraints definition using clinical criteria and constraints in opt params
+        """
+        opt_params_constraints = opt_params['constraints'] if 'constraints' in opt_params else []
         constraint_def = deepcopy(clinical_criteria.get_criteria())  # get all constraints definition using clinical criteria
 
         # add/modify constraints definition if present in opt params
         for opt_constraint in opt_params_constraints:
             # add constraint
-            param  = opt_constraint['parameters']
-            if param['structure_name'] in my_plan.structures.get_structures():
+            param = opt_constraint['parameters']
+            if param['structure_name'] in self.my_plan.structures.get_structures():
                 criterion_exist, criterion_ind = clinical_criteria.check_criterion_exists(opt_constraint, return_ind=True)
                 if criterion_exist:
                     constraint_def[criterion_ind] = opt_constraint
                 else:
                     constraint_def += [opt_constraint]
+        return constraint_def
 
-        # Adding max/mean constraints
-        for i in range(len(constraint_def)):
-            if constraint_def[i]['type'] == 'max_dose':
-                limit_key = self.matching_keys(constraint_def[i]['constraints'], 'limit')
-                if limit_key:
-                    limit = self.dose_to_gy(limit_key, constraint_def[i]['constraints'][limit_key])
-                    org = constraint_def[i]['parameters']['structure_name']
-                    if org != 'GTV' and org != 'CTV':
-                        if org in my_plan.structures.get_structures():
-                            if len(st.get_opt_voxels_idx(org)) == 0:
-                                continue
-                            constraints += [A[st.get_opt_voxels_idx(org), :] @ x <= limit / num_fractions]
-            elif constraint_def[i]['type'] == 'mean_dose':
-                limit_key = self.matching_keys(constraint_def[i]['constraints'], 'limit')
-                if limit_key:
-                    limit = self.dose_to_gy(limit_key, constraint_def[i]['constraints'][limit_key])
-                    org = constraint_def[i]['parameters']['structure_name']
-                    # mean constraints using voxel weights
-                    if org in my_plan.structures.get_structures():
-                        if len(st.get_opt_voxels_idx(org)) == 0:
-                            continue
-                        fraction_of_vol_in_calc_box = my_plan.structures.get_fraction_of_vol_in_calc_box(org)
-                        limit = limit/fraction_of_vol_in_calc_box  # modify limit due to fraction of volume receiving no dose
-                        constraints += [(1 / sum(st.get_opt_voxels_volume_cc(org))) *
-                                        (cp.sum((cp.multiply(st.get_opt_voxels_volume_cc(org),
-                                                             A[st.get_opt_voxels_idx(org), :] @ x))))
-                                        <= limit / num_fractions]
+    def _get_param_specs(self, obj_funcs: List[dict], constraint_def: List[dict]):
+        """
+        Get names and values of the cvxpy parameters of objective functions and constraints.
+        Names are of the form '<structure_name>_<type>_<field>' e.g. 'PTV_quadratic-overdose_weight',
+        'PTV_quadratic-overdose_dose_gy', 'CORD_max_dose_limit' and 'smoothness-quadratic_weight'.
+        Dose values are total dose in Gy
 
+        :return: list of names of parameters for each objective function (None if it is not used), list of names of
+            parameters for each constraint (None if it is not used) and dictionary of parameter values
+        """
+        structures = self.my_plan.structures.get_structures()
+        values = {}
+
+        def add_param(name, value):
+            # append index to the name if same term is used multiple times
+            unique_name, k = name, 1
+            while unique_name in values:
+                k += 1
+                unique_name = '{}_{}'.format(name, k)
+            values[unique_name] = float(value)
+            return unique_name
+
+        obj_names = []
+        for obj_func in obj_funcs:
+            names = None
+            obj_type = obj_func['type']
+            if obj_type == 'smoothness-quadratic':
+                names = {'weight': add_param('smoothness-quadratic_weight', obj_func['weight'])}
+            elif obj_type in ['quadratic-overdose', 'quadratic-underdose', 'quadratic']:
+                struct = obj_func['structure_name']
+                if struct in structures:
+                    names = {'weight': add_param('{}_{}_weight'.format(struct, obj_type), obj_func['weight'])}
+                    if obj_type != 'quadratic':
+                        key = self.matching_keys(obj_func, 'dose')
+                        names['dose_gy'] = add_param('{}_{}_dose_gy'.format(struct, obj_type),
+                                                     self.dose_to_gy(key, obj_func[key]))
+            obj_names.append(names)
+
+        constraint_names = []
+        for criterion in constraint_def:
+            names = None
+            if criterion['type'] in ['max_dose', 'mean_dose']:
+                limit_key = self.matching_keys(criterion['constraints'], 'limit')
+                org = criterion['parameters']['structure_name']
+                if limit_key and org in structures and not (criterion['type'] == 'max_dose' and org in ['GTV', 'CTV']):
+                    names = {'limit': add_param('{}_{}_limit'.format(org, criterion['type']),
+                                                self.dose_to_gy(limit_key, criterion['constraints'][limit_key]))}
+            constraint_names.append(names)
+        return obj_names, constraint_names, values
+
+    def update_params(self, opt_params: dict = None, clinical_criteria: ClinicalCriteria = None, **params):
+        """
+        Update weights and dose limits of the problem created by create_cvxpy_problem() without rebuilding it.
+        The next call of solve() reuses the compiled problem. Use solve(warm_start=True) to warm start the solver.
+        If opt_params['dose_penalty_formulation'] is 'hinge', dose values of quadratic overdose/underdose are constants
+        in the problem and their terms are created again when they are updated, so the problem is compiled again
 
-        print('Constraints done')
+        :param opt_params: modified optimization parameters. Weights and dose values of the objective functions and
+            constraints in the problem are updated. New objective functions or constraints are not added to the problem
+        :param clinical_criteria: modified clinical criteria
+        :param params: parameter values by name. See attribute params for the names e.g. PTV_quadratic_weight=100
+
+        :Example:
+        >>> opt.update_params(CORD_quadratic_weight=50, CORD_max_dose_limit=45)
+        >>> sol = opt.solve(solver='MOSEK', warm_start=True)
+        """
+        if opt_params is not None:
+            self.opt_params = opt_params
+        if clinical_criteria is not None:
+            self.clinical_criteria = clinical_criteria
+        if opt_params is not None or clinical_criteria is not None:
+            obj_funcs = self.opt_params['objective_functions'] if 'objective_functions' in self.opt_params else []
+            constraint_def = self._get_constraint_def(self.opt_params, self.clinical_criteria)
+            _, _, values = self._get_param_specs(obj_funcs, constraint_def)
+            for name, value in values.items():
+                if name in self.params:
+                    self.params[name].value = value
+                else:
+                    print('Warning: {} is not in the problem. Use create_cvxpy_problem() to add it'.format(name))
+        for name, value in params.items():
+            if name not in self.params:
+                raise ValueError('Invalid parameter {}. Valid parameters are {}'.format(name, list(self.params)))
+            self.params[name].value = float(value)
+        # dose of hinge terms is constant in the problem. Create the terms again if their dose is updated
+        for name, term in self._hinge_terms.items():
+            if self.params[name].value != term['dose_gy']:
+                self.obj[term['index']] = self._create_hinge_term(name, index=term['index'], voxels=term['voxels'],
+                                                                  weight=term['weight'],
+                                                                  num_fractions=term['num_fractions'],
+                                                                  is_overdose=term['is_overdose'])
+
+    def _create_hinge_term(self, name: str, index: int, voxels: np.ndarray, weight: cp.Parameter,
+                           num_fractions: int, is_overdose: bool):
+        """
+        Create objective term weight * sum_squares(pos(A_s @ x - d)) / num_voxels for quadratic overdose or
+        weight * sum_squares(pos(d - A_s @ x)) / num_voxels for quadratic underdose. Dose d is the value of parameter
+        name used as constant, since product of parameters weight and d is not DPP and cvxpy would compile the problem
+        again in every solve
+
+        :param name: name of the dose parameter of the term
+        :param index: index of the term in objective functions
+        :return: cvxpy expression of the term
+        """
+        dose_gy = self.params[name].value
+        dose = self.get_dose_expr(voxels)
+        hinge = cp.pos(dose - dose_gy / num_fractions) if is_overdose else cp.pos(dose_gy / num_fractions - dose)
+        self._hinge_terms[name] = {'index': index, 'dose_gy': dose_gy, 'voxels': voxels, 'weight': weight,
+                                   'num_fractions': num_fractions, 'is_overdose': is_overdose}
+        return (1 / len(voxels)) * (weight * cp.sum_squares(hinge))
+
+    def _create_dose_variable(self, obj_funcs: List[dict], constraint_def: List[dict]):
+        """
+        Create single dose variable d = A_opt @ x for the union of voxels of the structures used in objective functions
+        and max/mean constraints if opt_params['dose_formulation'] is 'shared'. The objectives and constraints are then
+        created on subsets of d, so that each voxel row of influence matrix is used once in the problem.
+        Default formulation 'sliced' uses A[voxels, :] @ x for each objective and constraint
+
+        :param obj_funcs: objective functions in opt params
+        :param constraint_def: constraints definition
+        """
+        self._dose_voxel_map = None
+        self._dose_voxels = None
+        self.vars.pop('d', None)
+        formulation = self.opt_params.get('dose_formulation', 'sliced')
+        if formulation == 'sliced':
+            return
+        if formulation != 'shared':
+            raise ValueError("dose_formulation should be 'sliced' or 'shared'. Got {}".format(formulation))
+        structs = [obj_func['structure_name'] for obj_func in obj_funcs if obj_func['type'] in
+                   ['quadratic-overdose', 'quadratic-underdose', 'quadratic']]
+        structs += [criterion['parameters']['structure_name'] for criterion in constraint_def if
+                    (criterion['type'] == 'max_dose' and criterion['parameters']['structure_name'] not in ['GTV', 'CTV'])
+                    or criterion['type'] == 'mean_dose']
+        structs = [struct for struct in set(structs) if struct in self.my_plan.structures.get_structures()]
+        voxels = np.unique(np.concatenate([np.asarray(self.inf_matrix.get_opt_voxels_idx(struct), dtype=int)
+                                           for struct in structs] + [np.zeros(0, dtype=int)]))
+        if len(voxels) == 0:
+            return
+        # position of each voxel row in d
+        self._dose_voxel_map = np.full(self.inf_matrix.A.shape[0], -1, dtype=int)
+        self._dose_voxel_map[voxels] = np.arange(len(voxels))
+        d = cp.Variable(len(voxels), name='d')
+        self.vars['d'] = d
+        self._dose_voxels = voxels
+        self.constraints += [d == self.inf_matrix.A[voxels, :] @ self.vars['x']]
+
+    def get_dose_expr(self, voxels: np.ndarray):
+        """
+        Get cvxpy expression for dose of the voxels. If shared dose variable is created, subset of it is used.
+        Otherwise, A[voxels, :] @ x is used
+
+        :param voxels: voxel indices (rows of influence matrix)
+        :return: cvxpy expression for dose of the voxels
+        """
+        if self._dose_voxel_map is not None:
+            ind = self._dose_voxel_map[voxels]
+            if np.all(ind >= 0):
+                return self.vars['d'][ind]
+        return self.inf_matrix.A[voxels, :] @ self.vars['x']
 
     def add_max(self, struct: str, dose_gy: float):
         """
@@ -276,7 +477,7 @@ class Optimization(object):
         st = self.inf_matrix
         x = self.vars['x']
 
-        [Qx, Qy, num_rows, num_cols] = self.get_smoothness_matrix(st.beamlets_dict)
+        [Qx, Qy, num_rows, num_cols] = st.get_smoothness_matrix()
         obj = weight * (
                 smoothness_X_weight * (1 / num_cols) * cp.sum_squares(Qx @ x) + smoothness_Y_weight * (1 / num_rows)
                 * cp.sum_squares(Qy @ x))
@@ -327,11 +528,23 @@ class Optimization(object):
 
         self.add_constraints(constraints)
 
-    def solve(self, return_cvxpy_prob=False, *args, **kwargs):
+    def solve(self, return_cvxpy_prob=False, *args, x0: np.ndarray = None, pyramid: InfluenceMatrixPyramid = None,
+              **kwargs):
         """
                 Return optimal solution and influence matrix associated with it in the form of dictionary
                 If return_problem set to true, returns cvxpy problem instance
 
+                :param x0: initial fluence used to warm start the solvers supporting it
+                :param kwargs: arguments of cvxpy solve(). If solver='portpy-fista', the problem defined by opt_params
+                    and clinical criteria is solved using FistaSolver without cvxpy. Its options max_iter,
+                    max_inner_iter, max_outer_iter, tol, feas_tol, rho and verbose can be passed. Convergence metrics
+                    of each iteration are saved in attribute solver_history and FistaSolver is returned instead of
+                    cvxpy problem
+                :param pyramid: object of InfluenceMatrixPyramid with the influence matrix of this problem as the finest
+                    level. If given, the problem is solved coarse-to-fine. The problem created by create_cvxpy_problem()
+                    using opt_params is solved at the coarsest level and its solution is prolonged to the next level as
+                    warm start until the finest level (this problem) is solved
+
                 :Example
                         dict = {"optimal_fluence": [..],
                         "inf_matrix": my_plan.inf_marix
@@ -339,8 +552,17 @@ class Optimization(object):
 
                 :return: solution dictionary, cvxpy problem instance(optional)
                 """
-
-        problem = cp.Problem(cp.Minimize(cp.sum(self.obj)), constraints=self.constraints)
+        if pyramid is not None:
+            x0 = self._solve_coarse_levels(pyramid, x0, *args, **kwargs)
+        if x0 is not None:
+            self.vars['x'].value = np.maximum(np.asarray(x0, dtype=float), 0)
+            if self._dose_voxels is not None:
+                self.vars['d'].value = self.inf_matrix.A[self._dose_voxels, :] @ self.vars['x'].value
+            kwargs.setdefault('warm_start', True)
+        if str(kwargs.get('solver', '')).lower() == 'portpy-fista':
+            return self._solve_fista(x0=x0, return_solver=return_cvxpy_prob, **kwargs)
+
+        problem = self._get_problem()
         print('Running Optimization..')
         t = time.time()
         # Check if 'solver' is passed in args
@@ -369,6 +591,118 @@ class Optimization(object):
         else:
             return sol
 
+    def _get_problem(self) -> cp.Problem:
+        """
+        Get cvxpy problem. Problem is created again only if objective functions or constraints are added or removed, so
+        that cvxpy reuses the compiled problem when only the parameters are updated
+        """
+        key = (tuple(map(id, self.obj)), tuple(map(id, self.constraints)))
+        if self._problem is None or self._problem_key != key:
+            self._problem = cp.Problem(cp.Minimize(cp.sum(self.obj)), constraints=self.constraints)
+            self._problem_key = key
+        return self._problem
+
+    def create_fista_solver(self) -> FistaSolver:
+        """
+        Create FistaSolver for the problem defined by opt_params and clinical criteria i.e. quadratic, quadratic-overdose,
+        quadratic-underdose and smoothness-quadratic objectives and max/mean dose constraints. Current values of the
+        parameters (see update_params) are used
+
+        :return: object of FistaSolver
+        """
+        inf_matrix = self.inf_matrix
+        st = inf_matrix
+        my_plan = self.my_plan
+        opt_params = self.opt_params
+        obj_funcs = opt_params['objective_functions'] if 'objective_functions' in opt_params else []
+        num_fractions = self.clinical_criteria.get_num_of_fractions()
+        constraint_def = self._get_constraint_def(opt_params, self.clinical_criteria)
+        obj_names, constraint_names, values = self._get_param_specs(obj_funcs, constraint_def)
+        params = self.params
+        # use values of cvxpy parameters if problem is created
+        values = {name: params[name].value if name in params else value for name, value in values.items()}
+
+        solver = FistaSolver(inf_matrix.A, A_op=inf_matrix.A_op)
+        penalty = {'quadratic-overdose': 'overdose', 'quadratic-underdose': 'underdose', 'quadratic': 'quadratic'}
+        for i in range(len(obj_funcs)):
+            if obj_names[i] is None:
+                continue
+            weight = values[obj_names[i]['weight']]
+            if obj_funcs[i]['type'] in penalty:
+                voxels = st.get_opt_voxels_idx(obj_funcs[i]['structure_name'])
+                if len(voxels) == 0:
+                    continue
+                dose_gy = values[obj_names[i]['dose_gy']] / num_fractions if 'dose_gy' in obj_names[i] else 0
+                solver.add_quadratic(voxels, weight=weight / len(voxels), dose=dose_gy,
+                                     penalty=penalty[obj_funcs[i]['type']])
+            elif obj_funcs[i]['type'] == 'smoothness-quadratic':
+                [Qx, Qy, num_rows, num_cols] = inf_matrix.get_smoothness_matrix()
+                solver.add_smoothness(Qx, weight=weight * 0.6 / num_cols)
+                solver.add_smoothness(Qy, weight=weight * 0.4 / num_rows)
+
+        for i in range(len(constraint_def)):
+            if constraint_names[i] is None:
+                continue
+            org = constraint_def[i]['parameters']['structure_name']
+            voxels = st.get_opt_voxels_idx(org)
+            if len(voxels) == 0:
+                continue
+            limit = values[constraint_names[i]['limit']] / num_fractions
+            if constraint_def[i]['type'] == 'max_dose':
+                solver.add_max(voxels, limit=limit)
+            elif constraint_def[i]['type'] == 'mean_dose':
+                vol = np.asarray(st.get_opt_voxels_volume_cc(org), dtype=float)
+                solver.add_mean(voxels, coef=vol / np.sum(vol),
+                                limit=limit / my_plan.structures.get_fraction_of_vol_in_calc_box(org))
+        return solver
+
+    def _solve_fista(self, x0: np.ndarray = None, return_solver: bool = False, **kwargs):
+        """
+        Solve the problem using FistaSolver. Objective functions and constraints added after create_cvxpy_problem()
+        are not supported
+        """
+        if self._num_problem_terms is not None and self._num_problem_terms != (len(self.obj), len(self.constraints)):
+            print('Warning: objective functions and constraints added after create_cvxpy_problem() are ignored by '
+                  'portpy-fista solver')
+        options = {key: kwargs[key] for key in ['max_iter', 'max_inner_iter', 'max_outer_iter', 'tol', 'feas_tol', 'rho',
+                                                 'verbose'] if key in kwargs}
+        solver = self.create_fista_solver()
+        print('Running Optimization..')
+        t = time.time()
+        x = solver.solve(x0=x0, **options)
+        elapsed = time.time() - t
+        self.vars['x'].value = x
+        self.obj_value = solver.objective(x)
+        self.solver_history = solver.history
+        print("Optimal value: %s" % self.obj_value)
+        print("Elapsed time: {} seconds".format(elapsed))
+        sol = {'optimal_intensity': x, 'inf_matrix': self.inf_matrix}
+        if return_solver:
+            return sol, solver
+        return sol
+
+    def _solve_coarse_levels(self, pyramid: InfluenceMatrixPyramid, x0: np.ndarray = None, *args, **kwargs):
+        """
+        Solve the coarser levels of the pyramid and return the solution prolonged to the finest level
+        """
+        if pyramid.get_level(-1).A.shape[1] != self.inf_matrix.A.shape[1]:
+            raise ValueError('finest level of the pyramid should be the influence matrix of the problem')
+        if x0 is not None:
+            x0 = pyramid.restrict(x0, level=-1, to_level=0)
+        for level in range(pyramid.num_levels - 1):
+            print('Solving level {} of pyramid..'.format(level))
+            opt = Optimization(self.my_plan, inf_matrix=pyramid.get_level(level),
+                               clinical_criteria=self.clinical_criteria, opt_params=self.opt_params)
+            if str(kwargs.get('solver', '')).lower() != 'portpy-fista':
+                opt.create_cvxpy_problem()
+            sol = opt.solve(False, *args, x0=x0, **kwargs)
+            if sol['optimal_intensity'] is None:
+                print('Warning: level {} of pyramid is not solved. Solving next level without warm start'.format(level))
+                x0 = None
+            else:
+                x0 = pyramid.prolong(sol['optimal_intensity'], level=level)
+        return x0
+
     def get_sol(self) -> dict:
         """
         Return optimal solution and influence matrix associated with it in the form of dictionary
@@ -433,14 +767,14 @@ class Optimization(object):
         self.add_constraints(constraints=constraints)
 
     @staticmethod
-    def get_smoothness_matrix(beamReq: List[dict]) -> (np.ndarray, np.ndarray, int, int):
+    def get_smoothness_matrix(beamReq: List[dict]) -> (csr_matrix, csr_matrix, int, int):
         """
         Create smoothness matrix so that adjacent beamlets are smooth out to reduce MU
 
         :param beamReq: beamlets dictionary from the object of influence matrix class
-        :returns: tuple(Qx, Qy) where
-            Qx: first matrix have values 1 and -1 for neighbouring beamlets in X direction
-            Qy: second matrix with values 1 and -1 for neighbouring beamlets in Y direction
+        :returns: tuple(Qx, Qy, num_rows, num_cols) where
+            Qx: first sparse matrix have values 1 and -1 for neighbouring beamlets in X direction
+            Qy: second sparse matrix with values 1 and -1 for neighbouring beamlets in Y direction
 
         :Example:
         Qx = [[1 -1 0 0 0 0]
@@ -448,53 +782,7 @@ class Optimization(object):
               [0 0 0 0 1 -1]]
 
         """
-        sRow = np.zeros((beamReq[-1]['end_beamlet_idx'] + 1, beamReq[-1]['end_beamlet_idx'] + 1), dtype=int)
-        sCol = np.zeros((beamReq[-1]['end_beamlet_idx'] + 1, beamReq[-1]['end_beamlet_idx'] + 1), dtype=int)
-        num_rows = 0
-        num_cols = 0
-        for b in range(len(beamReq)):
-            beam_map = beamReq[b]['beamlet_idx_2d_finest_grid']
-
-            rowsNoRepeat = [0]
-            for i in range(1, np.size(beam_map, 0)):
-                if (beam_map[i, :] != beam_map[rowsNoRepeat[-1], :]).any():
-                    rowsNoRepeat.append(i)
-            colsNoRepeat = [0]
-            for j in range(1, np.size(beam_map, 1)):
-                if (beam_map[:, j] != beam_map[:, colsNoRepeat[-1]]).any():
-                    colsNoRepeat.append(j)
-            beam_map = beam_map[np.ix_(np.asarray(rowsNoRepeat), np.asarray(colsNoRepeat))]
-            num_rows = num_rows + beam_map.shape[0]
-            num_cols = num_cols + beam_map.shape[1]
-            for r in range(np.size(beam_map, 0)):
-                startCol = 0
-                endCol = np.size(beam_map, 1) - 2
-                while (beam_map[r, startCol] == -1) and (startCol <= endCol):
-                    startCol = startCol + 1
-                while (beam_map[r, endCol] == -1) and (startCol <= endCol):
-                    endCol = endCol - 1
-
-                for c in range(startCol, endCol + 1):
-                    ind = beam_map[r, c]
-                    RN = beam_map[r, c + 1]
-                    if ind * RN >= 0:
-                        sRow[ind, ind] = int(1)
-                        sRow[ind, RN] = int(-1)
-
-            for c in range(np.size(beam_map, 1)):
-                startRow = 0
-                endRow = np.size(beam_map, 0) - 2
-                while (beam_map[startRow, c] == -1) and (startRow <= endRow):
-                    startRow = startRow + 1
-                while (beam_map[endRow, c] == -1) and (startRow <= endRow):
-                    endRow = endRow - 1
-                for r in range(startRow, endRow + 1):
-                    ind = beam_map[r, c]
-                    DN = beam_map[r + 1, c]
-                    if ind * DN >= 0:
-                        sCol[ind, ind] = int(1)
-                        sCol[ind, DN] = int(-1)
-        return sRow, sCol, num_rows, num_cols
+        return create_smoothness_matrix(beamReq)
 
     def create_cvxpy_problem_correction(self, d=None, delta=None):
         """
@@ -561,7 +849,7 @@ class Optimization(object):
                         continue
                     obj += [(1 / len(st.get_opt_voxels_idx(struct))) * (obj_funcs[i]['weight'] * cp.sum_squares(d[st.get_opt_voxels_idx(struct)] + delta[st.get_opt_voxels_idx(struct)]))]
             elif obj_funcs[i]['type'] == 'smoothness-quadratic':
-                [Qx, Qy, num_rows, num_cols] = self.get_smoothness_matrix(inf_matrix.beamlets_dict)
+                [Qx, Qy, num_rows, num_cols] = inf_matrix.get_smoothness_matrix()
                 smoothness_X_weight = 0.6
                 smoothness_Y_weight = 0.4
                 obj += [obj_funcs[i]['weight'] * (smoothness_X_weight * (1 / num_cols) * cp.sum_squares(Qx @ x) +
@@ -42,6 +42,7 @@ class Structures:
         self.structures_dict = structures_dict
         self.opt_voxels_dict = opt_voxels_dict
         self.opt_voxels_dict['name'] = structures_dict['name']
+        self.patient_id = data.patient_id
         self._ct_voxel_resolution_xyz_mm = deepcopy(self.opt_voxels_dict['ct_voxel_resolution_xyz_mm'])
         self.preprocess_structures()
 
@@ -8,3 +8,12 @@ from .convert_dose_rt_dicom_to_portpy import convert_dose_rt_dicom_to_portpy
 from .leaf_sequencing_siochi import leaf_sequencing_siochi
 from .write_rt_plan_imrt import write_rt_plan_imrt
 from .write_rt_plan_vmat import write_rt_plan_vmat
+from .lazy_h5_list import LazyH5List, H5ResidentCache, H5Ref
+from .h5_csr import read_csr_from_triplets, read_csr_from_h5, write_csr_to_h5
+from .inf_matrix_cache import InfluenceMatrixCache
+from .beam_map import create_beamlet_idx_2d_finest_grid, create_beamlet_idx_2d_orig_grid, renumber_beamlets, \
+    remove_repeated_rows_cols, beam_map_1d_to_2d, beam_map_2d_to_1d, group_beamlets, create_smoothness_matrix
+from .shared_copy import shared_copy
+from .parallel_spmv import ParallelSpMV
+from .low_rank import LowRankMatrix, randomized_svd
+from .fista_solver import FistaSolver
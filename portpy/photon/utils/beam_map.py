@@ -0,0 +1,223 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from typing import List
+
+
+def create_beamlet_idx_2d_finest_grid(beamlets: dict, finest_res_mm: float = 2.5) -> np.ndarray:
+    """
+    Create 2d grid for the beamlets where each element is finest_res_mm*finest_res_mm from x and y coordinates of
+    beamlets. Each element contains the index of the beamlet covering it and -1 if it is not covered by any beamlet.
+
+    The top left corner of each beamlet is quantized to the grid and its footprint (width_mm*height_mm) is scattered
+    directly into the grid. If footprints overlap, the beamlet whose corner comes later in row-major order of the grid
+    is kept.
+
+    :param beamlets: dictionary of beamlets for the beam containing position_x_mm, position_y_mm, width_mm, height_mm
+    :param finest_res_mm: resolution of the grid in mm. Default to 2.5
+    :return: 2d grid of beamlets for the beam
+    """
+    widths = np.ravel(beamlets['width_mm'][0])
+    heights = np.ravel(beamlets['height_mm'][0])
+    x_positions = np.ravel(beamlets['position_x_mm'][0]) - widths / 2  # x position is center of beamlet. Get left corner
+    y_positions = np.ravel(beamlets['position_y_mm'][0]) + heights / 2  # y position is center of beamlet. Get top corner
+    right_ind = np.argmax(x_positions)
+    bottom_ind = np.argmin(y_positions)
+    x_coord = np.arange(np.min(x_positions), np.max(x_positions) + widths[right_ind], finest_res_mm)
+    y_coord = np.arange(np.max(y_positions), np.min(y_positions) - heights[bottom_ind], -finest_res_mm)
+    num_rows, num_cols = len(y_coord), len(x_coord)
+
+    # quantize top left corners to grid and keep the beamlets whose corners lie exactly on the grid
+    cols = np.rint((x_positions - x_coord[0]) / finest_res_mm).astype(int)
+    rows = np.rint((y_coord[0] - y_positions) / finest_res_mm).astype(int)
+    valid = (cols >= 0) & (cols < num_cols) & (rows >= 0) & (rows < num_rows)
+    valid[valid] = (x_coord[cols[valid]] == x_positions[valid]) & (y_coord[rows[valid]] == y_positions[valid])
+    b_ind = np.flatnonzero(valid)
+
+    # if several beamlets have the same corner, keep the first one
+    corner = rows[b_ind] * num_cols + cols[b_ind]
+    corner, first = np.unique(corner, return_index=True)
+    b_ind = b_ind[first]
+
+    # scatter the footprints. rank of the corner in row-major order decides which beamlet covers each element
+    rank_grid = np.full(num_rows * num_cols, -1, dtype=np.int64)
+    num_width = (widths[b_ind] / finest_res_mm).astype(int)
+    num_height = (heights[b_ind] / finest_res_mm).astype(int)
+    for h, w in set(zip(num_height.tolist(), num_width.tolist())):
+        if h <= 0 or w <= 0:
+            continue
+        sel = np.flatnonzero((num_height == h) & (num_width == w))
+        r = rows[b_ind[sel]][:, None, None] + np.arange(h)[None, :, None]
+        c = cols[b_ind[sel]][:, None, None] + np.arange(w)[None, None, :]
+        r, c = np.broadcast_arrays(r, c)
+        rank = np.broadcast_to(corner[sel][:, None, None], r.shape)
+        inside = (r < num_rows) & (c < num_cols)
+        np.maximum.at(rank_grid, r[inside] * num_cols + c[inside], rank[inside])
+
+    beamlet_idx_2d_finest_grid = np.full(num_rows * num_cols, -1, dtype=int)
+    covered = rank_grid >= 0
+    beamlet_idx_2d_finest_grid[covered] = b_ind[np.searchsorted(corner, rank_grid[covered])]
+    return beamlet_idx_2d_finest_grid.reshape(num_rows, num_cols)
+
+
+def create_beamlet_idx_2d_orig_grid(beamlets: dict) -> np.ndarray:
+    """
+    Create beam map 2d grid in the original resolution where each element in matrix is the size of respective beamlet.
+    Rows and columns of the grid are the unique y (descending) and x (ascending) positions of the beamlet centers.
+    Elements without any beamlet are -1.
+
+    :param beamlets: dictionary of beamlets for the beam containing position_x_mm and position_y_mm
+    :return: beam map 2d grid in original resolution
+    """
+    x_positions = np.ravel(beamlets['position_x_mm'][0])
+    y_positions = np.ravel(beamlets['position_y_mm'][0])
+    x_min_max_sort = np.unique(x_positions)
+    y_min_max_sort = np.unique(y_positions)
+    cols = np.searchsorted(x_min_max_sort, x_positions)
+    rows = len(y_min_max_sort) - 1 - np.searchsorted(y_min_max_sort, y_positions)
+    beam_map = np.full(len(y_min_max_sort) * len(x_min_max_sort), np.iinfo(int).max, dtype=int)
+    # keep the first beamlet if several beamlets have the same position
+    np.minimum.at(beam_map, rows * len(x_min_max_sort) + cols, np.arange(len(x_positions)))
+    beam_map[beam_map == np.iinfo(int).max] = -1
+    return beam_map.reshape(len(y_min_max_sort), len(x_min_max_sort))
+
+
+def renumber_beamlets(beam_map: np.ndarray) -> np.ndarray:
+    """
+    Renumber the beamlets in beam map to be continuous from 0 while keeping their order. Elements with negative
+    values (no beamlet) are not changed
+
+    :param beam_map: 2d grid of beamlets
+    :return: beam map with continuous beamlet indices
+    """
+    valid = beam_map >= 0
+    map_copy = beam_map.copy()
+    _, inverse = np.unique(beam_map[valid], return_inverse=True)
+    map_copy[valid] = inverse
+    return map_copy
+
+
+def remove_repeated_rows_cols(beam_map: np.ndarray) -> np.ndarray:
+    """
+    Remove rows and columns which are same as the previous row/column of the beam map. It converts beam map in finest
+    resolution to the resolution of the beamlets
+
+    :param beam_map: 2d grid of beamlets
+    :return: beam map without repeated rows and columns
+    """
+    keep_rows = np.ones(beam_map.shape[0], dtype=bool)
+    keep_rows[1:] = np.any(beam_map[1:, :] != beam_map[:-1, :], axis=1)
+    keep_cols = np.ones(beam_map.shape[1], dtype=bool)
+    keep_cols[1:] = np.any(beam_map[:, 1:] != beam_map[:, :-1], axis=0)
+    return beam_map[np.ix_(keep_rows, keep_cols)]
+
+
+def beam_map_1d_to_2d(beam_map: np.ndarray, values_1d: np.ndarray, offset: int = 0) -> np.ndarray:
+    """
+    Create 2d map from the values of the beamlets. Element (r, c) of the map is values_1d[beam_map[r, c] - offset]
+    and 0 if there is no beamlet
+
+    :param beam_map: 2d grid of beamlets
+    :param values_1d: values of the beamlets e.g. fluence
+    :param offset: index of the first beamlet in values_1d. Default to 0
+    :return: 2d map of values
+    """
+    valid = beam_map >= 0
+    values_2d = np.zeros(beam_map.shape, dtype=np.result_type(values_1d, float))
+    values_2d[valid] = values_1d[beam_map[valid] - offset]
+    return values_2d
+
+
+def beam_map_2d_to_1d(beam_map: np.ndarray, values_2d: np.ndarray, values_1d: np.ndarray, offset: int = 0) -> np.ndarray:
+    """
+    Set the values of the beamlets from 2d map. values_1d[beam_map[r, c] - offset] is set to values_2d[r, c]. If a
+    beamlet covers several elements, the value of its last element in row-major order is used
+
+    :param beam_map: 2d grid of beamlets
+    :param values_2d: 2d map of values e.g. fluence
+    :param values_1d: values of the beamlets which are updated in place
+    :param offset: index of the first beamlet in values_1d. Default to 0
+    :return: values_1d
+    """
+    flat_map = beam_map.ravel()
+    cells = np.flatnonzero(flat_map >= 0)
+    # keep the last element of each beamlet in row-major order
+    beamlets, last = np.unique(flat_map[cells][::-1], return_index=True)
+    cells = cells[::-1][last]
+    values_1d[beamlets - offset] = np.ravel(values_2d)[cells]
+    return values_1d
+
+
+def group_beamlets(beamlets: np.ndarray, group_ids: np.ndarray) -> list:
+    """
+    Group the elements by beamlet. It is used to find the elements of the finest grid covered by each down sampled
+    beamlet
+
+    :param beamlets: beamlet of each element
+    :param group_ids: sorted unique beamlets to be grouped
+    :return: list of arrays containing positions of the elements (in increasing order) for each beamlet in group_ids
+    """
+    if len(group_ids) == 0:
+        return []
+    order = np.argsort(beamlets, kind='stable')
+    sorted_beamlets = beamlets[order]
+    start = np.searchsorted(sorted_beamlets, group_ids, side='left')
+    end = np.searchsorted(sorted_beamlets, group_ids, side='right')
+    return [order[i:j] for i, j in zip(start, end)]
+
+
+def _smoothness_assignments(beam_map: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+    # elements (row, col, value) set for the horizontally neighbouring beamlets of each row of the beam map in the
+    # order they are visited (row by row). For each row, pairs (c, c + 1) are used for c between the first and last
+    # beamlet in columns 0 to n - 2. Each pair with beam_map[r, c] * beam_map[r, c + 1] >= 0 sets (ind, ind) to 1
+    # and (ind, right neighbour) to -1
+    left = beam_map[:, :-1].astype(np.int64)
+    right = beam_map[:, 1:].astype(np.int64)
+    valid = left != -1
+    if valid.size == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    cols = np.arange(left.shape[1])
+    start = np.argmax(valid, axis=1)
+    end = left.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+    in_range = valid.any(axis=1)[:, None] & (cols[None, :] >= start[:, None]) & (cols[None, :] <= end[:, None])
+    mask = in_range & (left * right >= 0)
+    ind, neighbour = left[mask], right[mask]
+    rows = np.column_stack([ind, ind]).ravel()
+    cols = np.column_stack([ind, neighbour]).ravel()
+    values = np.tile([1, -1], len(ind))
+    return rows, cols, values
+
+
+def create_smoothness_matrix(beamlets: List[dict]) -> (csr_matrix, csr_matrix, int, int):
+    """
+    Create sparse smoothness matrices Qx and Qy with values 1 and -1 for neighbouring beamlets in X and Y direction
+    directly from the beam maps of the beams. Beam maps are converted to the resolution of the beamlets using
+    remove_repeated_rows_cols.
+
+    If an element is set more than once, the last assignment is kept and negative index (-1 for empty cell of beam
+    map) refers to the last beamlet, same as assigning the elements of dense matrix in loops.
+
+    :param beamlets: beamlets dictionary from the object of influence matrix class
+    :return: Qx, Qy, number of rows and number of columns of the beam maps
+    """
+    num_beamlets = beamlets[-1]['end_beamlet_idx'] + 1
+    num_rows = 0
+    num_cols = 0
+    assignments = {'x': [], 'y': []}
+    for beam in beamlets:
+        beam_map = remove_repeated_rows_cols(beam['beamlet_idx_2d_finest_grid'])
+        num_rows = num_rows + beam_map.shape[0]
+        num_cols = num_cols + beam_map.shape[1]
+        assignments['x'].append(_smoothness_assignments(beam_map))
+        assignments['y'].append(_smoothness_assignments(beam_map.T))
+
+    Q = []
+    for direction in ['x', 'y']:
+        rows, cols, values = [np.concatenate(arr) for arr in zip(*assignments[direction])]
+        rows = np.where(rows < 0, rows + num_beamlets, rows)
+        cols = np.where(cols < 0, cols + num_beamlets, cols)
+        # keep last assignment of each element
+        _, last = np.unique((rows * num_beamlets + cols)[::-1], return_index=True)
+        last = len(rows) - 1 - last
+        Q.append(csr_matrix((values[last].astype(int), (rows[last], cols[last])), shape=(num_beamlets, num_beamlets)))
+    return Q[0], Q[1], num_rows, num_cols
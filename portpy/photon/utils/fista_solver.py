@@ -0,0 +1,315 @@
+import time
+import numpy as np
+from scipy import sparse
+
+
+class FistaSolver:
+    """
+    First-order solver for fluence map optimization problems with quadratic dose objectives, max/mean dose
+    constraints and nonnegative fluence, working directly with the influence matrix A.
+
+    The problem is defined on the dose d = A @ x (per fraction)::
+
+        minimize    sum_k w_k * ||phi_k(d[v_k])||^2 + sum_s w_s * ||Q_s @ x||^2
+        subject to  d[v_j] <= L_j                      (max dose)
+                    c_j @ d[v_j] <= L_j                (mean dose)
+                    x >= 0
+
+    where phi_k is d - t_k (overdose, only positive part), t_k - d (underdose, only positive part) or d (quadratic).
+    Constraints are handled using augmented Lagrangian (dual updates with increasing penalty) and each subproblem is
+    solved using accelerated projected gradient (FISTA) with adaptive restart, backtracking step size and diagonal
+    (Jacobi) preconditioning.
+    Each iteration needs one product A @ x and one product A.T @ y, so memory needed by the solver is small compared
+    to interior point solvers. The solution is approximate and the solver usually needs thousands of iterations.
+    Conic solvers of cvxpy may be faster for small problems (see examples/python_files/fista_solver_benchmark.py).
+
+    :param A: influence matrix of shape (voxels x beamlets). If it is numpy array or sparse matrix, it is used for
+        the diagonal preconditioner. Otherwise, it should support the products A @ x and A.T @ y
+    :param A_op: linear operator used for the products e.g. InfluenceMatrix.A_op. defaults to A
+
+    :Example:
+    >>> solver = FistaSolver(inf_matrix.A, A_op=inf_matrix.A_op)
+    >>> solver.add_quadratic(voxels=ptv_voxels, weight=1, dose=2, penalty='overdose')
+    >>> solver.add_max(voxels=cord_voxels, limit=1.5)
+    >>> x = solver.solve()
+    """
+
+    def __init__(self, A, A_op=None):
+        self.A = A if A_op is None else A_op
+        # square of elements of A for diagonal preconditioner
+        if sparse.issparse(A):
+            self._A_squared = sparse.csr_matrix(A).multiply(A).tocsr()
+        elif isinstance(A, np.ndarray):
+            self._A_squared = A ** 2
+        else:
+            self._A_squared = None
+        self.num_voxels, self.num_beamlets = A.shape
+        self.quad_terms = []
+        self.smooth_terms = []
+        self.max_constraints = []
+        self.mean_constraints = []
+        self.history = None
+        self._terms = None
+
+    def add_quadratic(self, voxels: np.ndarray, weight: float, dose: float = 0, penalty: str = 'quadratic'):
+        """
+        Add w * ||phi(d[voxels])||^2 to the objective
+
+        :param voxels: voxel indices (rows of A)
+        :param weight: weight of the term
+        :param dose: dose threshold for overdose and underdose penalties
+        :param penalty: 'quadratic', 'overdose' or 'underdose'
+        """
+        if penalty not in ['quadratic', 'overdose', 'underdose']:
+            raise ValueError("penalty should be 'quadratic', 'overdose' or 'underdose'. Got {}".format(penalty))
+        self.quad_terms.append({'voxels': np.asarray(voxels, dtype=int), 'weight': float(weight),
+                                'dose': float(dose), 'penalty': penalty})
+        self._terms = None
+
+    def add_smoothness(self, Q, weight: float):
+        """
+        Add w * ||Q @ x||^2 to the objective
+
+        :param Q: matrix of shape (k x beamlets)
+        :param weight: weight of the term
+        """
+        self.smooth_terms.append({'Q': sparse.csr_matrix(Q, dtype=float), 'weight': float(weight)})
+
+    def add_max(self, voxels: np.ndarray, limit: float):
+        """
+        Add constraint d[voxels] <= limit
+        """
+        self.max_constraints.append({'voxels': np.asarray(voxels, dtype=int), 'limit': float(limit)})
+        self._terms = None
+
+    def add_mean(self, voxels: np.ndarray, coef: np.ndarray, limit: float):
+        """
+        Add constraint coef @ d[voxels] <= limit
+        """
+        self.mean_constraints.append({'voxels': np.asarray(voxels, dtype=int), 'coef': np.asarray(coef, dtype=float),
+                                      'limit': float(limit)})
+        self._terms = None
+
+    def _get_terms(self) -> dict:
+        """
+        Concatenate voxels, weights and dose thresholds of the quadratic terms and limits of the constraints, so that
+        they are evaluated together in each iteration. Mean constraints are saved as sparse matrix C (constraints x
+        voxels) with coef in the rows. It is created again if terms or constraints are added
+        """
+        if self._terms is not None:
+            return self._terms
+        sizes = [len(term['voxels']) for term in self.quad_terms]
+        penalties = [term['penalty'] for term in self.quad_terms]
+        rows = np.repeat(np.arange(len(self.mean_constraints)), [len(con['voxels']) for con in self.mean_constraints])
+        self._terms = {
+            'quad_voxels': np.concatenate([term['voxels'] for term in self.quad_terms] + [np.zeros(0, dtype=int)]),
+            'quad_weight': np.repeat(np.array([term['weight'] for term in self.quad_terms], dtype=float), sizes),
+            'quad_dose': np.repeat(np.array([0 if term['penalty'] == 'quadratic' else term['dose']
+                                             for term in self.quad_terms], dtype=float), sizes),
+            # residuals are clipped to [lower, upper] e.g. [0, inf] for overdose
+            'quad_lower': np.repeat(np.array([0 if p == 'overdose' else -np.inf for p in penalties]), sizes),
+            'quad_upper': np.repeat(np.array([0 if p == 'underdose' else np.inf for p in penalties]), sizes),
+            'max_voxels': np.concatenate([con['voxels'] for con in self.max_constraints] + [np.zeros(0, dtype=int)]),
+            'max_limits': np.concatenate([np.full(len(con['voxels']), con['limit']) for con in self.max_constraints] +
+                                         [np.zeros(0)]),
+            'mean_matrix': sparse.csr_matrix(
+                (np.concatenate([con['coef'] for con in self.mean_constraints] + [np.zeros(0)]),
+                 (rows, np.concatenate([con['voxels'] for con in self.mean_constraints] + [np.zeros(0, dtype=int)]))),
+                shape=(len(self.mean_constraints), self.num_voxels)),
+            'mean_limits': np.array([con['limit'] for con in self.mean_constraints], dtype=float)}
+        return self._terms
+
+    def objective(self, x: np.ndarray, d: np.ndarray = None) -> float:
+        """
+        :param x: fluence
+        :param d: dose A @ x. It is computed if not given
+        :return: objective value
+        """
+        if d is None:
+            d = self.A @ x
+        return self._evaluate(x, d, lam=np.zeros(0), rho=1)[1]
+
+    def constraint_values(self, d: np.ndarray) -> np.ndarray:
+        """
+        :param d: dose A @ x
+        :return: g(x) of all the constraints g(x) <= 0. Max constraints (one for each voxel) followed by mean
+            constraints
+        """
+        terms = self._get_terms()
+        return np.concatenate([d[terms['max_voxels']] - terms['max_limits'],
+                               terms['mean_matrix'] @ d - terms['mean_limits']])
+
+    def _evaluate(self, x: np.ndarray, d: np.ndarray, lam: np.ndarray, rho: float) -> tuple:
+        # augmented lagrangian value, objective value, residuals of the quadratic terms and constraint values.
+        # residuals are d - t (overdose, only positive part), d - t (underdose, only negative part) or d (quadratic)
+        terms = self._get_terms()
+        r = d[terms['quad_voxels']] - terms['quad_dose']
+        np.maximum(r, terms['quad_lower'], out=r)
+        np.minimum(r, terms['quad_upper'], out=r)
+        objective = float(terms['quad_weight'] @ (r * r))
+        for term in self.smooth_terms:
+            objective += term['weight'] * float(np.sum((term['Q'] @ x) ** 2))
+        g = self.constraint_values(d)
+        value = objective
+        if len(lam) > 0:
+            value += np.sum(np.maximum(lam + rho * g, 0) ** 2 - lam ** 2) / (2 * rho)
+        return value, objective, r, g
+
+    def _gradient(self, x: np.ndarray, r: np.ndarray, g: np.ndarray, lam: np.ndarray, rho: float) -> np.ndarray:
+        # gradient of the augmented lagrangian using the residuals and constraint values from _evaluate()
+        terms = self._get_terms()
+        grad_d = np.bincount(terms['quad_voxels'], weights=2 * terms['quad_weight'] * r, minlength=self.num_voxels)
+        if len(lam) > 0:
+            p = np.maximum(lam + rho * g, 0)
+            num_max = len(terms['max_voxels'])
+            grad_d += np.bincount(terms['max_voxels'], weights=p[:num_max], minlength=self.num_voxels)
+            grad_d += terms['mean_matrix'].T @ p[num_max:]
+        grad = np.asarray(self.A.T @ grad_d).ravel()
+        for term in self.smooth_terms:
+            grad += 2 * term['weight'] * (term['Q'].T @ (term['Q'] @ x))
+        return grad
+
+    def _preconditioner(self, rho: float) -> np.ndarray:
+        # inverse of diagonal of the upper bound of the hessian of the augmented lagrangian
+        if self._A_squared is None:
+            return np.ones(self.num_beamlets)
+        terms = self._get_terms()
+        h = np.bincount(terms['quad_voxels'], weights=2 * terms['quad_weight'], minlength=self.num_voxels)
+        h += rho * np.bincount(terms['max_voxels'], minlength=self.num_voxels)
+        diag = np.asarray(self._A_squared.T @ h).ravel()
+        for con in self.mean_constraints:
+            diag += rho * np.asarray(self.A.T @ _scatter(con['coef'], con['voxels'], self.num_voxels)).ravel() ** 2
+        for term in self.smooth_terms:
+            diag += 2 * term['weight'] * np.asarray(term['Q'].multiply(term['Q']).sum(axis=0)).ravel()
+        return 1 / np.maximum(diag, 1e-12 * max(diag.max(initial=0), np.finfo(float).tiny))
+
+    def _hessian_product(self, v: np.ndarray, rho: float) -> np.ndarray:
+        # product of v with upper bound of the hessian of the augmented lagrangian (all hinge terms active)
+        d = np.asarray(self.A @ v).ravel()
+        terms = self._get_terms()
+        h = np.bincount(terms['quad_voxels'], weights=2 * terms['quad_weight'] * d[terms['quad_voxels']],
+                        minlength=self.num_voxels)
+        h += rho * np.bincount(terms['max_voxels'], weights=d[terms['max_voxels']], minlength=self.num_voxels)
+        h += rho * (terms['mean_matrix'].T @ (terms['mean_matrix'] @ d))
+        hv = np.asarray(self.A.T @ h).ravel()
+        for term in self.smooth_terms:
+            hv += 2 * term['weight'] * (term['Q'].T @ (term['Q'] @ v))
+        return hv
+
+    def _lipschitz(self, rho: float, precond: np.ndarray, num_iter: int = 20, seed: int = 0) -> float:
+        # lipschitz constant of the gradient of the preconditioned augmented lagrangian using power iteration
+        scale = np.sqrt(precond)
+        v = np.random.default_rng(seed).random(self.num_beamlets)
+        v /= np.linalg.norm(v)
+        eig = 0
+        for _ in range(num_iter):
+            w = scale * self._hessian_product(scale * v, rho)
+            eig = np.linalg.norm(w)
+            if eig == 0:
+                break
+            v = w / eig
+        # safety margin for the error of power iteration
+        return max(1.1 * eig, np.finfo(float).tiny)
+
+    def solve(self, x0: np.ndarray = None, max_iter: int = 5000, max_inner_iter: int = 200, max_outer_iter: int = 50,
+              tol: float = 1e-3, feas_tol: float = 1e-3, rho: float = None, verbose: bool = False) -> np.ndarray:
+        """
+        Solve the problem
+
+        :param x0: initial fluence. defaults to zeros
+        :param max_iter: maximum number of FISTA iterations in total
+        :param max_inner_iter: maximum number of FISTA iterations for each augmented lagrangian subproblem
+        :param max_outer_iter: maximum number of augmented lagrangian (dual) updates
+        :param tol: FISTA iterations of a subproblem are stopped when the projected gradient step is reduced to tol
+            times the first step of the subproblem. Iterations are stopped when constraints are satisfied and the
+            subproblem is solved or relative change of the objective between dual updates is less than tol
+        :param feas_tol: tolerance on constraint violation relative to the limit
+        :param rho: initial penalty of the constraints. defaults to the largest curvature of the objective
+        :param verbose: print convergence metrics
+        :return: optimal fluence. Convergence metrics of each iteration are saved in attribute history
+        """
+        terms = self._get_terms()
+        limits = np.concatenate([terms['max_limits'], terms['mean_limits']])
+        limit_scale = np.maximum(np.abs(limits), 1e-6)
+        lam = np.zeros(len(limits))
+
+        if rho is None:
+            curvature = [2 * term['weight'] for term in self.quad_terms]
+            rho = max(curvature) if len(curvature) > 0 else 1
+        max_rho = rho * 1e4
+        x = np.zeros(self.num_beamlets) if x0 is None else np.maximum(np.asarray(x0, dtype=float), 0)
+        d = np.asarray(self.A @ x).ravel()
+
+        self.history = {'iteration': [], 'outer_iteration': [], 'objective': [], 'max_violation': [],
+                        'rel_change': [], 'rho': [], 'time': []}
+        t_start = time.time()
+        prev_violation, prev_objective = np.inf, np.inf
+        it = 0
+        for outer in range(max_outer_iter):
+            precond = self._preconditioner(rho)
+            # lipschitz constant assuming all the hinge terms are active. Step is increased while sufficient decrease
+            # condition holds and decreased (backtracking) otherwise
+            lipschitz_max = self._lipschitz(rho, precond)
+            lipschitz = lipschitz_max
+            y, d_y, x_prev, d_prev, t = x, d, x, d, 1
+            converged = False
+            first_grad_map = None
+            for inner in range(min(max_inner_iter, max_iter - it)):
+                it += 1
+                value_y, _, r_y, g_y = self._evaluate(y, d_y, lam, rho)
+                grad = self._gradient(y, r_y, g_y, lam, rho)
+                lipschitz = max(lipschitz / 1.5, lipschitz_max * 1e-6)
+                while True:
+                    x = np.maximum(y - precond / lipschitz * grad, 0)
+                    d = np.asarray(self.A @ x).ravel()
+                    dx = x - y
+                    value, objective, _, g = self._evaluate(x, d, lam, rho)
+                    if lipschitz >= lipschitz_max or \
+                            value <= value_y + grad @ dx + lipschitz / 2 * np.sum(dx ** 2 / precond):
+                        break
+                    lipschitz = min(2 * lipschitz, lipschitz_max)
+                # norm of projected gradient step in the preconditioned metric
+                grad_map = np.sqrt(lipschitz * np.sum(dx ** 2 / precond))
+                if first_grad_map is None:
+                    first_grad_map = max(grad_map, np.finfo(float).tiny)
+                rel_change = np.linalg.norm(x - x_prev) / max(np.linalg.norm(x), 1e-12)
+                violation = np.max(np.maximum(g, 0) / limit_scale, initial=0)
+                self._log(it, outer, objective, violation, rel_change, rho, time.time() - t_start, verbose)
+                if grad_map <= tol * first_grad_map or rel_change <= 1e-12:
+                    converged = True
+                    break
+                # adaptive restart if momentum is not in descent direction
+                if np.dot(y - x, x - x_prev) > 0:
+                    t = 1
+                t_next = (1 + np.sqrt(1 + 4 * t ** 2)) / 2
+                beta = (t - 1) / t_next
+                y = x + beta * (x - x_prev)
+                d_y = d + beta * (d - d_prev)  # A @ y without additional product
+                x_prev, d_prev, t = x, d, t_next
+            _, objective, _, g = self._evaluate(x, d, lam, rho)
+            violation = np.max(np.maximum(g, 0) / limit_scale, initial=0)
+            obj_change = abs(objective - prev_objective) / max(abs(objective), np.finfo(float).tiny)
+            if (violation <= feas_tol and (converged or obj_change <= tol)) or it >= max_iter or len(lam) == 0:
+                break
+            # dual update and increase penalty if violation does not decrease enough
+            lam = np.maximum(lam + rho * g, 0)
+            if violation > feas_tol and violation > 0.25 * prev_violation:
+                rho = min(10 * rho, max_rho)
+            prev_violation, prev_objective = violation, objective
+        if len(lam) > 0 and violation > feas_tol:
+            print('Warning: constraints are violated by {:.2e} (relative) after {} iterations'.format(violation, it))
+        return x
+
+    def _log(self, it, outer, objective, violation, rel_change, rho, elapsed, verbose):
+        for key, value in zip(['iteration', 'outer_iteration', 'objective', 'max_violation', 'rel_change', 'rho',
+                               'time'], [it, outer, objective, violation, rel_change, rho, elapsed]):
+            self.history[key].append(value)
+        if verbose and (it == 1 or it % 100 == 0):
+            print('iter {:6d}  outer {:3d}  objective {:.6e}  max violation {:.2e}  rel change {:.2e}  rho {:.1e}'
+                  .format(it, outer, objective, violation, rel_change, rho))
+
+
+def _scatter(values: np.ndarray, ind: np.ndarray, size: int) -> np.ndarray:
+    out = np.zeros(size)
+    out[ind] = values
+    return out
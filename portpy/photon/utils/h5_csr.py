@@ -0,0 +1,107 @@
+import os
+import h5py
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def read_csr_from_triplets(dset, chunk_rows: int = 2 ** 20, dtype=None) -> csr_matrix:
+    """
+    Create csr matrix from the (row, col, value) triplets dataset of sparse influence matrix in .h5 file.
+    The dataset is streamed in chunks and the csr arrays are assembled directly without creating the coo intermediate.
+    The shape of the matrix is inferred from the maximum row and column index.
+
+    :param dset: h5py dataset of shape N x 3 containing row index, column index and value
+    :param chunk_rows: number of triplets read at a time
+    :param dtype: data type of the matrix values. If None, data type of the dataset is used
+    :return: csr matrix
+    """
+    num_triplets = dset.shape[0]
+    if dtype is None:
+        dtype = dset.dtype
+    # first pass. count the non-zeros in each row and find the shape of the matrix
+    row_counts = np.zeros(0, dtype=np.int64)
+    num_rows, num_cols = 0, 0
+    for start in range(0, num_triplets, chunk_rows):
+        chunk = dset[start:start + chunk_rows]
+        rows = chunk[:, 0].astype(np.int64)
+        num_rows = max(num_rows, int(rows.max()) + 1)
+        num_cols = max(num_cols, int(chunk[:, 1].max()) + 1)
+        counts = np.bincount(rows)
+        if counts.size > row_counts.size:
+            counts[:row_counts.size] += row_counts
+            row_counts = counts
+        else:
+            row_counts[:counts.size] += counts
+    row_counts = np.pad(row_counts, (0, num_rows - row_counts.size))
+    idx_dtype = np.int32 if max(num_triplets, num_rows, num_cols) < np.iinfo(np.int32).max else np.int64
+    indptr = np.zeros(num_rows + 1, dtype=idx_dtype)
+    np.cumsum(row_counts, out=indptr[1:])
+
+    # second pass. scatter the column indices and values to their rows
+    indices = np.empty(num_triplets, dtype=idx_dtype)
+    data = np.empty(num_triplets, dtype=dtype)
+    next_pos = indptr[:-1].astype(np.int64)
+    for start in range(0, num_triplets, chunk_rows):
+        chunk = dset[start:start + chunk_rows]
+        rows = chunk[:, 0].astype(np.int64)
+        order = np.argsort(rows, kind='stable')
+        rows_sorted = rows[order]
+        first = np.searchsorted(rows_sorted, rows_sorted, side='left')
+        pos = next_pos[rows_sorted] + (np.arange(rows_sorted.size) - first)
+        indices[pos] = chunk[order, 1]
+        data[pos] = chunk[order, 2]
+        next_pos += np.bincount(rows, minlength=num_rows)
+    A = csr_matrix((data, indices, indptr), shape=(num_rows, num_cols))
+    A.sum_duplicates()
+    return A
+
+
+def write_csr_to_h5(filename: str, key: str, A: csr_matrix, source_file: str = None) -> None:
+    """
+    Save csr matrix in native layout (indptr, indices and data datasets) in .h5 file
+
+    :param filename: .h5 file to write
+    :param key: name of the group for the matrix
+    :param A: csr matrix
+    :param source_file: .h5 file from which the matrix is created. Its size and modification time are saved to detect
+        stale matrices
+    """
+    with h5py.File(filename, 'a') as f:
+        if key in f:
+            del f[key]
+        group = f.create_group(key)
+        group.create_dataset('indptr', data=A.indptr)
+        group.create_dataset('indices', data=A.indices)
+        group.create_dataset('data', data=A.data)
+        group.attrs['shape'] = A.shape
+        if source_file is not None:
+            stat = os.stat(source_file)
+            group.attrs['source_size'] = stat.st_size
+            group.attrs['source_mtime'] = stat.st_mtime
+
+
+def read_csr_from_h5(filename: str, key: str, source_file: str = None, dtype=None):
+    """
+    Read csr matrix saved using write_csr_to_h5
+
+    :param filename: .h5 file containing the matrix
+    :param key: name of the group for the matrix
+    :param source_file: .h5 file from which the matrix was created. If it is modified after the matrix was saved,
+        None is returned
+    :param dtype: data type of the matrix values. If None, saved data type is used
+    :return: csr matrix or None if the matrix is not found or stale
+    """
+    if not os.path.exists(filename):
+        return None
+    with h5py.File(filename, 'r') as f:
+        if key not in f:
+            return None
+        group = f[key]
+        if source_file is not None:
+            stat = os.stat(source_file)
+            if group.attrs.get('source_size') != stat.st_size or group.attrs.get('source_mtime') != stat.st_mtime:
+                return None
+        data = group['data'][:]
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return csr_matrix((data, group['indices'][:], group['indptr'][:]), shape=tuple(group.attrs['shape']))
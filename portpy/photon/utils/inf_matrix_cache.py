@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+import h5py
+import numpy as np
+from scipy import sparse
+
+
+class InfluenceMatrixCache:
+    """
+    Content-addressed on-disk cache of the influence matrix objects. Each entry is saved in a separate .h5 file named
+    by the hash of the parameters used to create the influence matrix. The least recently used entries are removed when
+    the total size of the cache exceeds max_size_gb.
+
+    :param cache_dir: directory to save the cache files
+    :param max_size_gb: maximum size of the cache in GB. If None, entries are never removed
+    """
+
+    def __init__(self, cache_dir: str, max_size_gb: float = None):
+        self.cache_dir = cache_dir
+        self.max_size_gb = max_size_gb
+
+    @staticmethod
+    def get_key(params: dict, arrays: list = None) -> str:
+        """
+        Create hash key from the parameters and arrays
+
+        :param params: json serializable dictionary of parameters
+        :param arrays: list of arrays which are hashed together with parameters
+        :return: hash key
+        """
+        h = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode())
+        for arr in arrays or []:
+            arr = np.ascontiguousarray(arr)
+            h.update(str((arr.dtype.str, arr.shape)).encode())
+            h.update(arr.tobytes())
+        return h.hexdigest()
+
+    def get_filename(self, key: str) -> str:
+        return os.path.join(self.cache_dir, 'inf_matrix_{}.h5'.format(key))
+
+    def load(self, key: str):
+        """
+        Load the cached entry
+
+        :param key: hash key of the entry
+        :return: dictionary saved using save() or None if the entry does not exist
+        """
+        filename = self.get_filename(key)
+        if not os.path.exists(filename):
+            return None
+        try:
+            with h5py.File(filename, 'r') as f:
+                entry = self._read_obj(f['entry'])
+        except (OSError, KeyError):
+            return None
+        os.utime(filename)  # mark as recently used
+        return entry
+
+    def save(self, key: str, entry: dict) -> None:
+        """
+        Save the entry to cache and remove the least recently used entries if cache exceeds max_size_gb
+
+        :param key: hash key of the entry
+        :param entry: dictionary containing arrays, sparse matrices, lists, dictionaries and scalars
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        filename = self.get_filename(key)
+        tmp_filename = filename + '.tmp'
+        try:
+            with h5py.File(tmp_filename, 'w') as f:
+                self._write_obj(f, 'entry', entry)
+        except Exception:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+        os.replace(tmp_filename, filename)
+        self.evict(keep=filename)
+
+    def evict(self, keep: str = None) -> None:
+        """
+        Remove the least recently used entries until the size of cache is less than max_size_gb
+
+        :param keep: file which should not be removed
+        """
+        if self.max_size_gb is None or not os.path.isdir(self.cache_dir):
+            return
+        files = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir)
+                 if f.startswith('inf_matrix_') and f.endswith('.h5')]
+        files = sorted(files, key=os.path.getmtime)
+        total_size = sum(os.path.getsize(f) for f in files)
+        max_size = self.max_size_gb * 1024 ** 3
+        for filename in files:
+            if total_size <= max_size:
+                break
+            if filename == keep:
+                continue
+            total_size -= os.path.getsize(filename)
+            os.remove(filename)
+
+    def clear(self) -> None:
+        """
+        Remove all the entries from cache
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+        for f in os.listdir(self.cache_dir):
+            if f.startswith('inf_matrix_') and f.endswith('.h5'):
+                os.remove(os.path.join(self.cache_dir, f))
+
+    @staticmethod
+    def _write_obj(parent, name: str, obj) -> None:
+        if isinstance(obj, dict):
+            group = parent.create_group(name)
+            group.attrs['type'] = 'dict'
+            group.attrs['keys'] = json.dumps(list(obj.keys()))
+            for i, val in enumerate(obj.values()):
+                InfluenceMatrixCache._write_obj(group, str(i), val)
+        elif isinstance(obj, (list, tuple)):
+            group = parent.create_group(name)
+            group.attrs['type'] = type(obj).__name__
+            for i, val in enumerate(obj):
+                InfluenceMatrixCache._write_obj(group, str(i), val)
+        elif sparse.issparse(obj):
+            obj = obj.tocsr()
+            group = parent.create_group(name)
+            group.attrs['type'] = 'csr'
+            group.attrs['shape'] = obj.shape
+            group.create_dataset('data', data=obj.data)
+            group.create_dataset('indices', data=obj.indices)
+            group.create_dataset('indptr', data=obj.indptr)
+        elif isinstance(obj, (np.ndarray, np.generic)):
+            if obj.dtype.kind == 'U':
+                dset = parent.create_dataset(name, data=np.char.encode(obj, 'utf-8'))
+                dset.attrs['type'] = 'str_array'
+            elif obj.dtype.kind == 'O':
+                raise TypeError('object arrays cannot be saved in cache')
+            else:
+                dset = parent.create_dataset(name, data=obj)
+                dset.attrs['type'] = 'array' if isinstance(obj, np.ndarray) else 'scalar'
+        elif obj is None or isinstance(obj, (bool, int, float, str)):
+            group = parent.create_group(name)
+            group.attrs['type'] = 'json'
+            group.attrs['value'] = json.dumps(obj)
+        else:
+            raise TypeError('{} cannot be saved in cache'.format(type(obj)))
+
+    @staticmethod
+    def _read_obj(node):
+        obj_type = node.attrs['type']
+        if obj_type == 'dict':
+            keys = json.loads(node.attrs['keys'])
+            return {key: InfluenceMatrixCache._read_obj(node[str(i)]) for i, key in enumerate(keys)}
+        elif obj_type in ('list', 'tuple'):
+            items = [InfluenceMatrixCache._read_obj(node[str(i)]) for i in range(len(node))]
+            return items if obj_type == 'list' else tuple(items)
+        elif obj_type == 'csr':
+            return sparse.csr_matrix((node['data'][:], node['indices'][:], node['indptr'][:]),
+                                     shape=tuple(node.attrs['shape']))
+        elif obj_type == 'str_array':
+            return np.char.decode(node[()], 'utf-8')
+        elif obj_type == 'array':
+            return np.asarray(node[()])
+        elif obj_type == 'scalar':
+            return node[()]
+        elif obj_type == 'json':
+            return json.loads(node.attrs['value'])
+        raise TypeError('invalid cache entry type {}'.format(obj_type))
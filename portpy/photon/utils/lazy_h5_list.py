@@ -0,0 +1,172 @@
+import threading
+from collections import OrderedDict
+from collections.abc import MutableSequence
+from typing import Callable, NamedTuple
+import numpy as np
+from scipy import sparse
+
+
+class H5Ref(NamedTuple):
+    """
+    Reference to a dataset (or group) inside a .h5 file of the patient data
+
+    :param filename: full path of the .h5 file
+    :param dataset_key: key of the dataset/group inside the .h5 file
+    :param field: name of the field in the data dictionary (e.g. influenceMatrixSparse)
+    :param structures: structures to be read for the groups organized by structure name. If None, all are read
+    """
+    filename: str
+    dataset_key: str
+    field: str
+    structures: tuple = None
+
+
+class H5ResidentCache:
+    """
+    LRU cache of the data read from .h5 files. The total size of the resident data is kept below max_bytes by
+    evicting the least recently used items. Evicted items are read again from disk on the next access.
+    Memory-mapped arrays are not counted towards the resident size since they are backed by the file itself.
+
+    :param max_bytes: maximum resident size in bytes. If None, the items are never evicted.
+    """
+
+    def __init__(self, max_bytes: float = None):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._resident_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, ref: H5Ref, loader: Callable):
+        """
+        Get the data for the reference. Load it using loader if it is not resident
+
+        :param ref: reference to the .h5 dataset
+        :param loader: function which takes the reference and returns the data
+        :return: data for the reference
+        """
+        with self._lock:
+            if ref in self._items:
+                self._items.move_to_end(ref)
+                return self._items[ref][0]
+        value = loader(ref)
+        nbytes = self.get_nbytes(value)
+        with self._lock:
+            if ref not in self._items:
+                self._items[ref] = (value, nbytes)
+                self._resident_bytes += nbytes
+            self._evict(keep=ref)
+            return self._items[ref][0]
+
+    def __contains__(self, ref: H5Ref) -> bool:
+        return ref in self._items
+
+    def get_resident_bytes(self) -> int:
+        """
+        :return: total size in bytes of the data currently resident in cache
+        """
+        return self._resident_bytes
+
+    def clear(self):
+        """
+        Remove all the items from cache
+        """
+        with self._lock:
+            self._items.clear()
+            self._resident_bytes = 0
+
+    def _evict(self, keep: H5Ref):
+        if self.max_bytes is None:
+            return
+        for ref in list(self._items.keys()):
+            if self._resident_bytes <= self.max_bytes:
+                break
+            if ref == keep or self._items[ref][1] == 0:
+                continue
+            _, nbytes = self._items.pop(ref)
+            self._resident_bytes -= nbytes
+
+    @staticmethod
+    def get_nbytes(value) -> int:
+        """
+        Get the size of the data in memory. Memory-mapped arrays are considered to be of size 0
+
+        :param value: data read from .h5 file
+        :return: size in bytes
+        """
+        if isinstance(value, np.memmap):
+            return 0
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        if sparse.issparse(value):
+            return sum(getattr(value, attr).nbytes for attr in ('data', 'indices', 'indptr') if hasattr(value, attr))
+        if isinstance(value, dict):
+            return sum(H5ResidentCache.get_nbytes(val) for val in value.values())
+        if isinstance(value, (list, tuple)):
+            return sum(H5ResidentCache.get_nbytes(val) for val in value)
+        return 0
+
+
+class LazyH5List(MutableSequence):
+    """
+    List whose elements are read lazily from .h5 files. The list initially contains references (H5Ref) to the datasets
+    and each element is materialized on its first access through the shared H5ResidentCache. Elements which are
+    set or appended by the user are kept as it is.
+
+    The list is converted to a regular list when it is copied or pickled.
+
+    :param refs: list of references to .h5 datasets
+    :param loader: function which takes the reference and returns the data
+    :param cache: object of class H5ResidentCache shared between lazy lists
+    """
+
+    def __init__(self, refs: list, loader: Callable, cache: H5ResidentCache):
+        self._items = list(refs)
+        self._loader = loader
+        self._cache = cache
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._materialize(item) for item in self._items[index]]
+        return self._materialize(self._items[index])
+
+    def __setitem__(self, index, value):
+        self._items[index] = value
+
+    def __delitem__(self, index):
+        del self._items[index]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        for item in self._items:
+            yield self._materialize(item)
+
+    def __repr__(self):
+        return 'LazyH5List({})'.format(self._items)
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+    def insert(self, index, value):
+        self._items.insert(index, value)
+
+    def copy(self):
+        return LazyH5List(self._items, loader=self._loader, cache=self._cache)
+
+    def is_loaded(self, index: int) -> bool:
+        """
+        Check if the element is already read from disk and resident in memory
+
+        :param index: index of the element
+        :return: True if element is resident
+        """
+        item = self._items[index]
+        if isinstance(item, H5Ref):
+            return item in self._cache
+        return True
+
+    def _materialize(self, item):
+        if isinstance(item, H5Ref):
+            return self._cache.get(item, self._loader)
+        return item
@@ -12,6 +12,7 @@ if TYPE_CHECKING:
     from portpy.photon.plan import Plan
 import numpy as np
 from copy import deepcopy
+from .beam_map import beam_map_1d_to_2d, beam_map_2d_to_1d
 
 
 def leaf_sequencing_siochi(my_plan: Plan, sol: dict, num_of_levels: int = 40) -> dict:
@@ -35,13 +36,7 @@ def leaf_sequencing_siochi(my_plan: Plan, sol: dict, num_of_levels: int = 40) ->
         maps = inf_matrix.get_bev_2d_grid(beam_id=beam_id, finest_grid=False)
         numRows = np.size(maps, 0)
         numCols = np.size(maps, 1)
-        w_maps = np.zeros((numRows, numCols))
-        # wMaps = np.zeros((numRows, numCols))
-        for r in range(numRows):
-            for c in range(numCols):
-                if maps[r, c] >= 0:
-                    curr = maps[r, c]
-                    w_maps[r, c] = sol['optimal_intensity'][curr]
+        w_maps = beam_map_1d_to_2d(maps, np.asarray(sol['optimal_intensity']))
 
         # create levels for fluence
         cal_fac = np.amax(w_maps)
@@ -175,11 +170,7 @@ def leaf_sequencing_siochi(my_plan: Plan, sol: dict, num_of_levels: int = 40) ->
             leaf_sequencing[gantry_angle].setdefault('MU', []).append(leaf_weight[l])
             leaf_sequencing[gantry_angle].setdefault('leaf_shapes', []).append(leaf_shapes[l])
             sum_of_beam = sum_of_beam + leaf_shapes[l]*leaf_weight[l]
-        for r in range(numRows):
-            for c in range(numCols):
-                if maps[r, c] >= 0:
-                    curr = maps[r, c]
-                    w_approx[curr] = sum_of_beam[r, c]
+        beam_map_2d_to_1d(maps, sum_of_beam, w_approx)
     leaf_sequencing['optimal_intensity'] = w_approx
     return leaf_sequencing
 
@@ -0,0 +1,132 @@
+import numpy as np
+from scipy import sparse
+
+
+class LowRankMatrix:
+    """
+    Low-rank representation A ~ U @ W of the influence matrix. U is dense matrix of shape (voxels x rank) and W is
+    dense or sparse matrix of shape (rank x beamlets). For truncated SVD, W = diag(s) @ Vt. For per-beam low-rank
+    blocks, U contains the left factors of all the beams and W is block diagonal.
+
+    It supports the operations used for influence matrix in optimization and evaluation i.e. A @ x (x can be numpy
+    array or cvxpy expression), A.T @ y, row/column indexing (A[rows, :]) and shape. Products are computed as
+    U @ (W @ x), so they cost O((voxels + beamlets) x rank).
+
+    :param U: left factor of shape (voxels x rank)
+    :param W: right factor of shape (rank x beamlets)
+    :param approx_error: relative approximation error ||A - U @ W||_F / ||A||_F
+
+    """
+
+    def __init__(self, U, W, approx_error: float = None):
+        self.U = U
+        self.W = W
+        self.approx_error = approx_error
+        self.shape = (U.shape[0], W.shape[1])
+        self.dtype = np.result_type(U.dtype, W.dtype)
+        self.ndim = 2
+
+    def __matmul__(self, x):
+        return self.U @ (self.W @ x)
+
+    def dot(self, x):
+        return self @ x
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        rows, cols = key
+        U = self.U if _is_full_slice(rows) else self.U[rows]
+        W = self.W if _is_full_slice(cols) else self.W[:, cols]
+        return LowRankMatrix(U, W, approx_error=self.approx_error)
+
+    @property
+    def T(self):
+        return LowRankMatrix(self.W.T, self.U.T, approx_error=self.approx_error)
+
+    @property
+    def rank(self) -> int:
+        return self.U.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(_nbytes(M) for M in [self.U, self.W])
+
+    def toarray(self) -> np.ndarray:
+        return np.asarray(self.U @ (self.W.toarray() if sparse.issparse(self.W) else self.W))
+
+    def astype(self, dtype):
+        return LowRankMatrix(self.U.astype(dtype), self.W.astype(dtype), approx_error=self.approx_error)
+
+    def __repr__(self):
+        return '<{}x{} LowRankMatrix of rank {} with relative error {}>'.format(
+            self.shape[0], self.shape[1], self.rank, self.approx_error)
+
+
+def _is_full_slice(key) -> bool:
+    return isinstance(key, slice) and key == slice(None)
+
+
+def _nbytes(M) -> int:
+    if sparse.issparse(M):
+        M = M.tocsr()
+        return M.data.nbytes + M.indices.nbytes + M.indptr.nbytes
+    return M.nbytes
+
+
+def frobenius_norm(A) -> float:
+    """
+    Frobenius norm of dense or sparse matrix
+    """
+    if sparse.issparse(A):
+        return float(np.sqrt(np.sum(np.abs(A.data) ** 2)))
+    return float(np.linalg.norm(A))
+
+
+def randomized_svd(A, rank: int = None, tol: float = None, oversample: int = 10, power_iter: int = 2,
+                   seed: int = 0, max_rank: int = None):
+    """
+    Truncated SVD of A using randomized range finder (Halko et al. 2011). Only the products A @ X and A.T @ Y are
+    used for the range finder and A can be dense or sparse matrix.
+
+    The rank is given by rank or the smallest rank with relative Frobenius error <= tol. The error of the truncated
+    SVD is sqrt(||A||_F^2 - sum(s^2)) / ||A||_F since U @ diag(s) @ Vt is a projection of A.
+
+    :param A: matrix of shape (m x n)
+    :param rank: rank of the truncated SVD
+    :param tol: relative Frobenius error used to select the rank if rank is None
+    :param oversample: number of additional random vectors for the range finder
+    :param power_iter: number of power iterations to improve accuracy for slowly decaying singular values
+    :param seed: seed of the random number generator
+    :param max_rank: maximum rank used when selecting the rank using tol. defaults to min(m, n). The size of the
+        random sketch starts from 64 and is doubled until tol is achieved
+    :return: U, s, Vt and relative approximation error
+    """
+    m, n = A.shape
+    if rank is None and tol is None:
+        raise ValueError('rank or tol should be given')
+    rng = np.random.default_rng(seed)
+    norm_A = max(frobenius_norm(A), np.finfo(float).tiny)
+    max_sketch_size = min(m, n) if max_rank is None else min(max_rank + oversample, m, n)
+    # if rank is not given, size of the sketch is doubled until tol is achieved
+    sketch_size = min(rank + oversample, m, n) if rank is not None else min(64, max_sketch_size)
+    while True:
+        Q, _ = np.linalg.qr(np.asarray(A @ rng.standard_normal((n, sketch_size))))
+        for _ in range(power_iter):
+            Z, _ = np.linalg.qr(np.asarray(A.T @ Q))
+            Q, _ = np.linalg.qr(np.asarray(A @ Z))
+        B = np.asarray(A.T @ Q).T  # B = Q.T @ A
+        Ub, s, Vt = np.linalg.svd(B, full_matrices=False)
+        errors = np.sqrt(np.maximum(norm_A ** 2 - np.cumsum(s ** 2), 0)) / norm_A
+        if rank is not None or errors[-1] <= tol or sketch_size >= max_sketch_size:
+            break
+        sketch_size = min(2 * sketch_size, max_sketch_size)
+    if rank is None:
+        below = np.flatnonzero(errors <= tol)
+        if below.size > 0:
+            rank = int(below[0]) + 1
+        else:
+            rank = len(s) if max_rank is None else min(len(s), max_rank)
+            print('Warning: relative error {:.2e} is not achieved with rank {}'.format(tol, rank))
+    rank = max(min(rank, len(s)), 1)
+    return Q @ Ub[:, :rank], s[:rank], Vt[:rank], float(errors[rank - 1])
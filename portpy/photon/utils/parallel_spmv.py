@@ -0,0 +1,141 @@
+import os
+import threading
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator
+from concurrent.futures import ThreadPoolExecutor
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _get_executor(num_threads: int) -> ThreadPoolExecutor:
+    # thread pools are shared by all the operators with the same number of threads
+    with _executors_lock:
+        if num_threads not in _executors:
+            _executors[num_threads] = ThreadPoolExecutor(max_workers=num_threads)
+        return _executors[num_threads]
+
+
+class ParallelSpMV(LinearOperator):
+    """
+    Linear operator for multithreaded sparse matrix-vector products A @ x and A.T @ y.
+
+    The matrix is split into row blocks with about the same number of non-zeros. The blocks share the arrays of A.
+    For csr matrix, A @ x is computed by multiplying the row blocks in parallel and A.T @ y by summing the products of
+    the transposed row blocks. For csc matrix, the column blocks of A (row blocks of A.T) are used in the same way.
+    SciPy releases the GIL in its sparse kernels, so the blocks are multiplied in parallel threads.
+    If the matrix is not csr/csc sparse matrix, it is too small or num_threads is 1, SciPy product is used.
+
+    :param A: influence matrix
+    :param num_threads: number of threads. defaults to None (number of cpus)
+    :param min_nnz_per_thread: minimum number of non-zeros in each block. defaults to 100000
+
+    :Example:
+    >>> A_op = ParallelSpMV(inf_matrix.A, num_threads=8)
+    >>> dose_1d = A_op @ x
+    >>> grad = A_op.T @ (dose_1d - presc)
+    """
+
+    def __init__(self, A, num_threads: int = None, min_nnz_per_thread: int = 100000):
+        super().__init__(dtype=A.dtype, shape=A.shape)
+        self.A = A
+        self.num_threads = num_threads if num_threads is not None else (os.cpu_count() or 1)
+        self.min_nnz_per_thread = min_nnz_per_thread
+        self._blocks = None
+        self._bounds = None
+        self._is_csc = False
+        if sparse.issparse(A) and A.format in ('csr', 'csc') and self.num_threads > 1:
+            # row blocks of csr matrix. csc matrix is handled as transpose of csr matrix
+            self._is_csc = A.format == 'csc'
+            M = A.T if self._is_csc else A
+            num_blocks = int(min(self.num_threads, max(1, M.nnz // max(min_nnz_per_thread, 1))))
+            if num_blocks > 1:
+                self._bounds = np.searchsorted(M.indptr, np.linspace(0, M.nnz, num_blocks + 1)[1:-1])
+                self._bounds = np.unique(np.concatenate([[0], self._bounds, [M.shape[0]]]))
+                self._blocks = [self._row_block(M, start, end) for start, end in
+                                zip(self._bounds[:-1], self._bounds[1:])]
+
+    def __reduce__(self):
+        return self.__class__, (self.A, self.num_threads, self.min_nnz_per_thread)
+
+    @staticmethod
+    def _row_block(M, start: int, end: int):
+        # csr matrix sharing indices and data with M
+        nz_start, nz_end = M.indptr[start], M.indptr[end]
+        return sparse.csr_matrix((M.data[nz_start:nz_end], M.indices[nz_start:nz_end],
+                                  M.indptr[start:end + 1] - nz_start), shape=(end - start, M.shape[1]), copy=False)
+
+    def is_parallel(self) -> bool:
+        """
+        :return: True if products are computed in parallel threads
+        """
+        return self._blocks is not None
+
+    def _stack_products(self, x: np.ndarray) -> np.ndarray:
+        # (row blocks) @ x
+        out = np.empty((self._bounds[-1],) + x.shape[1:], dtype=np.result_type(self.dtype, x.dtype))
+
+        def multiply(i):
+            out[self._bounds[i]:self._bounds[i + 1]] = self._blocks[i] @ x
+
+        list(_get_executor(self.num_threads).map(multiply, range(len(self._blocks))))
+        return out
+
+    def _sum_products(self, y: np.ndarray) -> np.ndarray:
+        # (row blocks).T @ y
+        def multiply(i):
+            return self._blocks[i].T @ y[self._bounds[i]:self._bounds[i + 1]]
+
+        return np.sum(list(_get_executor(self.num_threads).map(multiply, range(len(self._blocks)))), axis=0)
+
+    def _matvec(self, x):
+        x = np.asarray(x)
+        if self._blocks is None:
+            return self.A @ x
+        return self._sum_products(x) if self._is_csc else self._stack_products(x)
+
+    def _rmatvec(self, y):
+        y = np.asarray(y)
+        if self._blocks is None:
+            return self.A.T @ y
+        return self._stack_products(y) if self._is_csc else self._sum_products(y)
+
+    def _matmat(self, X):
+        return self._matvec(X)
+
+    def _rmatmat(self, Y):
+        return self._rmatvec(Y)
+
+    def _adjoint(self):
+        return _AdjointParallelSpMV(self)
+
+    def _transpose(self):
+        # influence matrix is real. So, transpose is same as adjoint
+        return _AdjointParallelSpMV(self)
+
+
+class _AdjointParallelSpMV(LinearOperator):
+    # A.T of ParallelSpMV using the same blocks
+
+    def __init__(self, op: ParallelSpMV):
+        super().__init__(dtype=op.dtype, shape=(op.shape[1], op.shape[0]))
+        self.op = op
+
+    def _matvec(self, x):
+        return self.op._rmatvec(x)
+
+    def _rmatvec(self, y):
+        return self.op._matvec(y)
+
+    def _matmat(self, X):
+        return self.op._rmatvec(X)
+
+    def _rmatmat(self, Y):
+        return self.op._matvec(Y)
+
+    def _adjoint(self):
+        return self.op
+
+    def _transpose(self):
+        return self.op
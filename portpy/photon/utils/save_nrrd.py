@@ -45,7 +45,7 @@ def save_nrrd(my_plan: Plan = None, sol: dict = None, dose_1d: np.ndarray = None
 
     dose_arr = []
     if sol is not None:
-        dose_1d = sol['inf_matrix'].A @ (sol['optimal_intensity']*my_plan.get_num_of_fractions())
+        dose_1d = sol['inf_matrix'].compute_dose(sol['optimal_intensity'], fractions=my_plan.get_num_of_fractions())
         dose_arr = sol['inf_matrix'].dose_1d_to_3d(dose_1d=dose_1d)
     else:
         dose_arr = my_plan.inf_matrix.dose_1d_to_3d(dose_1d=dose_1d)
@@ -0,0 +1,27 @@
+import numpy as np
+from .lazy_h5_list import LazyH5List
+
+
+def shared_copy(obj):
+    """
+    Create copy of the nested dictionaries and lists where numpy arrays and sparse matrices are shared instead of
+    being copied. Dictionaries and lists are copied so that their elements can be replaced without modifying the
+    original object. Arrays are shared as read-only views so that in-place changes raise an error instead of silently
+    modifying the original data. Fields that need to be modified should be replaced with new arrays (copy-on-write).
+
+    :param obj: dictionary, list or array
+    :return: copy of obj sharing the arrays with obj
+    """
+    if isinstance(obj, dict):
+        return {key: shared_copy(val) for key, val in obj.items()}
+    elif isinstance(obj, list):
+        return [shared_copy(val) for val in obj]
+    elif isinstance(obj, LazyH5List):
+        return obj.copy()
+    elif isinstance(obj, tuple):
+        return tuple(shared_copy(val) for val in obj)
+    elif isinstance(obj, np.ndarray):
+        view = obj.view()
+        view.flags.writeable = False
+        return view
+    return obj
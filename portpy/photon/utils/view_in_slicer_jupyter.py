@@ -49,7 +49,7 @@ def view_in_slicer_jupyter(my_plan, dose_1d: np.ndarray = None, sol: dict = None
         if dose_1d is not None:
             dose_arr = my_plan.inf_matrix.dose_1d_to_3d(dose_1d=dose_1d)
         else:
-            dose_1d = sol['inf_matrix'].A * sol['optimal_intensity'] * my_plan.get_num_of_fractions()
+            dose_1d = sol['inf_matrix'].compute_dose(sol['optimal_intensity'], fractions=my_plan.get_num_of_fractions())
             dose_arr = sol['inf_matrix'].dose_1d_to_3d(dose_1d=dose_1d)
         slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", dose_name)
         dose_node = slicer.util.getNode(dose_name)
@@ -11,10 +11,10 @@ from pathlib import Path
 from typing import List, TYPE_CHECKING
 from .ct import CT
 from .structures import Structures
+from .influence_matrix import InfluenceMatrix
 
 if TYPE_CHECKING:
     from portpy.photon.plan import Plan
-    from portpy.photon.influence_matrix import InfluenceMatrix
 try:
     from typing import Literal
 except ImportError:
@@ -57,7 +57,7 @@ class Visualization:
 
         if dose_1d is None:
             if 'dose_1d' not in sol:
-                dose_1d = sol['inf_matrix'].A @ (sol['optimal_intensity'] * my_plan.get_num_of_fractions())
+                dose_1d = sol['inf_matrix'].compute_dose(sol['optimal_intensity'], fractions=my_plan.get_num_of_fractions())
             else:
                 dose_1d = sol['dose_1d']
 
@@ -225,7 +225,7 @@ class Visualization:
                 for s in sol:
                     if 'inf_matrix' not in s:
                         s['inf_matrix'] = my_plan.inf_matrix
-                    dose_1d_list += [s['inf_matrix'].A @ (s['optimal_intensity'] * my_plan.get_num_of_fractions())]
+                dose_1d_list = InfluenceMatrix.compute_dose_for_sols(sol, fractions=my_plan.get_num_of_fractions())
 
         # getting options_fig:
         style = options['style'] if 'style' in options else 'solid'
@@ -504,7 +504,7 @@ class Visualization:
             show_dose = True
         if show_dose:
             if sol is not None:
-                dose_1d = sol['inf_matrix'].A @ (sol['optimal_intensity'] * my_plan.get_num_of_fractions())
+                dose_1d = sol['inf_matrix'].compute_dose(sol['optimal_intensity'], fractions=my_plan.get_num_of_fractions())
                 dose_3d = sol['inf_matrix'].dose_1d_to_3d(dose_1d=dose_1d)
             else:
                 dose_3d = my_plan.inf_matrix.dose_1d_to_3d(dose_1d=dose_1d)
@@ -520,7 +520,7 @@ class Visualization:
 
         if show_isodose:
             if not show_dose:
-                dose_1d = sol['inf_matrix'].A * sol['optimal_intensity'] * my_plan.get_num_of_fractions()
+                dose_1d = sol['inf_matrix'].compute_dose(sol['optimal_intensity'], fractions=my_plan.get_num_of_fractions())
                 dose_3d = sol['inf_matrix'].dose_1d_to_3d(dose_1d=dose_1d)
             dose_legend = Visualization.legend_dose_storage(my_plan)
             ax.contour(dose_3d[slice_num, :, :], dose_legend['dose_1d value'],
@@ -1,6 +1,7 @@
 import numpy as np
 from portpy.photon.data_explorer import DataExplorer
 from portpy.photon.influence_matrix import InfluenceMatrix
+from portpy.photon.utils.beam_map import beam_map_2d_to_1d
 import json
 from copy import deepcopy
 from typing import Union, List
@@ -356,14 +357,11 @@ class Arcs:
             num_beamlets = arc['end_beamlet_idx'] - arc['start_beamlet_idx'] + 1
 
             for b, beam in enumerate(arc['vmat_opt']):
-                beam['intermediate_sol'] = np.zeros_like(beam['reduced_2d_grid'], dtype=float)
-
-                for i in range(beam['start_beamlet_idx'], beam['end_beamlet_idx'] + 1):
-                    row, col = np.where(beam['reduced_2d_grid'] == i)
-                    if beam['int_v'] > 0:
-                        beam['intermediate_sol'][row, col] = min(1, w_beamlet[i - num_beamlets_so_far] / beam['int_v'])
-                    else:
-                        beam['intermediate_sol'][row, col] = 0
+                reduced_2d_grid = beam['reduced_2d_grid']
+                beam['intermediate_sol'] = np.zeros_like(reduced_2d_grid, dtype=float)
+                if beam['int_v'] > 0:
+                    ind = (reduced_2d_grid >= beam['start_beamlet_idx']) & (reduced_2d_grid <= beam['end_beamlet_idx'])
+                    beam['intermediate_sol'][ind] = np.minimum(1, w_beamlet[reduced_2d_grid[ind] - num_beamlets_so_far] / beam['int_v'])
 
             num_beamlets_so_far += num_beamlets
 
@@ -386,13 +384,9 @@ class Arcs:
         adj0 = vmat_params['first_beam_adj']
         # adj2 = vmat_params['last_beam_adj']
 
-        if best_plan:
-            sol['best_act_dose_v'] = np.zeros(A.shape[0])
-        else:
-            sol['act_dose_v'] = np.zeros(A.shape[0])
-            sol['int_dose_v'] = np.zeros(A.shape[0])
-            sol['optimal_intensity'] = np.zeros(A.shape[1])
-
+        # intensities of all the arcs are collected so that doses are computed in a single product
+        w_act = np.zeros(A.shape[1])
+        w_int = np.zeros(A.shape[1])
         beamlet_so_far = 0
         for arc in arcs:
             from_ = arc['start_beamlet_idx']
@@ -412,13 +406,21 @@ class Arcs:
 
             adjust_beamlets_weight[from_1-beamlet_so_far: to_1-beamlet_so_far + 1] = adj1
             if best_plan:
-                sol['best_act_dose_v'] += A[:, from_:to_ + 1] @ (arc['best_w_beamlet_act'] * adjust_beamlets_weight)
+                w_act[from_:to_ + 1] = arc['best_w_beamlet_act'] * adjust_beamlets_weight
             else:
-                sol['act_dose_v'] += A[:, from_:to_ + 1] @ (arc['w_beamlet_act']*adjust_beamlets_weight)
-                sol['int_dose_v'] += A[:, from_:to_ + 1] @ (arc['w_beamlet']*adjust_beamlets_weight)
-                sol['optimal_intensity'][from_:to_+1] = arc['w_beamlet_act']*adjust_beamlets_weight
+                w_act[from_:to_ + 1] = arc['w_beamlet_act'] * adjust_beamlets_weight
+                w_int[from_:to_ + 1] = arc['w_beamlet'] * adjust_beamlets_weight
             beamlet_so_far = beamlet_so_far + num_beamlets
 
+        # intermediate solutions change in every iteration. So, doses are not cached
+        if best_plan:
+            sol['best_act_dose_v'] = inf_matrix.compute_dose(w_act, use_cache=False)
+        else:
+            dose = inf_matrix.compute_dose(np.column_stack([w_act, w_int]), use_cache=False)
+            sol['act_dose_v'] = dose[:, 0]
+            sol['int_dose_v'] = dose[:, 1]
+            sol['optimal_intensity'] = w_act
+
         return sol
 
     def intermediate_to_actual(self):
@@ -484,10 +486,7 @@ class Arcs:
                                 act_solution[r, col[0] + count] = sum_boundary
                             if col[0] + count + 1 <= col[-1]:
                                 act_solution[r, col[0] + count + 1: col[-1]+1] = 0
-                    for c in range(num_cols):
-                        if reduced_2d_grid[r, c] >= 0:
-                            w_beamlet_act[reduced_2d_grid[r, c] - beamlet_so_far] = act_solution[r, c] * beam['int_v']
-
+                beam_map_2d_to_1d(reduced_2d_grid, act_solution * beam['int_v'], w_beamlet_act, offset=beamlet_so_far)
                 beam['actual_sol'] = act_solution
 
             arc['w_beamlet_act'] = w_beamlet_act
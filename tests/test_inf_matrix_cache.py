@@ -0,0 +1,134 @@
+import json
+import os
+
+import h5py
+import numpy as np
+import pytest
+from scipy import sparse
+
+from portpy.photon import DataExplorer, Structures, Beams, InfluenceMatrix
+from portpy.photon.utils.inf_matrix_cache import InfluenceMatrixCache
+
+PATIENT_ID = 'Test_Patient'
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    """
+    Create small patient data with one beam of 4x4 beamlets in PortPy format
+    """
+    pat_dir = tmp_path / 'data' / PATIENT_ID
+    os.makedirs(pat_dir / 'Beams')
+    res, origin, shape = [2.5, 2.5, 2.5], [-10.0, -10.0, -5.0], (4, 8, 8)
+    with h5py.File(pat_dir / 'CT_Data.h5', 'w') as f:
+        f['ct_hu_3d'] = np.zeros(shape, dtype=np.int16)
+    with open(pat_dir / 'CT_MetaData.json', 'w') as f:
+        json.dump({'ct_hu_3d_File': 'CT_Data.h5/ct_hu_3d', 'resolution_xyz_mm': res, 'origin_xyz_mm': origin,
+                   'size_xyz_mm': [8, 8, 4], 'direction': [1, 0, 0, 0, 1, 0, 0, 0, 1]}, f)
+    ptv = np.zeros(shape, dtype=np.uint8)
+    ptv[1:3, 2:6, 2:6] = 1
+    masks = {'PTV': ptv, 'BODY': np.ones(shape, dtype=np.uint8)}
+    with h5py.File(pat_dir / 'StructureSet_Data.h5', 'w') as f:
+        for name, mask in masks.items():
+            f[name] = mask
+    with open(pat_dir / 'StructureSet_MetaData.json', 'w') as f:
+        json.dump([{'name': name, 'volume_cc': float(mask.sum() * np.prod(res) / 1000),
+                    'structure_mask_3d_File': 'StructureSet_Data.h5/' + name, 'fraction_of_vol_in_calc_box': 1.0}
+                   for name, mask in masks.items()], f)
+    with h5py.File(pat_dir / 'OptimizationVoxels_Data.h5', 'w') as f:
+        f['ct_to_dose_voxel_map'] = np.arange(np.prod(shape)).reshape(shape)
+    with open(pat_dir / 'OptimizationVoxels_MetaData.json', 'w') as f:
+        json.dump({'ct_to_dose_voxel_map_File': 'OptimizationVoxels_Data.h5/ct_to_dose_voxel_map',
+                   'ct_voxel_resolution_xyz_mm': res, 'ct_origin_xyz_mm': origin,
+                   'dose_voxel_resolution_xyz_mm': res}, f)
+
+    x, y = np.meshgrid(np.arange(4) * 2.5 - 3.75, 3.75 - np.arange(4) * 2.5)
+    A = sparse.random(int(np.prod(shape)), 16, density=0.3, format='coo', random_state=0)
+    t = np.linspace(0, 2 * np.pi, 30)
+    with h5py.File(pat_dir / 'Beams' / 'Beam_0_Data.h5', 'w') as f:
+        f['inf_matrix_sparse'] = np.column_stack([A.row, A.col, A.data])
+        f['beamlets/id'] = np.arange(16)[:, None]
+        f['beamlets/position_x_mm'] = x.reshape(-1, 1)
+        f['beamlets/position_y_mm'] = y.reshape(-1, 1)
+        f['beamlets/width_mm'] = np.full((16, 1), 2.5)
+        f['beamlets/height_mm'] = np.full((16, 1), 2.5)
+        f['beamlets/MLC_leaf_idx'] = np.repeat(np.arange(4), 4)[:, None]
+        f['BEV_structure_contour_points/PTV/Segment_0'] = np.column_stack([4 * np.cos(t), 4 * np.sin(t)])
+    with open(pat_dir / 'Beams' / 'Beam_0_MetaData.json', 'w') as f:
+        json.dump({'ID': 0, 'gantry_angle': 0, 'collimator_angle': 0, 'couch_angle': 0, 'beam_modality': 'Photon',
+                   'energy_MV': '6X', 'iso_center': {'x_mm': 0, 'y_mm': 0, 'z_mm': 0}, 'jaw_position': {},
+                   'influenceMatrixSparse_File': 'Beam_0_Data.h5/inf_matrix_sparse', 'influenceMatrixSparse_tol': 0.01,
+                   'BEV_structure_contour_points_File': 'Beam_0_Data.h5/BEV_structure_contour_points',
+                   'beamlets': {key + '_File': 'Beam_0_Data.h5/beamlets/' + key for key in
+                                ['id', 'position_x_mm', 'position_y_mm', 'width_mm', 'height_mm', 'MLC_leaf_idx']}}, f)
+    with open(pat_dir / 'PlannerBeams.json', 'w') as f:
+        json.dump({'IDs': [0]}, f)
+    return str(tmp_path / 'data')
+
+
+def _create_inf_matrix(data_dir: str, cache_dir: str, sparse_dtype=None, **kwargs):
+    data = DataExplorer(data_dir=data_dir, patient_id=PATIENT_ID, sparse_dtype=sparse_dtype)
+    structs = Structures(data)
+    beams = Beams(data)
+    inf_matrix = InfluenceMatrix(structs=structs, beams=beams, cache_dir=cache_dir, **kwargs)
+    return inf_matrix, beams
+
+
+def test_cache_round_trip(tmp_path):
+    cache = InfluenceMatrixCache(cache_dir=str(tmp_path))
+    A = sparse.random(5, 4, density=0.5, format='csr', random_state=0)
+    entry = {'A': A, 'beamlets_dict': [{'beam_id': 0, 'opt_beamlets_ids': np.arange(4)}],
+             'opt_voxels_dict': {'name': ['PTV', 'CORD'], 'voxel_idx': [np.arange(3), np.arange(3, 5)]},
+             'beamlet_agg_matrix': sparse.identity(4, format='csr'), 'voxel_agg_matrix': None, 'sparse_tol': 1e-3}
+    cache.save('key', entry)
+    loaded = cache.load('key')
+    assert (loaded['A'] != A).nnz == 0
+    assert (loaded['beamlet_agg_matrix'] != entry['beamlet_agg_matrix']).nnz == 0
+    assert loaded['voxel_agg_matrix'] is None
+    assert loaded['sparse_tol'] == 1e-3
+    assert loaded['opt_voxels_dict']['name'] == ['PTV', 'CORD']
+    assert np.array_equal(loaded['opt_voxels_dict']['voxel_idx'][1], np.arange(3, 5))
+    assert np.array_equal(loaded['beamlets_dict'][0]['opt_beamlets_ids'], np.arange(4))
+    assert cache.load('missing_key') is None
+
+
+def test_cache_miss_then_hit(data_dir, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    inf_matrix, _ = _create_inf_matrix(data_dir, cache_dir)
+    assert len(os.listdir(cache_dir)) > 0
+    cached_inf_matrix, beams = _create_inf_matrix(data_dir, cache_dir)
+    assert cached_inf_matrix.A.dtype == inf_matrix.A.dtype
+    assert (cached_inf_matrix.A != inf_matrix.A).nnz == 0
+    assert cached_inf_matrix.sparse_tol == inf_matrix.sparse_tol
+    # influence matrix of the beams is not kept in memory when it is loaded from cache
+    assert 'influenceMatrixSparse' not in beams.beams_dict
+    assert 'influenceMatrixFull' not in beams.beams_dict
+
+
+def test_cache_key_depends_on_source_data(data_dir, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    inf_matrix, _ = _create_inf_matrix(data_dir, cache_dir, sparse_dtype='float32')
+    assert inf_matrix.A.dtype == np.float32
+    inf_matrix, _ = _create_inf_matrix(data_dir, cache_dir)
+    assert inf_matrix.A.dtype == np.float64
+
+    # influence matrix is created again when the beam data is modified
+    beam_file = os.path.join(data_dir, PATIENT_ID, 'Beams', 'Beam_0_Data.h5')
+    with h5py.File(beam_file, 'r+') as f:
+        f['inf_matrix_sparse'][:, 2] *= 2
+    os.utime(beam_file, (os.stat(beam_file).st_atime, os.stat(beam_file).st_mtime + 10))
+    new_inf_matrix, _ = _create_inf_matrix(data_dir, cache_dir)
+    assert np.allclose(new_inf_matrix.A.toarray(), 2 * inf_matrix.A.toarray())
+
+
+def test_cache_hit_restores_agg_matrices(data_dir, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    inf_matrix, _ = _create_inf_matrix(data_dir, cache_dir, beamlet_width_mm=5, beamlet_height_mm=5)
+    cached_inf_matrix, _ = _create_inf_matrix(data_dir, cache_dir, beamlet_width_mm=5, beamlet_height_mm=5)
+    assert cached_inf_matrix.A.shape == inf_matrix.A.shape
+    assert (cached_inf_matrix.A != inf_matrix.A).nnz == 0
+    assert (cached_inf_matrix.get_beamlet_agg_matrix() != inf_matrix.get_beamlet_agg_matrix()).nnz == 0
+    assert cached_inf_matrix.get_voxel_agg_matrix() is None
+    # full matrix can not be streamed for the down sampled influence matrix loaded from cache
+    with pytest.raises(ValueError):
+        cached_inf_matrix.sparsify(rel_tol=0.1, data=DataExplorer(data_dir=data_dir, patient_id=PATIENT_ID))